@@ -0,0 +1,176 @@
+import asyncio
+import fcntl
+import json
+import os
+import time
+from collections import deque
+from typing import Optional
+
+from metrics import Counter, STAGE_SECONDS, perf_counter
+
+AUDIT_LOG_PATH = os.environ.get("AUDIT_LOG_PATH", "/data/audit.log")
+AUDIT_LOG_MAX_BYTES = int(os.environ.get("AUDIT_LOG_MAX_BYTES", str(64 * 1024 * 1024)))
+AUDIT_LOG_RETENTION = int(os.environ.get("AUDIT_LOG_RETENTION", "8"))
+
+AUDIT_RECORDS = Counter("twofa_audit_records_total", "Audit records by outcome (written, dropped, delayed)",
+                        ("result",))
+_written = AUDIT_RECORDS.labels("written")
+_dropped = AUDIT_RECORDS.labels("dropped")
+_delayed = AUDIT_RECORDS.labels("delayed")
+_failed = AUDIT_RECORDS.labels("failed")
+_flush_timer = STAGE_SECONDS.labels("audit_flush")
+
+# What `record` does when the queue is full
+DROP = "drop"
+BLOCK = "block"
+
+
+class AuditLog:
+    """
+    Verification audit trail written off the request path.
+
+    Handlers `await record(...)`, which appends a tuple to a bounded
+    in-memory queue. A background task (see `run`) takes up to `max_batch`
+    records at a time and hands them to a thread that appends them to the
+    file as JSON lines, then makes one fsync for the whole batch. A batch
+    is written once `max_batch` records are waiting or the oldest has
+    waited `max_delay` seconds, whichever comes first.
+
+    When the queue is full the `policy` decides: DROP discards the record
+    (counted as dropped), BLOCK makes the handler wait for room (counted as
+    delayed). The file rotates to path.1 ... path.N like CodeLog, under a
+    lock file so several workers can share it.
+    """
+
+    def __init__(self, path: str = AUDIT_LOG_PATH, max_batch: int = 512, max_delay: float = 0.2,
+                 queue_size: int = 50000, policy: str = DROP, max_bytes: int = AUDIT_LOG_MAX_BYTES,
+                 retention: int = AUDIT_LOG_RETENTION, fsync: bool = True):
+        if policy not in (DROP, BLOCK):
+            raise ValueError(f"Unknown audit policy: {policy}")
+        self.path = path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue_size = queue_size
+        self.policy = policy
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self.fsync = fsync
+        self._queue = deque()
+        # Set when the writer should look at the queue: first record of a
+        # batch arrived, a full batch is waiting, or we are closing
+        self._wakeup = asyncio.Event()
+        self._room = asyncio.Event()
+        self._closing = False
+        # Batch being written; shielded from cancelling `run` so close() can wait for it
+        self._writing = None
+        self.written = 0
+        self.dropped = 0
+        self.delayed = 0
+        self.failed = 0
+        self.batches = 0
+
+    async def record(self, event: str, user, client_ip: Optional[str], result: str,
+                     timestamp: Optional[float] = None):
+        """Queue one audit record; never touches the disk."""
+        item = (time.time() if timestamp is None else timestamp, event, user, client_ip, result)
+        while len(self._queue) >= self.queue_size:
+            if self.policy == DROP or self._closing:
+                self.dropped += 1
+                _dropped.inc()
+                return
+            self.delayed += 1
+            _delayed.inc()
+            self._room.clear()
+            await self._room.wait()
+        self._queue.append(item)
+        if len(self._queue) == 1 or len(self._queue) >= self.max_batch:
+            self._wakeup.set()
+
+    async def run(self):
+        """Writer loop; run it as a task and cancel it (or call close) on shutdown."""
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            # Give the batch until max_delay after its first record to fill up
+            deadline = loop.time() + self.max_delay
+            while len(self._queue) < self.max_batch and not self._closing:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            await self._flush_batch()
+
+    async def _flush_batch(self):
+        batch = [self._queue.popleft() for _ in range(min(self.max_batch, len(self._queue)))]
+        self._room.set()
+        if not batch:
+            return
+        self._writing = asyncio.ensure_future(self._write_batch(batch))
+        await asyncio.shield(self._writing)
+
+    async def _write_batch(self, batch):
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except Exception as e:
+            self.failed += len(batch)
+            _failed.inc(len(batch))
+            print(f"ERROR: audit batch of {len(batch)} records not written: {e}")
+            return
+        self.written += len(batch)
+        self.batches += 1
+        _written.inc(len(batch))
+
+    async def close(self):
+        """Write whatever is still queued (call from the lifespan after cancelling `run`)."""
+        self._closing = True
+        self._room.set()
+        if self._writing is not None:
+            await self._writing
+        while self._queue:
+            await self._flush_batch()
+
+    def _write(self, batch):
+        started = perf_counter()
+        data = "".join(
+            json.dumps({"ts": ts, "event": event, "user": user, "ip": client_ip, "result": result},
+                       separators=(",", ":")) + "\n"
+            for ts, event, user, client_ip, result in batch
+        ).encode()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self.path) and os.path.getsize(self.path) + len(data) > self.max_bytes:
+                self._rotate()
+            with open(self.path, "ab") as f:
+                f.write(data)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+        _flush_timer.observe(perf_counter() - started)
+
+    def _rotate(self):
+        if self.retention == 0:
+            os.remove(self.path)
+            return
+        oldest = f"{self.path}.{self.retention}"
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for i in range(self.retention - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._queue),
+            "queue_size": self.queue_size,
+            "policy": self.policy,
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "delayed": self.delayed,
+            "failed": self.failed,
+        }
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the TOTP, crypto and HTTP paths
+
+Runs each benchmark for a fixed minimum time, reports ops/sec and p50/p99
+latency, and can save the results as a JSON baseline or compare against
+one, exiting non-zero when a benchmark regressed past the threshold.
+
+Usage:
+    python bench.py                                 # run everything
+    python bench.py --filter totp                   # only names containing "totp"
+    python bench.py --save baseline.json            # record a baseline
+    python bench.py --compare baseline.json         # fail on >20% regressions
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+
+PRIVATE_KEY = "student_private.pem"
+PUBLIC_KEY = "student_public.pem"
+
+# Fixed seed so every run exercises the same inputs
+RNG = random.Random(2024)
+HEX_SEED = bytes(RNG.getrandbits(8) for _ in range(32)).hex()
+
+
+def percentile(sorted_samples, fraction):
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+def measure(fn, min_time, warmup=10, min_ops=20):
+    """Time single calls of fn until min_time has passed."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    clock = time.perf_counter
+    deadline = clock() + min_time
+    while len(samples) < min_ops or clock() < deadline:
+        started = clock()
+        fn()
+        samples.append(clock() - started)
+    total = sum(samples)
+    samples.sort()
+    return {
+        "ops": len(samples),
+        "ops_per_sec": len(samples) / total if total else float("inf"),
+        "p50_us": percentile(samples, 0.50) * 1e6,
+        "p99_us": percentile(samples, 0.99) * 1e6,
+    }
+
+
+def encrypt_seed(hex_seed):
+    with open(PUBLIC_KEY, "rb") as f:
+        public_key = serialization.load_pem_public_key(f.read())
+    ciphertext = public_key.encrypt(hex_seed.encode(), padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None))
+    return base64.b64encode(ciphertext).decode()
+
+
+class AsgiClient:
+    """Drive an ASGI app in-process, without sockets or an HTTP client library."""
+
+    def __init__(self, app):
+        self.app = app
+        self.loop = asyncio.new_event_loop()
+
+    async def _request(self, method, path, body):
+        path, _, query = path.partition("?")
+        payload = json.dumps(body).encode() if body is not None else b""
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+            "query_string": query.encode(), "root_path": "",
+            "headers": [(b"content-type", b"application/json"),
+                        (b"content-length", str(len(payload)).encode())],
+            "client": ("127.0.0.1", 50000), "server": ("127.0.0.1", 8080),
+        }
+        status = None
+
+        async def receive():
+            return {"type": "http.request", "body": payload, "more_body": False}
+
+        async def send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        await self.app(scope, receive, send)
+        return status
+
+    def request(self, method, path, body=None, expect=200):
+        status = self.loop.run_until_complete(self._request(method, path, body))
+        if status != expect:
+            raise RuntimeError(f"{method} {path} returned {status}, expected {expect}")
+        return status
+
+
+def build_benchmarks():
+    """Return a list of (name, callable) pairs."""
+    from crypto_utils import decrypt_seed, get_private_key, load_private_key
+    from totp_utils import TotpSeed, generate_totp_code, verify_totp_code
+    import generate_signature
+
+    seed = TotpSeed.from_hex(HEX_SEED)
+    code, _ = generate_totp_code(seed)
+    encrypted = encrypt_seed(HEX_SEED)
+    private_key = get_private_key(PRIVATE_KEY)
+    commit_hash = "%040x" % RNG.getrandbits(160)
+
+    def quiet(fn):
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                fn()
+        return run
+
+    benchmarks = [
+        ("totp.generate_warm", lambda: generate_totp_code(seed)),
+        ("totp.generate_hex", lambda: generate_totp_code(HEX_SEED)),
+        ("totp.verify_warm", lambda: verify_totp_code(seed, code)),
+        ("totp.verify_hex", lambda: verify_totp_code(HEX_SEED, code)),
+        ("totp.window_rebuild", lambda: TotpSeed(seed.key).window(1)),
+        ("crypto.load_private_key", lambda: load_private_key(PRIVATE_KEY)),
+        ("crypto.get_private_key_cached", lambda: get_private_key(PRIVATE_KEY)),
+        ("crypto.decrypt_seed", lambda: decrypt_seed(encrypted, private_key)),
+        ("signature.sign_commit_hash",
+         quiet(lambda: generate_signature.sign_commit_hash(commit_hash, private_key))),
+    ]
+
+    # HTTP endpoints through the ASGI app, with throttling off so repeated
+    # calls measure the handler rather than 429s. The lifespan doesn't run
+    # here, so there would be no audit writer draining the queue either.
+    os.environ["RATE_LIMIT"] = "0"
+    os.environ["REPLAY_GUARD"] = "0"
+    os.environ["AUDIT_LOG"] = "0"
+    os.environ.setdefault("SEED_STORE_PATH", os.path.join(tempfile.mkdtemp(), "seeds.bin"))
+    import main
+    from seed_store import SeedStore
+
+    with SeedStore(main.SEED_STORE_PATH, writable=True) as store:
+        for user_id in range(1000):
+            store.put(user_id, bytes(RNG.getrandbits(8) for _ in range(32)).hex())
+    main.decrypted_seed = seed
+    client = AsgiClient(main.app)
+    batch = {"items": [{"user_id": i, "code": "000000"} for i in range(100)]}
+
+    benchmarks += [
+        ("http.health", lambda: client.request("GET", "/health")),
+        ("http.generate_2fa", lambda: client.request("GET", "/generate-2fa")),
+        ("http.generate_2fa_user", lambda: client.request("GET", "/generate-2fa?user_id=7")),
+        ("http.verify_2fa", lambda: client.request("POST", "/verify-2fa", {"code": code})),
+        ("http.verify_2fa_user", lambda: client.request("POST", "/verify-2fa",
+                                                       {"code": "000000", "user_id": 7})),
+        ("http.verify_2fa_batch100", lambda: client.request("POST", "/verify-2fa/batch", batch)),
+    ]
+    return benchmarks
+
+
+def compare(results, baseline, threshold, p99_threshold):
+    """Return a list of regression messages (empty if none)."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["ops_per_sec"] < base["ops_per_sec"] * (1 - threshold):
+            regressions.append(f"{name}: {result['ops_per_sec']:.0f} ops/s vs baseline "
+                               f"{base['ops_per_sec']:.0f} ops/s")
+        if result["p99_us"] > base["p99_us"] * (1 + p99_threshold):
+            regressions.append(f"{name}: p99 {result['p99_us']:.1f}us vs baseline {base['p99_us']:.1f}us")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the TOTP, crypto and HTTP paths.")
+    parser.add_argument("--filter", default="", help="Only run benchmarks whose name contains this")
+    parser.add_argument("--min-time", type=float, default=1.0, help="Seconds per benchmark")
+    parser.add_argument("--save", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Allowed ops/sec drop before failing (default 0.2 = 20%%)")
+    parser.add_argument("--p99-threshold", type=float, default=1.0,
+                        help="Allowed p99 growth before failing; tails are noisy (default 1.0 = 100%%)")
+    args = parser.parse_args(argv)
+
+    results = {}
+    print(f"{'benchmark':32} {'ops/sec':>12} {'p50 (us)':>10} {'p99 (us)':>10}")
+    for name, fn in build_benchmarks():
+        if args.filter not in name:
+            continue
+        result = measure(fn, args.min_time)
+        results[name] = result
+        print(f"{name:32} {result['ops_per_sec']:12.0f} {result['p50_us']:10.1f} {result['p99_us']:10.1f}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "results": results,
+            }, f, indent=2)
+        print(f"\n✅ Saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold, args.p99_threshold)
+        if regressions:
+            print("\n❌ Regressions:")
+            for message in regressions:
+                print(f"   {message}")
+            return 1
+        print(f"\n✅ No regressions beyond {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
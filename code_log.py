@@ -0,0 +1,169 @@
+import fcntl
+import mmap
+import os
+import struct
+from typing import List, Optional, Tuple
+
+MAGIC = b"2FACODES"
+VERSION = 1
+
+# magic, version, record size
+_HEADER = struct.Struct("<8sII")
+HEADER_SIZE = _HEADER.size
+
+# unix timestamp, 6-digit ASCII code, padding to 16 bytes
+_RECORD = struct.Struct("<Q6s2x")
+RECORD_SIZE = _RECORD.size
+
+CODE_LOG_PATH = os.environ.get("CODE_LOG_PATH", "/cron/codes.log")
+CODE_LOG_MAX_BYTES = int(os.environ.get("CODE_LOG_MAX_BYTES", str(1024 * 1024)))
+CODE_LOG_RETENTION = int(os.environ.get("CODE_LOG_RETENTION", "4"))
+
+
+class CodeLog:
+    """
+    Append-only log of (timestamp, code) in fixed 16-byte records.
+
+    The active file is rotated to path.1, path.2, ... once it reaches
+    max_bytes, keeping at most `retention` rotated files, so the log never
+    grows past (retention + 1) * max_bytes. Records are appended in time
+    order, so lookups binary-search each file through mmap instead of
+    scanning it.
+    """
+
+    def __init__(self, path: str = CODE_LOG_PATH, max_bytes: int = CODE_LOG_MAX_BYTES,
+                 retention: int = CODE_LOG_RETENTION):
+        if max_bytes < HEADER_SIZE + RECORD_SIZE:
+            raise ValueError(f"max_bytes must be at least {HEADER_SIZE + RECORD_SIZE}")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.retention = retention
+
+    def append(self, timestamp: int, code: str):
+        """Append one record, rotating the active file first if it is full."""
+        record = _RECORD.pack(int(timestamp), code.encode("ascii"))
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        # The cron script and the app may both append; serialise on a lock file
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self.path) and os.path.getsize(self.path) + RECORD_SIZE > self.max_bytes:
+                self._rotate()
+            with open(self.path, "ab") as f:
+                if f.tell() == 0:
+                    f.write(_HEADER.pack(MAGIC, VERSION, RECORD_SIZE))
+                f.write(record)
+
+    def _rotate(self):
+        oldest = f"{self.path}.{self.retention}"
+        if self.retention == 0:
+            os.remove(self.path)
+            return
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for i in range(self.retention - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def files(self) -> List[str]:
+        """Existing log files, oldest first."""
+        candidates = [f"{self.path}.{i}" for i in range(self.retention, 0, -1)] + [self.path]
+        return [path for path in candidates if os.path.exists(path)]
+
+    def range(self, start: Optional[int] = None, end: Optional[int] = None,
+              limit: Optional[int] = None) -> List[Tuple[int, str]]:
+        """
+        Records with start <= timestamp <= end, oldest first.
+
+        Args:
+            start: Earliest timestamp (default: beginning of the log).
+            end: Latest timestamp (default: end of the log).
+            limit: Stop after this many records.
+        """
+        entries = []
+        for path in self.files():
+            if limit is not None and len(entries) >= limit:
+                break
+            try:
+                with open(path, "rb") as f:
+                    if os.fstat(f.fileno()).st_size <= HEADER_SIZE:
+                        continue
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                        self._scan(m, start, end, limit, entries)
+            except FileNotFoundError:
+                # Rotated away between listing and opening
+                continue
+        return entries
+
+    def at(self, timestamp: int) -> Optional[Tuple[int, str]]:
+        """The latest record at or before `timestamp`, if any."""
+        for path in reversed(self.files()):
+            try:
+                with open(path, "rb") as f:
+                    if os.fstat(f.fileno()).st_size <= HEADER_SIZE:
+                        continue
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                        _check_header(m)
+                        index = _bisect_right(m, timestamp) - 1
+                        if index >= 0:
+                            return _read(m, index)
+            except FileNotFoundError:
+                continue
+        return None
+
+    @staticmethod
+    def _scan(m, start, end, limit, entries):
+        _check_header(m)
+        count = _count(m)
+        index = 0 if start is None else _bisect_left(m, start)
+        while index < count:
+            entry = _read(m, index)
+            if end is not None and entry[0] > end:
+                break
+            entries.append(entry)
+            if limit is not None and len(entries) >= limit:
+                break
+            index += 1
+
+
+def _check_header(m):
+    magic, version, record_size = _HEADER.unpack_from(m, 0)
+    if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+        raise ValueError("Not a code log file")
+
+
+def _count(m) -> int:
+    # Ignore a torn trailing record from an interrupted write
+    return (len(m) - HEADER_SIZE) // RECORD_SIZE
+
+
+def _timestamp(m, index) -> int:
+    return struct.unpack_from("<Q", m, HEADER_SIZE + index * RECORD_SIZE)[0]
+
+
+def _read(m, index) -> Tuple[int, str]:
+    timestamp, code = _RECORD.unpack_from(m, HEADER_SIZE + index * RECORD_SIZE)
+    return timestamp, code.decode("ascii")
+
+
+def _bisect_left(m, timestamp) -> int:
+    lo, hi = 0, _count(m)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _timestamp(m, mid) < timestamp:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _bisect_right(m, timestamp) -> int:
+    lo, hi = 0, _count(m)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _timestamp(m, mid) <= timestamp:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
@@ -1,18 +1,104 @@
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.backends import default_backend
+from itertools import islice
+import argparse
 import base64
+import os
+import struct
+import sys
+import threading
+from metrics import CACHE_EVENTS, ERRORS, STAGE_SECONDS, perf_counter
+
+_pem_parse_timer = STAGE_SECONDS.labels("pem_parse")
+_b64_decode_timer = STAGE_SECONDS.labels("b64_decode")
+_rsa_decrypt_timer = STAGE_SECONDS.labels("rsa_decrypt")
+_seed_validate_timer = STAGE_SECONDS.labels("seed_validate")
+_key_cache_hits = CACHE_EVENTS.labels("private_key", "hit")
+_key_cache_misses = CACHE_EVENTS.labels("private_key", "miss")
+_envelope_chunk_timer = STAGE_SECONDS.labels("envelope_chunk_decrypt")
+_decrypt_errors = ERRORS.labels("decrypt_seed")
+
+# Parsed private keys by absolute path: path -> ((mtime_ns, inode, size), key)
+_key_cache = {}
+_key_cache_lock = threading.Lock()
 
 def load_private_key(pem_file):
     """Load RSA private key from PEM file"""
+    started = perf_counter()
     with open(pem_file, 'rb') as f:
         private_key = serialization.load_pem_private_key(
             f.read(),
             password=None,
             backend=default_backend()
         )
+    _pem_parse_timer.observe(perf_counter() - started)
     return private_key
 
+def _key_file_identity(pem_file):
+    st = os.stat(pem_file)
+    return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+def get_private_key(pem_file):
+    """
+    Return the parsed RSA private key for pem_file from the key cache
+    
+    The PEM is parsed on first use and again only when the file's mtime,
+    inode or size changes (e.g. the key was rotated or the mount replaced),
+    so repeated decrypts cost one stat() instead of a 4096-bit key parse.
+    """
+    path = os.path.abspath(pem_file)
+    identity = _key_file_identity(path)
+    cached = _key_cache.get(path)
+    if cached is not None and cached[0] == identity:
+        _key_cache_hits.inc()
+        return cached[1]
+    
+    _key_cache_misses.inc()
+    with _key_cache_lock:
+        cached = _key_cache.get(path)
+        if cached is not None and cached[0] == identity:
+            return cached[1]
+        private_key = load_private_key(path)
+        _key_cache[path] = (identity, private_key)
+        return private_key
+
+def preload_private_key(pem_file):
+    """Parse pem_file into the key cache now, e.g. at startup"""
+    evict_private_key(pem_file)
+    return get_private_key(pem_file)
+
+def evict_private_key(pem_file=None):
+    """Drop pem_file from the key cache, or every cached key if None"""
+    with _key_cache_lock:
+        if pem_file is None:
+            _key_cache.clear()
+        else:
+            _key_cache.pop(os.path.abspath(pem_file), None)
+
+def load_public_key(pem_file):
+    """Load RSA public key from PEM file"""
+    with open(pem_file, 'rb') as f:
+        return serialization.load_pem_public_key(f.read(), backend=default_backend())
+
+def encrypt_seed(hex_seed, public_key):
+    """
+    Encrypt a hex seed with RSA/OAEP (SHA-256), the inverse of decrypt_seed
+    
+    Returns:
+        Base64-encoded ciphertext
+    """
+    ciphertext = public_key.encrypt(
+        hex_seed.encode('utf-8'),
+        padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
+        )
+    )
+    return base64.b64encode(ciphertext).decode('ascii')
+
 def decrypt_seed(encrypted_seed_b64, private_key):
     """
     Decrypt base64-encoded encrypted seed using RSA/OAEP
@@ -29,7 +115,10 @@ def decrypt_seed(encrypted_seed_b64, private_key):
     """
     try:
         # Step 1: Base64 decode the encrypted seed
+        started = perf_counter()
         encrypted_seed = base64.b64decode(encrypted_seed_b64)
+        decoded = perf_counter()
+        _b64_decode_timer.observe(decoded - started)
         
         # Step 2: RSA/OAEP decrypt with SHA-256
         decrypted_bytes = private_key.decrypt(
@@ -40,6 +129,8 @@ def decrypt_seed(encrypted_seed_b64, private_key):
                 label=None
             )
         )
+        decrypted = perf_counter()
+        _rsa_decrypt_timer.observe(decrypted - decoded)
         
         # Step 3: Decode bytes to UTF-8 string
         decrypted_seed = decrypted_bytes.decode('utf-8')
@@ -54,16 +145,254 @@ def decrypt_seed(encrypted_seed_b64, private_key):
         except ValueError:
             raise ValueError("Decrypted seed contains non-hex characters")
         
+        _seed_validate_timer.observe(perf_counter() - decrypted)
+        
         # Step 5: Return hex seed
         return decrypted_seed
         
     except Exception as e:
+        _decrypt_errors.inc()
         raise ValueError(f"Decryption failed: {str(e)}")
 
 
+# Envelope format for bulk seed import/export: one RSA-OAEP-wrapped AES-256
+# data key protects a stream of AES-GCM chunks of fixed-size seed records.
+#
+#   header:  magic "2FAENV1\0" | version u16 | reserved u16 | records per chunk u32 |
+#            wrapped key length u16 | wrapped key
+#   chunks:  AES-GCM(records) + 16-byte tag, back to back
+#
+# Every chunk but the last holds exactly `records per chunk` records, so chunk
+# i starts at a computable offset (random access without an index). The nonce
+# is the chunk index and the associated data is the header plus a last-chunk
+# flag, so reordered, truncated or spliced archives fail authentication.
+ENVELOPE_MAGIC = b"2FAENV1\0"
+ENVELOPE_VERSION = 1
+_ENVELOPE_HEADER = struct.Struct("<8sHHIH")
+SEED_RECORD = struct.Struct("<I32s")
+_GCM_TAG_SIZE = 16
+
+def _oaep():
+    return padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()),
+        algorithm=hashes.SHA256(),
+        label=None
+    )
+
+def _chunk_nonce(index):
+    return index.to_bytes(12, 'big')
+
+def _chunk_aad(header, last):
+    return header + (b"\x01" if last else b"\x00")
+
+def write_seed_envelope(out, records, public_key, chunk_records=1024):
+    """
+    Stream (user_id, key bytes) records into an envelope archive
+    
+    Args:
+        out: Binary file object to write to (needn't be seekable)
+        records: Iterable of (user_id, 32-byte key); consumed lazily
+        public_key: RSA public key that wraps the data key
+        chunk_records: Seed records per AES-GCM chunk
+    
+    Returns:
+        Number of records written
+    """
+    if not 0 < chunk_records <= 0xFFFFFFFF:
+        raise ValueError(f"Invalid chunk size: {chunk_records}")
+    data_key = AESGCM.generate_key(bit_length=256)
+    wrapped = public_key.encrypt(data_key, _oaep())
+    header = _ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, 0, chunk_records, len(wrapped)) + wrapped
+    out.write(header)
+    aesgcm = AESGCM(data_key)
+    
+    def chunks():
+        records_iter = iter(records)
+        while True:
+            chunk = list(islice(records_iter, chunk_records))
+            yield chunk
+            if len(chunk) < chunk_records:
+                return
+    
+    # Hold one chunk back so the last one can be flagged as such
+    count = 0
+    index = 0
+    pending = None
+    for chunk in chunks():
+        if pending is not None and not chunk:
+            break
+        if pending is not None:
+            out.write(aesgcm.encrypt(_chunk_nonce(index), pending, _chunk_aad(header, False)))
+            index += 1
+        pending = b"".join(SEED_RECORD.pack(user_id, key) for user_id, key in chunk)
+        count += len(chunk)
+    out.write(aesgcm.encrypt(_chunk_nonce(index), pending, _chunk_aad(header, True)))
+    return count
+
+class SeedEnvelope:
+    """
+    Reader for envelope archives
+    
+    The data key is unwrapped once (one RSA private-key operation for the
+    whole archive). Iterating streams every record in order; read_chunk(i)
+    decrypts a single chunk of a seekable file.
+    """
+    
+    def __init__(self, f, private_key):
+        self.f = f
+        fixed = f.read(_ENVELOPE_HEADER.size)
+        if len(fixed) != _ENVELOPE_HEADER.size:
+            raise ValueError("Not a seed envelope: truncated header")
+        magic, version, _, self.chunk_records, wrapped_len = _ENVELOPE_HEADER.unpack(fixed)
+        if magic != ENVELOPE_MAGIC or version != ENVELOPE_VERSION:
+            raise ValueError("Not a seed envelope")
+        wrapped = f.read(wrapped_len)
+        if len(wrapped) != wrapped_len:
+            raise ValueError("Not a seed envelope: truncated header")
+        self.header = fixed + wrapped
+        self.chunk_size = self.chunk_records * SEED_RECORD.size + _GCM_TAG_SIZE
+        try:
+            self._aesgcm = AESGCM(private_key.decrypt(wrapped, _oaep()))
+        except Exception as e:
+            _decrypt_errors.inc()
+            raise ValueError(f"Decryption failed: could not unwrap data key ({e})")
+    
+    def _open(self, index, data, last):
+        started = perf_counter()
+        try:
+            plain = self._aesgcm.decrypt(_chunk_nonce(index), data, _chunk_aad(self.header, last))
+        except Exception:
+            _decrypt_errors.inc()
+            raise ValueError(f"Decryption failed: chunk {index} is corrupt, reordered or truncated")
+        _envelope_chunk_timer.observe(perf_counter() - started)
+        if len(plain) % SEED_RECORD.size:
+            raise ValueError(f"Decryption failed: chunk {index} has a partial record")
+        return [(user_id, key) for user_id, key in SEED_RECORD.iter_unpack(plain)]
+    
+    @property
+    def chunk_count(self):
+        """Number of chunks (seekable files only)"""
+        size = os.fstat(self.f.fileno()).st_size - len(self.header)
+        return max(1, -(-size // self.chunk_size))
+    
+    def read_chunk(self, index):
+        """Decrypt chunk `index` of a seekable file"""
+        count = self.chunk_count
+        if not 0 <= index < count:
+            raise IndexError(f"Chunk {index} out of range (archive has {count})")
+        self.f.seek(len(self.header) + index * self.chunk_size)
+        return self._open(index, self.f.read(self.chunk_size), index == count - 1)
+    
+    def __iter__(self):
+        """Stream every record, reading one chunk ahead to spot the last one"""
+        if self.f.seekable():
+            self.f.seek(len(self.header))
+        index = 0
+        data = self.f.read(self.chunk_size)
+        while True:
+            following = self.f.read(self.chunk_size) if len(data) == self.chunk_size else b""
+            yield from self._open(index, data, not following)
+            if not following:
+                return
+            index += 1
+            data = following
+
+def read_seeds(f, private_key):
+    """
+    Yield (user_id, key bytes) from an envelope archive, or a single
+    base64 RSA-OAEP seed as written to encrypted_seed.txt (user_id None)
+    
+    Args:
+        f: Binary file object
+        private_key: RSA private key object
+    """
+    head = f.read(len(ENVELOPE_MAGIC))
+    if head == ENVELOPE_MAGIC:
+        envelope = SeedEnvelope(_Prepend(head, f), private_key)
+        yield from envelope
+        return
+    hex_seed = decrypt_seed((head + f.read()).decode('ascii').strip(), private_key)
+    yield None, bytes.fromhex(hex_seed)
+
+class _Prepend:
+    """File object replaying already-read bytes, for sniffing non-seekable input"""
+    
+    def __init__(self, head, f):
+        self.head = head
+        self.f = f
+    
+    def read(self, size):
+        if self.head:
+            data, self.head = self.head[:size], self.head[size:]
+            if len(data) < size:
+                data += self.f.read(size - len(data))
+            return data
+        return self.f.read(size)
+    
+    def seekable(self):
+        return False
+
+def envelope_main(argv=None):
+    """
+    python crypto_utils.py encrypt-envelope|decrypt-envelope ...
+    
+    Seeds go in and come out as "user_id hex_seed" lines, the format
+    seed_store.py imports.
+    """
+    parser = argparse.ArgumentParser(prog="crypto_utils.py", description="Bulk seed envelope archives.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    encrypt = commands.add_parser("encrypt-envelope", help="'user_id hex_seed' lines on stdin -> archive on stdout")
+    encrypt.add_argument("--public-key", default="student_public.pem")
+    encrypt.add_argument("--chunk-records", type=int, default=1024)
+    decrypt = commands.add_parser("decrypt-envelope",
+                                  help="archive (or single encrypted seed) on stdin -> 'user_id hex_seed' lines")
+    decrypt.add_argument("--private-key", default="student_private.pem")
+    decrypt.add_argument("--input", help="Read this file instead of stdin (needed for --chunk)")
+    decrypt.add_argument("--chunk", type=int, help="Only decrypt this chunk index")
+    args = parser.parse_args(argv)
+    
+    if args.command == "encrypt-envelope":
+        def records():
+            for line in sys.stdin:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                user_id, hex_seed = line.split()
+                key = bytes.fromhex(hex_seed)
+                if len(key) != 32:
+                    raise ValueError(f"Invalid seed for user {user_id}")
+                yield int(user_id), key
+        count = write_seed_envelope(sys.stdout.buffer, records(), load_public_key(args.public_key),
+                                    args.chunk_records)
+        sys.stdout.buffer.flush()
+        print(f"✅ Encrypted {count} seeds", file=sys.stderr)
+        return 0
+    
+    private_key = get_private_key(args.private_key)
+    f = open(args.input, 'rb') if args.input else sys.stdin.buffer
+    try:
+        if args.chunk is not None:
+            if not args.input:
+                parser.error("--chunk needs --input (random access needs a seekable file)")
+            records = SeedEnvelope(f, private_key).read_chunk(args.chunk)
+        else:
+            records = read_seeds(f, private_key)
+        out = sys.stdout
+        for user_id, key in records:
+            out.write(key.hex() + "\n" if user_id is None else f"{user_id} {key.hex()}\n")
+    finally:
+        if args.input:
+            f.close()
+    return 0
+
+
 # Test the decryption (run locally)
 
 if __name__ == "__main__":
+    # Subcommands: python crypto_utils.py encrypt-envelope|decrypt-envelope ...
+    if len(sys.argv) > 1 and sys.argv[1] in ("encrypt-envelope", "decrypt-envelope"):
+        sys.exit(envelope_main(sys.argv[1:]))
+    
     private_key = load_private_key("student_private.pem")
 
     with open("encrypted_seed.txt", "r") as f:
@@ -0,0 +1,232 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from metrics import STAGE_SECONDS, perf_counter
+from seed_store import MAX_USER_ID
+from totp_utils import DEFAULT_LOOK_AHEAD, HotpWindow, SeedLike, as_seed, check_code
+
+MAGIC = b"2FAHOTPC"
+VERSION = 1
+RECORD_SIZE = 8
+
+# magic, version, record size
+_HEADER = struct.Struct("<8sII")
+HEADER_SIZE = _HEADER.size
+_RECORD = struct.Struct("<Q")
+
+# Grow the file in steps of this many records to avoid remapping per insert
+GROW_RECORDS = 65536
+
+_flush_timer = STAGE_SECONDS.labels("hotp_counter_flush")
+
+
+class CounterStore:
+    """
+    Next expected HOTP counter per integer user ID.
+
+    Same layout idea as SeedStore: a header, then one 8-byte little-endian
+    record per user at HEADER_SIZE + user_id * 8, all mapped shared so every
+    worker sees updates at once. A zero record is a token that was never
+    used. Updates are a compare-and-set under a byte-range lock on the
+    record, which is atomic across processes, and only reach the disk when
+    `flush` is called, so many verifies share one msync.
+    """
+
+    def __init__(self, path: str, writable: bool = False):
+        self.path = path
+        self.writable = writable
+        self._lock = threading.Lock()
+        self.pending = 0
+
+        if writable and not os.path.exists(path):
+            self._create(path)
+
+        self._file = open(path, "r+b" if writable else "rb")
+        self._map = None
+        self._remap()
+
+        magic, version, record_size = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+            self.close()
+            raise ValueError(f"{path} is not a HOTP counter store")
+
+    @staticmethod
+    def _create(path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, RECORD_SIZE))
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+        access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+        self._map = mmap.mmap(self._file.fileno(), 0, access=access)
+
+    def _offset(self, user_id: int) -> int:
+        if not 0 <= user_id <= MAX_USER_ID:
+            raise ValueError(f"Invalid user ID: {user_id}")
+        return HEADER_SIZE + user_id * RECORD_SIZE
+
+    def _covers(self, offset: int) -> bool:
+        # Caller holds self._lock
+        if offset + RECORD_SIZE <= len(self._map):
+            return True
+        if os.fstat(self._file.fileno()).st_size > len(self._map):
+            # Another process grew the file since we mapped it
+            self._remap()
+        return offset + RECORD_SIZE <= len(self._map)
+
+    def get(self, user_id: int) -> int:
+        """Next expected counter for `user_id` (0 if the token was never used)."""
+        offset = self._offset(user_id)
+        with self._lock:
+            if not self._covers(offset):
+                return 0
+            return _RECORD.unpack_from(self._map, offset)[0]
+
+    def compare_and_set(self, user_id: int, expected: int, counter: int) -> bool:
+        """
+        Set the counter to `counter` if it still is `expected`.
+
+        Returns:
+            False if another request (in any worker) moved it first.
+        """
+        if not self.writable:
+            raise ValueError("Counter store is opened read-only")
+        offset = self._offset(user_id)
+        fd = self._file.fileno()
+        with self._lock:
+            if not self._covers(offset):
+                self._grow(user_id)
+            fcntl.lockf(fd, fcntl.LOCK_EX, RECORD_SIZE, offset)
+            try:
+                if _RECORD.unpack_from(self._map, offset)[0] != expected:
+                    return False
+                _RECORD.pack_into(self._map, offset, counter)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, RECORD_SIZE, offset)
+            self.pending += 1
+        return True
+
+    def _grow(self, user_id: int):
+        # Caller holds self._lock; the header lock serializes growth between processes
+        fd = self._file.fileno()
+        records = (user_id // GROW_RECORDS + 1) * GROW_RECORDS
+        fcntl.lockf(fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            if os.fstat(fd).st_size < HEADER_SIZE + records * RECORD_SIZE:
+                self._file.truncate(HEADER_SIZE + records * RECORD_SIZE)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+        self._remap()
+
+    def flush(self) -> int:
+        """
+        Write pending counter updates to disk with one msync.
+
+        Returns:
+            Number of updates flushed.
+        """
+        with self._lock:
+            pending, self.pending = self.pending, 0
+        if pending and self.writable:
+            started = perf_counter()
+            self._map.flush()
+            _flush_timer.observe(perf_counter() - started)
+        return pending
+
+    def close(self):
+        if self._map is not None:
+            self.flush()
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class HotpVerifier:
+    """
+    Counter-based HOTP verification with look-ahead resynchronization.
+
+    Each user's HotpWindow is kept (up to `max_windows` of them, least
+    recently used dropped first) and slid forward as the stored counter
+    moves, so a verify is one dict lookup plus the HMACs for counters that
+    came into range.
+    """
+
+    def __init__(self, counters: CounterStore, look_ahead: int = DEFAULT_LOOK_AHEAD,
+                 max_windows: int = 10000):
+        self.counters = counters
+        self.look_ahead = look_ahead
+        self.max_windows = max_windows
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+        self.resyncs = 0
+        self.races = 0
+
+    def _window(self, user_id: int, key: bytes, start: int) -> HotpWindow:
+        with self._lock:
+            window = self._windows.get(user_id)
+            if window is not None:
+                self._windows.move_to_end(user_id)
+        if window is None or window.key != key or window.start > start:
+            window = HotpWindow(key, start, self.look_ahead)
+            with self._lock:
+                self._windows[user_id] = window
+                while len(self._windows) > self.max_windows:
+                    self._windows.popitem(last=False)
+        return window
+
+    def verify(self, user_id: int, seed: SeedLike, code: str) -> Optional[int]:
+        """
+        Accept `code` if it matches one of the next look_ahead+1 counters
+        and advance the user's counter past it.
+
+        Returns:
+            The matched counter, or None (no match, or a concurrent verify
+            consumed the counter first).
+
+        Raises:
+            ValueError: If seed or code is invalid.
+        """
+        seed = as_seed(seed)
+        check_code(code)
+        start = self.counters.get(user_id)
+        window = self._window(user_id, seed.key, start)
+        with self._lock:
+            window.advance(start)
+            matched = window.match(code)
+        if matched is None:
+            return None
+        if not self.counters.compare_and_set(user_id, start, matched + 1):
+            self.races += 1
+            return None
+        if matched > start:
+            self.resyncs += 1
+        return matched
+
+    def stats(self) -> dict:
+        return {
+            "look_ahead": self.look_ahead,
+            "cached_windows": len(self._windows),
+            "resyncs": self.resyncs,
+            "races": self.races,
+            "pending_flush": self.counters.pending,
+        }
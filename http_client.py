@@ -0,0 +1,109 @@
+import asyncio
+import json
+
+
+class Connection:
+    """One keep-alive HTTP/1.1 connection over asyncio streams."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=None, content=None, headers=()):
+        """
+        Send one request and return (status, headers, body bytes), reconnecting if needed.
+
+        `body` is sent as JSON; pass raw bytes as `content` instead to forward
+        a body untouched. Response header names are lower-cased. A request
+        is only resent when a reused keep-alive connection fails before any
+        response byte arrives (the server closed it while idle); once a
+        fresh connection was used or a response started, the error is
+        raised, so a non-idempotent request is never processed twice.
+        """
+        if content is None:
+            content = json.dumps(body).encode() if body is not None else b""
+        head = (f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nConnection: keep-alive\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(content)}\r\n")
+        head += "".join(f"{name}: {value}\r\n" for name, value in headers) + "\r\n"
+        for attempt in (0, 1):
+            reused = self.writer is not None
+            if not reused:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                self.writer.write(head.encode("latin-1") + content)
+                await self.writer.drain()
+                status_line = await self.reader.readuntil(b"\r\n")
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                self.close()
+                started = isinstance(e, asyncio.IncompleteReadError) and e.partial
+                if attempt or not reused or started:
+                    raise
+                continue
+            try:
+                return await self._read_response(status_line)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                raise
+
+    async def _read_response(self, status_line):
+        status = int(status_line.split()[1])
+        length = 0
+        close = False
+        headers = {}
+        while True:
+            line = await self.reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            name = name.strip().lower()
+            value = value.strip()
+            headers[name] = value
+            if name == "content-length":
+                length = int(value)
+            elif name == "connection" and value.lower() == "close":
+                close = True
+        body = await self.reader.readexactly(length) if length else b""
+        if close:
+            self.close()
+        return status, headers, body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class ConnectionPool:
+    """
+    Up to `size` keep-alive connections to one host, handed out one request
+    at a time. Idle connections are reused most-recently-used first, so a
+    light load keeps few sockets warm.
+    """
+
+    def __init__(self, host, port, size=32):
+        self.host = host
+        self.port = port
+        self.size = size
+        self._idle = []
+        self._slots = asyncio.Semaphore(size)
+        self.opened = 0
+
+    async def request(self, method, path, body=None, content=None, headers=()):
+        async with self._slots:
+            conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = Connection(self.host, self.port)
+                self.opened += 1
+            try:
+                result = await conn.request(method, path, body=body, content=content, headers=headers)
+            except BaseException:
+                conn.close()
+                raise
+            self._idle.append(conn)
+            return result
+
+    def close(self):
+        for conn in self._idle:
+            conn.close()
+        self._idle.clear()
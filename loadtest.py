@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Async load generator for the 2FA service
+
+Keeps `--concurrency` keep-alive connections busy for `--duration` seconds
+with a weighted mix of generate / verify / batch requests, and prints
+throughput, latency percentiles and error rate every `--interval` seconds.
+
+Usage:
+    # Against a running service
+    python loadtest.py --url http://127.0.0.1:8080 --users 1000 --store /data/seeds.bin
+
+    # Start uvicorn locally for each worker count and find the saturation point
+    python loadtest.py --spawn --workers 1,2,4 --concurrency 64 --duration 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+from http_client import Connection
+from local_instance import spawn_instance
+from seed_store import SeedStore
+from totp_utils import TotpSeed, generate_totp_code
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[min(len(sorted_samples) - 1, int(fraction * len(sorted_samples)))]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = Counter()
+        self.requests = 0
+
+    def record(self, kind, latency, status):
+        self.requests += 1
+        self.latencies.append(latency)
+        if status != 200:
+            self.errors[f"{kind}:{status}"] += 1
+
+    def summary(self, elapsed):
+        samples = sorted(self.latencies)
+        errors = sum(self.errors.values())
+        return {
+            "requests": self.requests,
+            "rps": self.requests / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(samples, 0.50) * 1000,
+            "p99_ms": percentile(samples, 0.99) * 1000,
+            "max_ms": (samples[-1] * 1000) if samples else 0.0,
+            "error_rate": errors / self.requests if self.requests else 0.0,
+            "errors": dict(self.errors),
+        }
+
+
+def build_requests(seeds, mix, batch_size, rng):
+    """Yield (kind, method, path, body) forever, following the weighted mix."""
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    user_ids = list(seeds)
+    while True:
+        kind = rng.choices(kinds, weights)[0]
+        user_id = rng.choice(user_ids)
+        if kind == "generate":
+            yield kind, "GET", f"/generate-2fa?user_id={user_id}", None
+        elif kind == "verify":
+            code, _ = generate_totp_code(seeds[user_id])
+            yield kind, "POST", "/verify-2fa", {"user_id": user_id, "code": code}
+        else:
+            items = []
+            for other in rng.sample(user_ids, min(batch_size, len(user_ids))):
+                items.append({"user_id": other, "code": generate_totp_code(seeds[other])[0]})
+            yield kind, "POST", "/verify-2fa/batch", {"items": items}
+
+
+async def run_load(host, port, seeds, mix, concurrency, duration, interval, batch_size):
+    total = Stats()
+    window = Stats()
+    deadline = time.monotonic() + duration
+    rng = random.Random(1)
+    requests = build_requests(seeds, mix, batch_size, rng)
+
+    async def client():
+        conn = Connection(host, port)
+        try:
+            while time.monotonic() < deadline:
+                kind, method, path, body = next(requests)
+                started = time.perf_counter()
+                try:
+                    status, _, _ = await conn.request(method, path, body)
+                except (OSError, asyncio.IncompleteReadError):
+                    status = 0
+                    conn.close()
+                latency = time.perf_counter() - started
+                total.record(kind, latency, status)
+                window.record(kind, latency, status)
+        finally:
+            conn.close()
+
+    async def reporter():
+        nonlocal window
+        started = time.monotonic()
+        while time.monotonic() < deadline:
+            await asyncio.sleep(interval)
+            current, window = window, Stats()
+            s = current.summary(interval)
+            print(f"  t={time.monotonic() - started:5.1f}s  {s['rps']:8.0f} req/s  "
+                  f"p50 {s['p50_ms']:7.2f}ms  p99 {s['p99_ms']:7.2f}ms  errors {s['error_rate']:.2%}")
+
+    started = time.monotonic()
+    report = asyncio.create_task(reporter())
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    report.cancel()
+    return total.summary(time.monotonic() - started)
+
+
+def make_seed_store(path, users):
+    """Enrol `users` random seeds and return {user_id: TotpSeed}."""
+    rng = random.Random(7)
+    seeds = {}
+    with SeedStore(path, writable=True) as store:
+        for user_id in range(users):
+            seed = TotpSeed(bytes(rng.getrandbits(8) for _ in range(32)))
+            store.put(user_id, seed)
+            seeds[user_id] = seed
+    return seeds
+
+
+def load_seed_store(path, users):
+    with SeedStore(path) as store:
+        return {user_id: store.get(user_id) for user_id in range(users) if store.get(user_id)}
+
+
+def spawn_server(port, workers, store_path):
+    """Start the service on the store at `store_path`, with all its other state files beside it"""
+    env = dict(os.environ, RATE_LIMIT="0", REPLAY_GUARD="0")
+    return spawn_instance(os.path.dirname(store_path), port, workers, env=env)
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("generate", "verify", "batch"):
+            raise argparse.ArgumentTypeError(f"Unknown request kind: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Async load generator for the 2FA service.")
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="Service to load (ignored with --spawn)")
+    parser.add_argument("--spawn", action="store_true", help="Start uvicorn locally for each worker count")
+    parser.add_argument("--workers", default="1", help="Comma-separated uvicorn worker counts for --spawn")
+    parser.add_argument("--port", type=int, default=18080, help="Port for --spawn")
+    parser.add_argument("--store", help="Seed store the target service uses (required without --spawn)")
+    parser.add_argument("--users", type=int, default=1000, help="Enrolled users to draw requests from")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent keep-alive connections")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per run")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between progress lines")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("generate=1,verify=3"),
+                        help="Weighted request mix, e.g. generate=1,verify=3,batch=1")
+    parser.add_argument("--batch-size", type=int, default=50, help="Items per batch request")
+    parser.add_argument("--json", help="Write the per-run summaries to this file")
+    args = parser.parse_args(argv)
+
+    runs = []
+    if args.spawn:
+        store_path = os.path.join(tempfile.mkdtemp(), "seeds.bin")
+        seeds = make_seed_store(store_path, args.users)
+        for workers in [int(w) for w in args.workers.split(",")]:
+            print(f"\n▶ {workers} worker(s), {args.concurrency} connections, {args.duration:.0f}s")
+            server = spawn_server(args.port, workers, store_path)
+            try:
+                summary = asyncio.run(run_load("127.0.0.1", args.port, seeds, args.mix, args.concurrency,
+                                               args.duration, args.interval, args.batch_size))
+            finally:
+                server.terminate()
+                server.wait()
+            summary["workers"] = workers
+            runs.append(summary)
+    else:
+        if not args.store:
+            parser.error("--store is required without --spawn (codes are computed from its seeds)")
+        target = urlsplit(args.url)
+        seeds = load_seed_store(args.store, args.users)
+        print(f"\n▶ {args.url}, {args.concurrency} connections, {args.duration:.0f}s")
+        runs.append(asyncio.run(run_load(target.hostname, target.port or 80, seeds, args.mix,
+                                         args.concurrency, args.duration, args.interval, args.batch_size)))
+
+    print(f"\n{'workers':>8} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>8}")
+    for run in runs:
+        print(f"{run.get('workers', '-'):>8} {run['rps']:10.0f} {run['p50_ms']:8.2f} {run['p99_ms']:8.2f} "
+              f"{run['max_ms']:8.2f} {run['error_rate']:8.2%}")
+        for kind, count in sorted(run["errors"].items()):
+            print(f"{'':>8} {kind}: {count}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(runs, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
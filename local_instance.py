@@ -0,0 +1,53 @@
+"""
+Local `main.py` instances for tools that need a service of their own
+
+Each instance keeps its seed store, HOTP counters, audit log, snapshot and
+runtime directory under one directory, so instances started side by side
+(shards, load-test runs) never share state files.
+"""
+
+import http.client
+import os
+import subprocess
+import sys
+import time
+
+
+def instance_env(directory: str, base=None) -> dict:
+    """Environment for a `main.py` instance keeping all its files under `directory`."""
+    return dict(os.environ if base is None else base,
+                SEED_STORE_PATH=os.path.join(directory, "seeds.bin"),
+                HOTP_COUNTER_PATH=os.path.join(directory, "hotp-counters.bin"),
+                AUDIT_LOG_PATH=os.path.join(directory, "audit.log"),
+                SNAPSHOT_PATH=os.path.join(directory, "state.snap"),
+                RUNTIME_DIR=os.path.join(directory, "run"))
+
+
+def spawn_instance(directory: str, port: int, workers: int = 1, env=None) -> subprocess.Popen:
+    """Start uvicorn serving main.py on the state in `directory` and wait for /health."""
+    os.makedirs(directory, exist_ok=True)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--no-access-log", "--log-level", "warning"],
+        env=instance_env(directory, env), cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    try:
+        for _ in range(400):
+            if process.poll() is not None:
+                raise RuntimeError(f"Instance on port {port} exited with status {process.returncode}")
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+                conn.request("GET", "/health")
+                if conn.getresponse().status == 200:
+                    conn.close()
+                    break
+                conn.close()
+            except OSError:
+                pass
+            time.sleep(0.05)
+        else:
+            raise RuntimeError(f"Instance on port {port} did not become ready")
+    except BaseException:
+        process.terminate()
+        raise
+    return process
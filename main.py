@@ -1,15 +1,195 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Optional
+import asyncio
+import fcntl
+import hashlib
+import hmac
+import itertools
 import os
 import base64
-from crypto_utils import load_private_key, decrypt_seed
-from totp_utils import generate_totp_code, verify_totp_code
+import stat
+import tempfile
+import time
+from audit_log import BLOCK, DROP, AuditLog
+from code_log import CodeLog
+from hotp_store import CounterStore, HotpVerifier
+from crypto_utils import get_private_key, decrypt_seed, preload_private_key
+import metrics
+import tracing
+from rate_limit import AttemptLimiter
+from scheduler import run_periodic
+from scripts.log_2fa_cron import log_totp_code
+import snapshot
+from seed_repository import EncryptedSeedRepository, InvalidationBus
+from seed_store import SeedStore, parse_user_id as parse_store_user_id
+from totp_utils import (DriftTable, FileReplayBackend, MemoryReplayBackend, ReplayGuard, TotpSeed, check_code,
+                        generate_hotp_code, generate_totp_code, match_totp_batch, match_totp_step)
 
-app = FastAPI()
+SEED_STORE_PATH = os.environ.get("SEED_STORE_PATH", "/data/seeds.bin")
 
-# Global variable to store decrypted seed
+# Per-user seeds kept RSA-encrypted at rest (one base64 file per user, see
+# seed_repository.py) instead of the plaintext seed store, with decrypted
+# seeds cached in an LRU of SEED_CACHE_SIZE entries for SEED_CACHE_TTL seconds
+ENCRYPTED_SEED_DIR = os.environ.get("ENCRYPTED_SEED_DIR")
+SEED_CACHE_SIZE = int(os.environ.get("SEED_CACHE_SIZE", "10000"))
+SEED_CACHE_TTL = float(os.environ.get("SEED_CACHE_TTL", "300"))
+
+# Admin endpoints (seed cache invalidation) require this token in the
+# X-Admin-Token header; without one they only answer loopback clients
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# Batch verification: maximum items per request, and the size above which a
+# batch is split into chunks and verified across a process pool
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "10000"))
+BATCH_POOL_THRESHOLD = int(os.environ.get("BATCH_POOL_THRESHOLD", "2048"))
+BATCH_POOL_WORKERS = int(os.environ.get("BATCH_POOL_WORKERS", str(os.cpu_count() or 1)))
+
+# In-process replacement for cron/2fa-cron: set TOTP_SCHEDULER=1 to log codes
+# from this process (and don't start cron), every TOTP_SCHEDULER_INTERVAL seconds
+TOTP_SCHEDULER = os.environ.get("TOTP_SCHEDULER", "0") == "1"
+TOTP_SCHEDULER_INTERVAL = int(os.environ.get("TOTP_SCHEDULER_INTERVAL", "60"))
+
+# Replay protection: each code is accepted once per user. REPLAY_GUARD_DIR
+# (e.g. /dev/shm/2fa-replay) shares the record between worker processes.
+REPLAY_GUARD = os.environ.get("REPLAY_GUARD", "1") == "1"
+REPLAY_GUARD_DIR = os.environ.get("REPLAY_GUARD_DIR")
+# Inline-seed batch items are recorded under HMAC(key, seed) rather than the
+# seed. REPLAY_KEY (hex) sets the key; otherwise it is derived from the
+# service's private key so every worker computes the same entries.
+REPLAY_KEY = os.environ.get("REPLAY_KEY")
+
+# Clock-drift tracking: /verify-2fa learns each user's step offset and tries
+# it first; VERIFY_MAX_DRIFT bounds how far (in 30s steps) it can move
+DRIFT_TRACKING = os.environ.get("DRIFT_TRACKING", "1") == "1"
+VERIFY_MAX_DRIFT = int(os.environ.get("VERIFY_MAX_DRIFT", "4"))
+DRIFT_MAX_USERS = int(os.environ.get("DRIFT_MAX_USERS", "100000"))
+
+# Counter-based HOTP tokens: next expected counter per user (hotp_store.py),
+# accepting codes up to HOTP_LOOK_AHEAD presses ahead. Counter updates are
+# msync'd every HOTP_FLUSH_INTERVAL seconds rather than per request.
+HOTP_COUNTER_PATH = os.environ.get("HOTP_COUNTER_PATH", "/data/hotp-counters.bin")
+HOTP_LOOK_AHEAD = int(os.environ.get("HOTP_LOOK_AHEAD", "20"))
+HOTP_FLUSH_INTERVAL = float(os.environ.get("HOTP_FLUSH_INTERVAL", "1"))
+
+# Brute-force throttling for code verification, per user and per client IP.
+# Checks against the service's own seed (no user_id) are throttled per
+# client IP rather than as one shared user. BATCH_TRUSTED_IPS lists gateway
+# addresses (comma-separated) whose batch items skip the per-IP budget;
+# every item still counts against its user.
+RATE_LIMIT = os.environ.get("RATE_LIMIT", "1") == "1"
+VERIFY_RATE = float(os.environ.get("VERIFY_RATE", "0.2"))
+VERIFY_BURST = int(os.environ.get("VERIFY_BURST", "5"))
+VERIFY_MAX_FAILURES = int(os.environ.get("VERIFY_MAX_FAILURES", "5"))
+VERIFY_LOCKOUT_SECONDS = float(os.environ.get("VERIFY_LOCKOUT_SECONDS", "300"))
+VERIFY_IP_RATE = float(os.environ.get("VERIFY_IP_RATE", "2"))
+VERIFY_IP_BURST = int(os.environ.get("VERIFY_IP_BURST", "30"))
+BATCH_TRUSTED_IPS = frozenset(ip.strip() for ip in os.environ.get("BATCH_TRUSTED_IPS", "").split(",") if ip.strip())
+
+# Audit trail of every verification outcome (audit_log.py), written in
+# batches by a background task. AUDIT_POLICY=drop sheds records when the
+# queue is full; block makes handlers wait for room instead.
+AUDIT_LOG = os.environ.get("AUDIT_LOG", "1") == "1"
+AUDIT_BATCH = int(os.environ.get("AUDIT_BATCH", "512"))
+AUDIT_MAX_DELAY = float(os.environ.get("AUDIT_MAX_DELAY", "0.2"))
+AUDIT_QUEUE_SIZE = int(os.environ.get("AUDIT_QUEUE_SIZE", "50000"))
+AUDIT_POLICY = os.environ.get("AUDIT_POLICY", DROP)
+
+# In-memory state (service seed, drift offsets, attempt limiters, in-process
+# replay buckets) is snapshotted every SNAPSHOT_INTERVAL seconds and on
+# shutdown, and mapped back in at startup (snapshot.py). Each worker claims
+# a slot and writes its own file (SNAPSHOT_PATH for slot 0, SNAPSHOT_PATH.<n>
+# for the others); startup restores the union of those saved within the
+# last SNAPSHOT_MAX_AGE seconds, so slots of removed workers age out.
+SNAPSHOT = os.environ.get("SNAPSHOT", "1") == "1"
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", "/data/state.snap")
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", "60"))
+SNAPSHOT_MAX_AGE = float(os.environ.get("SNAPSHOT_MAX_AGE", "3600"))
+
+# Opt-in request profiling (tracing.py): SERVER_TIMING=1 adds a Server-Timing
+# header with per-stage durations; PROFILE_EVERY=N cProfiles every Nth request
+# and PROFILE_SLOW_MS dumps stack samples of slower requests into PROFILE_DIR
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") == "1"
+PROFILE_EVERY = int(os.environ.get("PROFILE_EVERY", "0"))
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", "0"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/2fa-profiles")
+
+# Most entries one /codes/history request may return
+CODE_HISTORY_MAX = int(os.environ.get("CODE_HISTORY_MAX", "5000"))
+
+# Bounded thread pool for CPU-heavy crypto (PEM parse, RSA decrypt) so it
+# never runs on the event loop; OpenSSL releases the GIL while it works
+CRYPTO_POOL_SIZE = int(os.environ.get("CRYPTO_POOL_SIZE", "2"))
+
+# Multi-worker mode: WEB_CONCURRENCY uvicorn workers share the service seed
+# through a small mmap'd slot instead of each re-reading /data/seed.txt, and
+# only one of them runs the scheduler. Both live in RUNTIME_DIR, a directory
+# only this user can enter (on tmpfs by default), one per deployment: the
+# default name includes the user and a hash of the checkout and seed store.
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+_RUNTIME_ROOT = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+_INSTANCE = hashlib.sha256(f"{os.getcwd()}\0{SEED_STORE_PATH}".encode()).hexdigest()[:12]
+RUNTIME_DIR = os.environ.get("RUNTIME_DIR", os.path.join(_RUNTIME_ROOT, f"2fa-{os.getuid()}-{_INSTANCE}"))
+SHARED_SEED_PATH = os.environ.get("SHARED_SEED_PATH", os.path.join(RUNTIME_DIR, "seed.bin"))
+SCHEDULER_LOCK_PATH = os.environ.get("SCHEDULER_LOCK_PATH", os.path.join(RUNTIME_DIR, "scheduler.lock"))
+
+# This worker's snapshot file and the flock'd file holding its slot
+snapshot_path = None
+snapshot_slot_lock = None
+
+# Global variable to store the parsed seed handle (TotpSeed)
 decrypted_seed = None
 
+# One-record seed store shared by all workers; record 0 is the service seed
+shared_seed = None
+
+# Set once the lifespan warm-up has finished
+warmed_up = False
+
+# Per-user seed table, opened on first use (see seed_store.py)
+seed_store = None
+
+# HOTP verifier over the counter store, opened on first use
+hotp_verifier = None
+
+# Process pool for large verify batches, started on first use
+batch_pool = None
+
+crypto_executor = ThreadPoolExecutor(max_workers=CRYPTO_POOL_SIZE, thread_name_prefix="crypto")
+
+seed_repository = None
+if ENCRYPTED_SEED_DIR:
+    seed_repository = EncryptedSeedRepository(ENCRYPTED_SEED_DIR, "student_private.pem",
+                                              capacity=SEED_CACHE_SIZE, ttl=SEED_CACHE_TTL,
+                                              executor=crypto_executor)
+
+audit_log = None
+if AUDIT_LOG:
+    audit_log = AuditLog(max_batch=AUDIT_BATCH, max_delay=AUDIT_MAX_DELAY, queue_size=AUDIT_QUEUE_SIZE,
+                         policy=BLOCK if AUDIT_POLICY == BLOCK else DROP)
+
+# Rotating code log written by the cron job / scheduler
+code_log = CodeLog()
+
+drift_table = None
+if DRIFT_TRACKING:
+    drift_table = DriftTable(valid_window=1, max_drift=VERIFY_MAX_DRIFT, max_users=DRIFT_MAX_USERS)
+
+replay_guard = None
+if REPLAY_GUARD:
+    # Keep buckets as long as a drifted step can still match
+    replay_guard = ReplayGuard(FileReplayBackend(REPLAY_GUARD_DIR) if REPLAY_GUARD_DIR else None,
+                               valid_window=max(1, VERIFY_MAX_DRIFT if DRIFT_TRACKING else 1))
+
+user_limiter = ip_limiter = None
+if RATE_LIMIT:
+    user_limiter = AttemptLimiter(rate=VERIFY_RATE, burst=VERIFY_BURST, max_failures=VERIFY_MAX_FAILURES,
+                                  lockout_seconds=VERIFY_LOCKOUT_SECONDS)
+    ip_limiter = AttemptLimiter(rate=VERIFY_IP_RATE, burst=VERIFY_IP_BURST,
+                                max_failures=VERIFY_MAX_FAILURES * 10, lockout_seconds=VERIFY_LOCKOUT_SECONDS)
+
 def try_save_seed(hex_seed):
     """Try to save seed to /data/seed.txt, but don't fail if not writable"""
     try:
@@ -20,28 +200,402 @@ def try_save_seed(hex_seed):
         # In local dev, /data might not be writable. That's OK.
         pass
 
+_seed_file_timer = metrics.STAGE_SECONDS.labels("seed_file_read")
+_seed_store_timer = metrics.STAGE_SECONDS.labels("seed_store_read")
+
+def get_seed_store():
+    """Open the per-user seed store once it exists"""
+    global seed_store
+    if seed_store is None and os.path.exists(SEED_STORE_PATH):
+        seed_store = SeedStore(SEED_STORE_PATH)
+    return seed_store
+
+def get_hotp_verifier():
+    """Open (creating if needed) the HOTP counter store"""
+    global hotp_verifier
+    if hotp_verifier is None:
+        hotp_verifier = HotpVerifier(CounterStore(HOTP_COUNTER_PATH, writable=True),
+                                     look_ahead=HOTP_LOOK_AHEAD)
+    return hotp_verifier
+
+def flush_hotp_counters():
+    """Write batched HOTP counter updates to disk"""
+    if hotp_verifier is not None:
+        hotp_verifier.counters.flush()
+
+def parse_user_id(value):
+    """Validate an optional user ID from a request, raising HTTP 400 if malformed"""
+    try:
+        return parse_store_user_id(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail={"error": "Invalid user_id"})
+
+def read_saved_seed():
+    """Read /data/seed.txt (blocking; call through asyncio.to_thread)"""
+    started = metrics.perf_counter()
+    with open("/data/seed.txt", "r") as f:
+        hex_seed = f.read().strip()
+    _seed_file_timer.observe(metrics.perf_counter() - started)
+    return hex_seed
+
+def publish_seed(seed):
+    """Make seed the service seed in this worker and every other one"""
+    global decrypted_seed
+    decrypted_seed = seed
+    if shared_seed is not None:
+        shared_seed.put(0, seed)
+
+def current_seed():
+    """The service seed, picking up one another worker published (32-byte mmap compare)"""
+    global decrypted_seed
+    if shared_seed is not None:
+        key = shared_seed.get_key(0)
+        if key is not None and (decrypted_seed is None or decrypted_seed.key != key):
+            decrypted_seed = TotpSeed(key)
+    return decrypted_seed
+
+async def resolve_seed(user_id=None):
+    """Return the seed for user_id, or the service's own seed if no user given"""
+
+    if user_id is not None and seed_repository is not None:
+        # Cache hits come back done; misses share one decrypt on the crypto pool
+        future = seed_repository.get_future(user_id)
+        seed = future.result() if future.done() else await asyncio.wrap_future(future)
+        if seed is None:
+            raise HTTPException(status_code=404, detail={"error": "Unknown user"})
+        return seed
+
+    if user_id is not None:
+        started = metrics.perf_counter()
+        store = get_seed_store()
+        seed = store.get(user_id) if store is not None else None
+        _seed_store_timer.observe(metrics.perf_counter() - started)
+        if seed is None:
+            raise HTTPException(status_code=404, detail={"error": "Unknown user"})
+        return seed
+
+    seed = current_seed()
+    if seed is None:
+        if os.path.exists("/data/seed.txt"):
+            seed = TotpSeed.from_hex(await asyncio.to_thread(read_saved_seed))
+            publish_seed(seed)
+        else:
+            raise Exception("Seed not decrypted yet")
+    return seed
+
+def get_batch_pool():
+    global batch_pool
+    if batch_pool is None:
+        batch_pool = ProcessPoolExecutor(max_workers=BATCH_POOL_WORKERS)
+    return batch_pool
+
+def scheduled_log_job():
+    """Cron job body, reusing the warm in-memory seed when there is one"""
+    log_totp_code(seed=current_seed(), code_log=code_log)
+
+def require_admin(request: Request):
+    """Raise HTTP 403 unless the request carries ADMIN_TOKEN or, without one configured, comes from loopback"""
+    if ADMIN_TOKEN:
+        token = request.headers.get("x-admin-token", "")
+        if hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return
+    elif request.client is not None and request.client.host in ("127.0.0.1", "::1"):
+        return
+    raise HTTPException(status_code=403, detail={"error": "Forbidden"})
+
+def ensure_private_dir(path):
+    """
+    Create `path` (mode 0700) or check an existing one is a real directory
+    owned by this user, tightening its mode to 0700. Anything else raises
+    PermissionError rather than trusting files someone else could plant.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise PermissionError(f"{path} is not a directory owned by this user")
+    if stat.S_IMODE(info.st_mode) != 0o700:
+        os.chmod(path, 0o700)
+    return path
+
+def acquire_scheduler_lock():
+    """Return an flock'd file if this worker should run the scheduler, else None"""
+    try:
+        ensure_private_dir(os.path.dirname(os.path.abspath(SCHEDULER_LOCK_PATH)))
+        lock = os.fdopen(os.open(SCHEDULER_LOCK_PATH, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), "a")
+    except OSError as e:
+        print(f"WARNING: scheduler lock unavailable ({e}); not running the in-process scheduler")
+        return None
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+def claim_snapshot_slot():
+    """Claim the lowest free snapshot slot for this worker's lifetime and return its file"""
+    global snapshot_path, snapshot_slot_lock
+    ensure_private_dir(RUNTIME_DIR)
+    for slot in itertools.count():
+        lock = os.fdopen(os.open(os.path.join(RUNTIME_DIR, f"snapshot.{slot}.lock"),
+                                 os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            continue
+        snapshot_slot_lock = lock
+        snapshot_path = snapshot.slot_path(SNAPSHOT_PATH, slot)
+        return snapshot_path
+
+def memory_replay_backend():
+    if replay_guard is not None and isinstance(replay_guard.backend, MemoryReplayBackend):
+        return replay_guard.backend
+    return None
+
+def save_state():
+    """Snapshot in-memory auth state to this worker's slot (blocking; runs off the event loop)"""
+    if snapshot_path is None:
+        return
+    sections = {}
+    seed = current_seed()
+    if seed is not None:
+        sections[snapshot.SEED] = seed.key
+    if drift_table is not None:
+        sections[snapshot.DRIFT] = snapshot.encode_drift(drift_table.items())
+    if user_limiter is not None:
+        sections[snapshot.LIMIT_USER] = snapshot.encode_limiter(user_limiter.export())
+        sections[snapshot.LIMIT_IP] = snapshot.encode_limiter(ip_limiter.export())
+    backend = memory_replay_backend()
+    if backend is not None:
+        # Inline-seed entries only matter for the seconds their code is valid
+        sections[snapshot.REPLAY] = snapshot.encode_replay(
+            (step, [key for key in keys if not (isinstance(key, str) and key.startswith("seed-"))])
+            for step, keys in backend.buckets())
+    snapshot.write_snapshot(snapshot_path, sections)
+
+def restore_state():
+    """Load every worker's last snapshot into this worker's in-memory state"""
+    def restore_seed(buf, elapsed):
+        # Only a fallback: the seed files (loaded first) or a seed another
+        # worker published take precedence
+        if current_seed() is None:
+            publish_seed(TotpSeed(bytes(buf)))
+    
+    handlers = {snapshot.SEED: restore_seed}
+    if drift_table is not None:
+        handlers[snapshot.DRIFT] = lambda buf, elapsed: drift_table.restore(snapshot.decode_drift(buf))
+    if user_limiter is not None:
+        handlers[snapshot.LIMIT_USER] = lambda buf, elapsed: user_limiter.restore(
+            snapshot.decode_limiter(buf), elapsed)
+        handlers[snapshot.LIMIT_IP] = lambda buf, elapsed: ip_limiter.restore(
+            snapshot.decode_limiter(buf), elapsed)
+    backend = memory_replay_backend()
+    if backend is not None:
+        handlers[snapshot.REPLAY] = lambda buf, elapsed: backend.restore(snapshot.decode_replay(buf))
+    for path in snapshot.slot_paths(SNAPSHOT_PATH):
+        try:
+            snapshot.load_snapshot(path, handlers, max_age=SNAPSHOT_MAX_AGE)
+        except ValueError as e:
+            print(f"WARNING: state snapshot not restored: {e}")
+
+def load_seed_files():
+    """The service seed from /data/seed.txt, else encrypted_seed.txt; None if neither exists"""
+    if os.path.exists("/data/seed.txt"):
+        return TotpSeed.from_hex(read_saved_seed())
+    if os.path.exists("encrypted_seed.txt"):
+        hex_seed = decrypt_with_service_key(read_encrypted_seed())
+        try_save_seed(hex_seed)
+        return TotpSeed.from_hex(hex_seed)
+    return None
+
+def warm_up():
+    """Open shared state, parse the private key and load the service seed before serving"""
+    global shared_seed
+    try:
+        ensure_private_dir(os.path.dirname(os.path.abspath(SHARED_SEED_PATH)))
+        shared_seed = SeedStore(SHARED_SEED_PATH, writable=True, capacity=1)
+    except OSError as e:
+        print(f"WARNING: shared seed slot unavailable ({e}); this worker keeps its own copy")
+    if seed_repository is not None:
+        try:
+            seed_repository.bus = InvalidationBus(os.path.join(ensure_private_dir(RUNTIME_DIR), "seed-cache.bus"))
+        except OSError as e:
+            print(f"WARNING: seed cache invalidations stay local to this worker ({e})")
+    get_seed_store()
+    
+    if os.path.exists("student_private.pem"):
+        preload_private_key("student_private.pem")
+    
+    # The seed files are the source of truth: whatever an earlier run left in
+    # the slot or the snapshot is overwritten. The slot only shares the seed.
+    seed = load_seed_files()
+    if seed is not None:
+        publish_seed(seed)
+    if SNAPSHOT:
+        try:
+            claim_snapshot_slot()
+        except OSError as e:
+            print(f"WARNING: no snapshot slot, state will not be saved: {e}")
+        try:
+            restore_state()
+        except (OSError, ValueError) as e:
+            print(f"WARNING: state snapshot not restored: {e}")
+
+@asynccontextmanager
+async def lifespan(app):
+    global warmed_up
+    # Uvicorn only starts accepting requests once this startup half returns
+    try:
+        await asyncio.get_running_loop().run_in_executor(crypto_executor, warm_up)
+    except Exception as e:
+        print(f"WARNING: warm-up incomplete: {e}")
+    warmed_up = True
+    
+    scheduler_task = None
+    scheduler_lock = acquire_scheduler_lock() if TOTP_SCHEDULER else None
+    if scheduler_lock is not None:
+        scheduler_task = asyncio.create_task(run_periodic(scheduled_log_job, TOTP_SCHEDULER_INTERVAL))
+    hotp_flush_task = asyncio.create_task(run_periodic(flush_hotp_counters, HOTP_FLUSH_INTERVAL, align=False))
+    audit_task = asyncio.create_task(audit_log.run()) if audit_log is not None else None
+    snapshot_task = None
+    if SNAPSHOT:
+        snapshot_task = asyncio.create_task(run_periodic(save_state, SNAPSHOT_INTERVAL, align=False))
+    try:
+        yield
+    finally:
+        for task in (scheduler_task, hotp_flush_task, audit_task, snapshot_task):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if audit_log is not None:
+            await audit_log.close()
+        if SNAPSHOT:
+            try:
+                await asyncio.to_thread(save_state)
+            except OSError as e:
+                print(f"WARNING: state snapshot not saved: {e}")
+        if hotp_verifier is not None:
+            hotp_verifier.counters.close()
+        if scheduler_lock is not None:
+            scheduler_lock.close()
+        crypto_executor.shutdown(wait=False)
+        if batch_pool is not None:
+            batch_pool.shutdown(wait=False)
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware,
+                   endpoints=("/generate-2fa", "/verify-2fa", "/verify-2fa/batch", "/decrypt-seed",
+                              "/hotp/verify"))
+if SERVER_TIMING or PROFILE_EVERY or PROFILE_SLOW_MS:
+    app.add_middleware(tracing.ServerTimingMiddleware, header=SERVER_TIMING,
+                       profile_every=PROFILE_EVERY, profile_slow=PROFILE_SLOW_MS / 1000,
+                       profile_dir=PROFILE_DIR)
+
+def limiter_samples():
+    for scope, limiter in (("user", user_limiter), ("ip", ip_limiter)):
+        if limiter is not None:
+            for name, value in limiter.stats().items():
+                yield (scope, name), value
+
+metrics.Gauge("twofa_verify_limiter", "Attempt limiter counters (requests allowed/shed, lockouts)",
+              ("scope", "counter"), callback=limiter_samples)
+
+def drift_samples():
+    if drift_table is not None:
+        stats = drift_table.stats()
+        for name in ("drifting_users", "first_try", "searched", "misses", "overflow"):
+            yield (name,), stats[name]
+
+metrics.Gauge("twofa_verify_drift", "Clock-drift table (users with an offset, first-try and searched matches)",
+              ("counter",), callback=drift_samples)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """GET /metrics - Prometheus text exposition"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def load_replay_key():
+    """Secret for hashing inline seeds into replay-guard entries"""
+    if REPLAY_KEY:
+        return bytes.fromhex(REPLAY_KEY)
+    try:
+        with open("student_private.pem", "rb") as f:
+            return hmac.new(f.read(), b"2fa replay key", hashlib.sha256).digest()
+    except OSError:
+        # Nothing shared to derive it from: each worker only recognises its own entries
+        return os.urandom(32)
+
+replay_secret = load_replay_key()
+
+def replay_key(user_id=None, seed=None):
+    """Identity a replay-guard entry is recorded under (never the seed itself)"""
+    if seed is not None:
+        return "seed-" + hmac.new(replay_secret, seed.key, hashlib.sha256).digest()[:16].hex()
+    return "default" if user_id is None else str(user_id)
+
+def limiter_key(user_id, client_ip):
+    """User-limiter bucket: the user, or the client IP for the service's own seed"""
+    return f"default-{client_ip}" if user_id is None else str(user_id)
+
+def accept_step(key, step, now=None):
+    """True if step matched and (with replay protection) wasn't used before"""
+    if step is None:
+        return False
+    if replay_guard is None:
+        return True
+    return replay_guard.accept(key, step, for_time=now)
+
+async def audit(event, user, client_ip, outcome):
+    """Queue an audit record (no disk I/O on the request path)"""
+    if audit_log is not None:
+        await audit_log.record(event, user, client_ip, outcome)
+
+def audit_outcome(exc):
+    return "throttled" if exc.status_code == 429 else f"http_{exc.status_code}"
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "ok"}
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness: 200 once warm-up finished and the service seed is loaded"""
+    if not warmed_up:
+        return JSONResponse(status_code=503, content={"status": "warming up"})
+    if current_seed() is None:
+        return JSONResponse(status_code=503, content={"status": "seed not decrypted yet"})
+    return {"status": "ready"}
+
+def read_encrypted_seed():
+    with open("encrypted_seed.txt", "r") as f:
+        return f.read().strip()
+
+def decrypt_with_service_key(encrypted_seed_b64):
+    private_key = get_private_key("student_private.pem")
+    return decrypt_seed(encrypted_seed_b64, private_key)
+
 @app.post("/decrypt-seed")
 async def decrypt_seed_endpoint():
     """POST /decrypt-seed - Decrypt the seed from encrypted_seed.txt"""
-    global decrypted_seed
-    
     try:
         if not os.path.exists("encrypted_seed.txt"):
             raise FileNotFoundError("encrypted_seed.txt not found")
         
-        with open("encrypted_seed.txt", "r") as f:
-            encrypted_seed_b64 = f.read().strip()
+        encrypted_seed_b64 = await asyncio.to_thread(read_encrypted_seed)
         
-        private_key = load_private_key("student_private.pem")
-        hex_seed = decrypt_seed(encrypted_seed_b64, private_key)
+        # Key parse (on cache miss) and RSA decrypt run on the crypto pool
+        loop = asyncio.get_running_loop()
+        hex_seed = await loop.run_in_executor(crypto_executor, tracing.bind(decrypt_with_service_key),
+                                              encrypted_seed_b64)
         
-        decrypted_seed = hex_seed
-        try_save_seed(hex_seed)
+        publish_seed(TotpSeed.from_hex(hex_seed))
+        await asyncio.to_thread(try_save_seed, hex_seed)
         
         return {"status": "ok", "message": "Seed decrypted and saved"}
         
@@ -49,49 +603,277 @@ async def decrypt_seed_endpoint():
         raise HTTPException(status_code=500, detail={"error": str(e)})
 
 @app.get("/generate-2fa")
-async def generate_2fa():
-    """GET /generate-2fa - Generate current TOTP code"""
-    global decrypted_seed
-    
+async def generate_2fa(user_id: Optional[int] = None):
+    """GET /generate-2fa - Generate current TOTP code (optionally for ?user_id=)"""
     try:
-        if decrypted_seed is None:
-            if os.path.exists("/data/seed.txt"):
-                with open("/data/seed.txt", "r") as f:
-                    decrypted_seed = f.read().strip()
-            else:
-                raise Exception("Seed not decrypted yet")
-        
-        code, remaining = generate_totp_code(decrypted_seed)
+        seed = await resolve_seed(parse_user_id(user_id))
+        code, remaining = generate_totp_code(seed)
         return {"code": code, "valid_for": remaining}
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail={"error": str(e)})
 
 @app.post("/verify-2fa")
-async def verify_2fa(payload: dict):
-    """POST /verify-2fa - Verify TOTP code"""
-    global decrypted_seed
-    
+async def verify_2fa(payload: dict, request: Request):
+    """POST /verify-2fa - Verify TOTP code (optionally for payload user_id)"""
+    client_ip = request.client.host if request.client else "unknown"
+    outcome = "error"
+    # Audited as parsed: a rejected user_id is never copied into the log
+    user_id = None
     try:
         code = payload.get("code")
         if not code:
             raise HTTPException(status_code=400, detail={"error": "Missing code"})
         
-        if decrypted_seed is None:
-            if os.path.exists("/data/seed.txt"):
-                with open("/data/seed.txt", "r") as f:
-                    decrypted_seed = f.read().strip()
-            else:
-                raise Exception("Seed not decrypted yet")
+        user_id = parse_user_id(payload.get("user_id"))
+        user_key = replay_key(user_id)
+        limit_key = limiter_key(user_id, client_ip)
+        
+        # Throttle before any seed lookup or HMAC work. The IP goes first so a
+        # client over its own budget can't keep spending a victim's user tokens.
+        if user_limiter is not None:
+            if not (ip_limiter.allow(client_ip) and user_limiter.allow(limit_key)):
+                raise HTTPException(status_code=429, detail={"error": "Too many attempts"})
         
-        is_valid = verify_totp_code(decrypted_seed, code, valid_window=1)
+        seed = await resolve_seed(user_id)
+        
+        now = time.time()
+        if drift_table is not None:
+            step = drift_table.match(user_key, seed, code, for_time=now)
+        else:
+            step = match_totp_step(seed, code, valid_window=1, for_time=now)
+        is_valid = accept_step(user_key, step, now)
+        outcome = "valid" if is_valid else "invalid"
+        
+        if user_limiter is not None:
+            user_limiter.record(limit_key, is_valid)
+            ip_limiter.record(client_ip, is_valid)
         return {"valid": is_valid}
         
+    except HTTPException as e:
+        outcome = audit_outcome(e)
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={"error": str(e)})
+    finally:
+        await audit("verify-2fa", user_id, client_ip, outcome)
+
+@app.post("/verify-2fa/batch")
+async def verify_2fa_batch(payload: dict, request: Request):
+    """
+    POST /verify-2fa/batch - Verify many codes in one request
+
+    Body: {"items": [{"code": "123456", "user_id": 1}, {"code": "...", "seed": "<hex>"}, ...]}
+    Items without user_id or seed use the service's own seed. Results come
+    back in input order as {"valid": bool} or {"error": "..."} per item.
+    """
+    client_ip = request.client.host if request.client else "unknown"
+    # A trusted gateway batches for many clients: only its users' budgets apply
+    charge_ip = ip_limiter is not None and client_ip not in BATCH_TRUSTED_IPS
+    try:
+        items = payload.get("items")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail={"error": "Missing items"})
+        if len(items) > BATCH_MAX_ITEMS:
+            raise HTTPException(status_code=413, detail={"error": f"Too many items (max {BATCH_MAX_ITEMS})"})
+        
+        # Resolve each distinct seed once per batch
+        seeds = {}
+        results = [None] * len(items)
+        outcomes = ["error"] * len(items)
+        # Parsed user per item for the audit trail (None for inline seeds and rejected IDs)
+        users = [None] * len(items)
+        pairs = []
+        positions = []
+        keys = []
+        limit_keys = []
+        for i, item in enumerate(items):
+            try:
+                # Every item costs the client IP a token, as a single verify would
+                if charge_ip and not ip_limiter.allow(client_ip):
+                    raise HTTPException(status_code=429, detail={"error": "Too many attempts"})
+                if not isinstance(item, dict):
+                    raise ValueError("Item must be an object")
+                code = item.get("code")
+                check_code(code)
+                if item.get("seed") is not None:
+                    lookup = ("seed", item["seed"])
+                else:
+                    lookup = ("user", parse_user_id(item.get("user_id")))
+                    users[i] = lookup[1]
+                    if user_limiter is not None and not user_limiter.allow(limiter_key(lookup[1], client_ip)):
+                        raise HTTPException(status_code=429, detail={"error": "Too many attempts"})
+                seed = seeds.get(lookup)
+                if seed is None:
+                    if lookup[0] == "seed":
+                        seed = TotpSeed.from_hex(lookup[1])
+                    else:
+                        seed = await resolve_seed(lookup[1])
+                    seeds[lookup] = seed
+            except HTTPException as e:
+                results[i] = e.detail
+                outcomes[i] = audit_outcome(e)
+                continue
+            except Exception as e:
+                results[i] = {"error": str(e)}
+                continue
+            pairs.append((seed.key, code))
+            positions.append(i)
+            if lookup[0] == "user":
+                keys.append(replay_key(lookup[1]))
+                limit_keys.append(limiter_key(lookup[1], client_ip))
+            else:
+                keys.append(replay_key(seed=seed))
+                limit_keys.append(None)
+        
+        # One time step for the whole batch, even if chunks finish later
+        now = time.time()
+        if len(pairs) < BATCH_POOL_THRESHOLD:
+            steps = match_totp_batch(pairs, valid_window=1, for_time=now)
+        else:
+            loop = asyncio.get_running_loop()
+            pool = get_batch_pool()
+            chunk = -(-len(pairs) // BATCH_POOL_WORKERS)
+            chunks = await asyncio.gather(*(
+                loop.run_in_executor(pool, match_totp_batch, pairs[start:start + chunk], 1, now)
+                for start in range(0, len(pairs), chunk)
+            ))
+            steps = [step for part in chunks for step in part]
+        
+        for i, key, limit_key, step in zip(positions, keys, limit_keys, steps):
+            is_valid = accept_step(key, step, now)
+            if charge_ip:
+                ip_limiter.record(client_ip, is_valid)
+            if user_limiter is not None and limit_key is not None:
+                user_limiter.record(limit_key, is_valid)
+            results[i] = {"valid": is_valid}
+            outcomes[i] = "valid" if is_valid else "invalid"
+        
+        for user, outcome in zip(users, outcomes):
+            await audit("verify-2fa/batch", user, client_ip, outcome)
+        return {"results": results}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={"error": str(e)})
+
+@app.get("/audit/stats")
+async def audit_stats():
+    """GET /audit/stats - Audit queue depth and written/dropped/delayed record counts"""
+    if audit_log is None:
+        return {"enabled": False}
+    return {"enabled": True, **audit_log.stats()}
+
+@app.get("/verify-2fa/limits")
+async def verify_limits():
+    """GET /verify-2fa/limits - Attempt limiter counters (requests shed, lockouts)"""
+    if user_limiter is None:
+        return {"enabled": False}
+    return {"enabled": True, "user": user_limiter.stats(), "ip": ip_limiter.stats()}
+
+@app.get("/verify-2fa/drift")
+async def verify_drift():
+    """GET /verify-2fa/drift - Learned clock offsets and how often they hit first try"""
+    if drift_table is None:
+        return {"enabled": False}
+    return {"enabled": True, "max_drift": drift_table.max_drift, **drift_table.stats()}
+
+def require_user_id(value):
+    user_id = parse_user_id(value)
+    if user_id is None:
+        raise HTTPException(status_code=400, detail={"error": "Missing user_id"})
+    return user_id
+
+@app.get("/hotp/generate")
+async def generate_hotp(user_id: Optional[int] = None):
+    """GET /hotp/generate?user_id= - Code for the user's next expected HOTP counter (doesn't advance it)"""
+    try:
+        user_id = require_user_id(user_id)
+        seed = await resolve_seed(user_id)
+        counter = get_hotp_verifier().counters.get(user_id)
+        return {"code": generate_hotp_code(seed, counter), "counter": counter}
+        
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail={"error": str(e)})
 
+@app.post("/hotp/verify")
+async def verify_hotp(payload: dict, request: Request):
+    """POST /hotp/verify - Verify a HOTP code ({"user_id": ..., "code": ...}) and advance the counter"""
+    client_ip = request.client.host if request.client else "unknown"
+    outcome = "error"
+    user_id = None
+    try:
+        code = payload.get("code")
+        if not code:
+            raise HTTPException(status_code=400, detail={"error": "Missing code"})
+        
+        user_id = require_user_id(payload.get("user_id"))
+        user_key = f"hotp-{user_id}"
+        
+        if user_limiter is not None:
+            if not (ip_limiter.allow(client_ip) and user_limiter.allow(user_key)):
+                raise HTTPException(status_code=429, detail={"error": "Too many attempts"})
+        
+        seed = await resolve_seed(user_id)
+        counter = get_hotp_verifier().verify(user_id, seed, code)
+        is_valid = counter is not None
+        outcome = "valid" if is_valid else "invalid"
+        
+        if user_limiter is not None:
+            user_limiter.record(user_key, is_valid)
+            ip_limiter.record(client_ip, is_valid)
+        return {"valid": is_valid}
+        
+    except HTTPException as e:
+        outcome = audit_outcome(e)
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={"error": str(e)})
+    finally:
+        await audit("hotp-verify", user_id, client_ip, outcome)
+
+@app.get("/hotp/stats")
+async def hotp_stats():
+    """GET /hotp/stats - Look-ahead resyncs, CAS races and unflushed counter updates"""
+    if hotp_verifier is None:
+        return {"enabled": False}
+    return {"enabled": True, **hotp_verifier.stats()}
+
+@app.get("/seeds/cache")
+async def seed_cache_stats():
+    """GET /seeds/cache - Decrypted-seed cache size, hit ratio and evictions"""
+    if seed_repository is None:
+        return {"enabled": False}
+    return {"enabled": True, **seed_repository.stats()}
+
+@app.post("/seeds/cache/invalidate")
+async def seed_cache_invalidate(request: Request, payload: Optional[dict] = None):
+    """POST /seeds/cache/invalidate - Drop one user's cached seed ({"user_id": ...}) or all of them, in every worker"""
+    require_admin(request)
+    if seed_repository is None:
+        raise HTTPException(status_code=404, detail={"error": "Encrypted seed repository not enabled"})
+    user_id = parse_user_id((payload or {}).get("user_id"))
+    seed_repository.invalidate(user_id)
+    return {"status": "ok"}
+
+@app.get("/codes/history")
+async def codes_history(start: Optional[int] = Query(None, alias="from"),
+                        end: Optional[int] = Query(None, alias="to"),
+                        limit: int = Query(1000, ge=1, le=CODE_HISTORY_MAX)):
+    """GET /codes/history?from=&to= - Logged codes between two unix timestamps"""
+    try:
+        # Binary search and scan over the mapped log files: keep it off the event loop
+        entries = await asyncio.to_thread(code_log.range, start, end, limit=limit)
+        return {"entries": [{"timestamp": ts, "code": code} for ts, code in entries]}
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail={"error": str(e)})
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    uvicorn.run("main:app", host="0.0.0.0", port=8080, workers=WEB_CONCURRENCY)
@@ -0,0 +1,184 @@
+import time
+from bisect import bisect_left
+from typing import Dict, Sequence, Tuple
+
+# Latency buckets in seconds, from HMAC-scale microseconds up to RSA/disk-scale seconds
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "total", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One slot per bucket plus +Inf, allocated once
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        """
+        Child for one label combination.
+
+        Look children up once and keep them (e.g. at module level) so the
+        hot path is a bare attribute increment: no locks, no dict lookups.
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in sorted(self._children.items()):
+            lines.extend(self._render_child(key, child))
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonic counter. Increments are plain int adds under the GIL."""
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _render_child(self, key, child):
+        return [f"{self.name}{self._label_text(key)} {child.value}"]
+
+
+class Histogram(_Metric):
+    """Histogram with fixed, preallocated buckets (seconds)."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, key, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), list(child.counts)):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{self.name}_bucket{self._label_text(key, [('le', le)])} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(key)} {child.total}")
+        lines.append(f"{self.name}_count{self._label_text(key)} {cumulative}")
+        return lines
+
+
+class Gauge(Counter):
+    """Value sampled at scrape time from a callable."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), callback=None):
+        super().__init__(name, help, labelnames)
+        self.callback = callback
+
+    def render(self):
+        if self.callback is not None:
+            for labels, value in self.callback():
+                self.labels(*labels).value = value
+        return super().render()
+
+
+REGISTRY = []
+
+
+def render() -> str:
+    """All registered metrics in Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = Histogram("twofa_request_seconds", "HTTP request latency by endpoint",
+                            ("endpoint",))
+REQUEST_ERRORS = Counter("twofa_request_errors_total", "HTTP responses with status >= 400",
+                         ("endpoint", "status"))
+STAGE_SECONDS = Histogram("twofa_stage_seconds", "Time spent in crypto and I/O stages",
+                          ("stage",))
+CACHE_EVENTS = Counter("twofa_cache_events_total", "Cache hits and misses",
+                       ("cache", "result"))
+ERRORS = Counter("twofa_errors_total", "Errors raised by crypto and TOTP helpers",
+                 ("operation",))
+
+perf_counter = time.perf_counter
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing the endpoints in `endpoints`.
+
+    Plain ASGI rather than BaseHTTPMiddleware, so the only per-request cost
+    is two perf_counter() calls and a histogram observe.
+    """
+
+    def __init__(self, app, endpoints: Sequence[str]):
+        self.app = app
+        self.timers = {path: REQUEST_SECONDS.labels(path) for path in endpoints}
+
+    async def __call__(self, scope, receive, send):
+        timer = self.timers.get(scope.get("path")) if scope["type"] == "http" else None
+        if timer is None:
+            return await self.app(scope, receive, send)
+
+        path = scope["path"]
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            timer.observe(perf_counter() - started)
+            if status >= 400:
+                REQUEST_ERRORS.labels(path, status).inc()
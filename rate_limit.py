@@ -0,0 +1,149 @@
+import threading
+import time
+import zlib
+from typing import Hashable, Iterable, List, Optional, Tuple
+
+
+class _Entry:
+    __slots__ = ("tokens", "updated", "failures", "locked_until")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        self.failures = 0
+        self.locked_until = 0.0
+
+
+class _Shard:
+    __slots__ = ("lock", "entries", "last_sweep")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.last_sweep = 0.0
+
+
+class AttemptLimiter:
+    """
+    Token-bucket plus lockout limiter for verification attempts.
+
+    Each key (a user, a client IP, ...) gets a bucket of `burst` tokens that
+    refills at `rate` tokens per second; an attempt spends one. After
+    `max_failures` consecutive failed verifications the key is locked out for
+    `lockout_seconds`. Keys are spread over `shards` independently locked
+    dicts so concurrent requests rarely contend, and idle entries are
+    expired lazily when their shard is touched.
+
+    The shed counters are plain ints bumped without a global lock, so they
+    are approximate under heavy concurrency.
+    """
+
+    def __init__(self, rate: float = 0.2, burst: int = 5, max_failures: int = 5,
+                 lockout_seconds: float = 300.0, shards: int = 64, idle_seconds: float = 900.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_failures = max_failures
+        self.lockout_seconds = lockout_seconds
+        self.idle_seconds = idle_seconds
+        self._shards = [_Shard() for _ in range(shards)]
+        self.allowed = 0
+        self.rejected_rate = 0
+        self.rejected_lockout = 0
+        self.lockouts = 0
+
+    def _shard(self, key: Hashable) -> _Shard:
+        if isinstance(key, str):
+            index = zlib.crc32(key.encode())
+        else:
+            index = hash(key)
+        return self._shards[index % len(self._shards)]
+
+    def _sweep(self, shard: _Shard, now: float):
+        # Caller holds shard.lock
+        if now - shard.last_sweep < self.idle_seconds:
+            return
+        shard.last_sweep = now
+        expired = [key for key, entry in shard.entries.items()
+                   if now - entry.updated > self.idle_seconds and entry.locked_until <= now]
+        for key in expired:
+            del shard.entries[key]
+
+    def allow(self, key: Hashable, now: Optional[float] = None) -> bool:
+        """Spend a token for `key`; False if it is rate limited or locked out."""
+        if now is None:
+            now = time.monotonic()
+        shard = self._shard(key)
+        with shard.lock:
+            self._sweep(shard, now)
+            entry = shard.entries.get(key)
+            if entry is None:
+                entry = shard.entries[key] = _Entry(self.burst, now)
+            if entry.locked_until > now:
+                self.rejected_lockout += 1
+                return False
+            entry.tokens = min(self.burst, entry.tokens + (now - entry.updated) * self.rate)
+            entry.updated = now
+            if entry.tokens < 1:
+                self.rejected_rate += 1
+                return False
+            entry.tokens -= 1
+        self.allowed += 1
+        return True
+
+    def record(self, key: Hashable, success: bool, now: Optional[float] = None):
+        """Report the outcome of an allowed attempt."""
+        if now is None:
+            now = time.monotonic()
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None:
+                return
+            if success:
+                entry.failures = 0
+                return
+            entry.failures += 1
+            if entry.failures >= self.max_failures:
+                entry.failures = 0
+                entry.locked_until = now + self.lockout_seconds
+                self.lockouts += 1
+
+    def export(self, now: Optional[float] = None) -> List[Tuple[Hashable, float, float, int, float]]:
+        """
+        (key, tokens, seconds idle, failures, lockout seconds left) per
+        entry. Times are relative, since the monotonic clock doesn't survive
+        a restart.
+        """
+        if now is None:
+            now = time.monotonic()
+        entries = []
+        for shard in self._shards:
+            with shard.lock:
+                for key, entry in shard.entries.items():
+                    entries.append((key, entry.tokens, now - entry.updated, entry.failures,
+                                    max(0.0, entry.locked_until - now)))
+        return entries
+
+    def restore(self, entries: Iterable[Tuple[Hashable, float, float, int, float]],
+                elapsed: float = 0.0, now: Optional[float] = None):
+        """Load entries saved by `export`, `elapsed` seconds ago."""
+        if now is None:
+            now = time.monotonic()
+        for key, tokens, idle, failures, lockout in entries:
+            if idle + elapsed > self.idle_seconds and lockout <= elapsed:
+                continue
+            entry = _Entry(min(self.burst, tokens), now - idle - elapsed)
+            entry.failures = failures
+            entry.locked_until = now + lockout - elapsed if lockout > elapsed else 0.0
+            shard = self._shard(key)
+            with shard.lock:
+                shard.entries[key] = entry
+
+    def stats(self) -> dict:
+        return {
+            "allowed": self.allowed,
+            "rejected_rate": self.rejected_rate,
+            "rejected_lockout": self.rejected_lockout,
+            "lockouts": self.lockouts,
+            "tracked_keys": sum(len(shard.entries) for shard in self._shards),
+        }
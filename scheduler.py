@@ -0,0 +1,43 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+from totp_utils import TOTP_PERIOD
+
+# Run this long after a boundary so the job sees the new TOTP period
+BOUNDARY_SLACK = 0.05
+
+
+def seconds_until_next_run(interval, now=None):
+    """
+    Seconds until the next multiple of `interval` on the unix clock.
+
+    With an interval that is a multiple of TOTP_PERIOD (the default 60s
+    included) every run lands just after a TOTP period boundary.
+    """
+    if now is None:
+        now = time.time()
+    return interval - (now % interval) + BOUNDARY_SLACK
+
+
+async def run_periodic(job, interval=60, align=True):
+    """
+    Run the blocking callable `job` every `interval` seconds until cancelled.
+
+    The job runs in the default thread pool so it never stalls the event
+    loop, and a failing run is logged without stopping the schedule. With
+    align=False runs are simply `interval` apart instead of landing on
+    multiples of it (for housekeeping unrelated to TOTP periods).
+    """
+    if interval <= 0:
+        raise ValueError("Scheduler interval must be positive")
+    if align and interval % TOTP_PERIOD:
+        print(f"[{datetime.now(timezone.utc)}] WARNING: scheduler interval {interval}s "
+              f"is not a multiple of the {TOTP_PERIOD}s TOTP period")
+
+    while True:
+        await asyncio.sleep(seconds_until_next_run(interval) if align else interval)
+        try:
+            await asyncio.to_thread(job)
+        except Exception as e:
+            print(f"[{datetime.now(timezone.utc)}] ERROR: scheduled job failed: {e}")
@@ -1,30 +1,40 @@
 #!/usr/bin/env python3
-import os, sys
+import os, sys, time
 from datetime import datetime, timezone
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from crypto_utils import load_private_key, decrypt_seed
-from totp_utils import generate_totp_code
+from code_log import CodeLog
+from crypto_utils import get_private_key, decrypt_seed
+from totp_utils import TotpSeed, generate_totp_code
 
-def log_totp_code():
+def load_seed():
+    """Load the seed from /data/seed.txt, decrypting encrypted_seed.txt if needed"""
+    if not os.path.exists("encrypted_seed.txt"):
+        print(f"[{datetime.now(timezone.utc)}] ERROR: encrypted_seed.txt not found")
+        return None
+    with open("encrypted_seed.txt", "r") as f:
+        encrypted_seed_b64 = f.read().strip()
+    if os.path.exists("/data/seed.txt"):
+        with open("/data/seed.txt", "r") as f:
+            return TotpSeed.from_hex(f.read().strip())
+    private_key = get_private_key("student_private.pem")
+    return TotpSeed.from_hex(decrypt_seed(encrypted_seed_b64, private_key))
+
+def log_totp_code(seed=None, code_log=None):
+    """Append the current code to the code log (see code_log.py)
+
+    seed: an already-loaded TotpSeed (in-process scheduler); loaded from
+    disk when None (cron mode).
+    """
     try:
-        if not os.path.exists("encrypted_seed.txt"):
-            print(f"[{datetime.now(timezone.utc)}] ERROR: encrypted_seed.txt not found")
-            return
-        with open("encrypted_seed.txt", "r") as f:
-            encrypted_seed_b64 = f.read().strip()
-        hex_seed = None
-        if os.path.exists("/data/seed.txt"):
-            with open("/data/seed.txt", "r") as f:
-                hex_seed = f.read().strip()
-        else:
-            private_key = load_private_key("student_private.pem")
-            hex_seed = decrypt_seed(encrypted_seed_b64, private_key)
-        code, remaining = generate_totp_code(hex_seed)
-        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        if seed is None:
+            seed = load_seed()
+            if seed is None:
+                return
+        now = int(time.time())
+        code, remaining = generate_totp_code(seed, for_time=now)
+        (code_log or CodeLog()).append(now, code)
+        timestamp = datetime.fromtimestamp(now, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
         log_entry = f"{timestamp} - 2FA Code: {code}"
-        os.makedirs("/cron", exist_ok=True)
-        with open("/cron/last_code.txt", "a") as f:
-            f.write(log_entry + "\n")
         print(log_entry)
     except Exception as e:
         print(f"[{datetime.now(timezone.utc)}] ERROR: {e}")
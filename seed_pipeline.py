@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Bulk seed decryption pipeline
+
+Reads encrypted seeds from a JSONL file, one {"user_id": ..., "encrypted_seed": "<base64>"}
+object per line, decrypts them across a process pool and writes the hex
+seeds (or seed-store records) in input order.
+
+Usage:
+    python seed_pipeline.py encrypted.jsonl --out seeds.txt
+    python seed_pipeline.py encrypted.jsonl --store /data/seeds.bin --workers 8
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from crypto_utils import decrypt_seed, get_private_key
+
+# Private key of the current worker process, loaded once by _init_worker
+_worker_key = None
+
+
+def _init_worker(key_path):
+    global _worker_key
+    _worker_key = get_private_key(key_path)
+
+
+def _decrypt_chunk(lines):
+    """
+    Decrypt a chunk of JSONL lines in a worker.
+
+    Returns:
+        List of (user_id, hex_seed, error) tuples; hex_seed is None on error.
+    """
+    results = []
+    for line in lines:
+        user_id = None
+        try:
+            record = json.loads(line)
+            user_id = record.get("user_id")
+            hex_seed = decrypt_seed(record["encrypted_seed"], _worker_key)
+            results.append((user_id, hex_seed, None))
+        except Exception as e:
+            results.append((user_id, None, str(e)))
+    return results
+
+
+def _chunks(lines, size):
+    lines = (line for line in lines if line.strip())
+    while True:
+        chunk = list(islice(lines, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def decrypt_jsonl(lines, key_path, write, workers=None, chunk_size=32,
+                  in_flight=4, progress=None, progress_interval=2.0):
+    """
+    Decrypt JSONL records across a process pool, preserving input order.
+
+    At most `workers * in_flight` chunks are queued at once, so memory stays
+    bounded however large the input is.
+
+    Args:
+        lines: Iterable of JSONL lines.
+        key_path: Private key PEM; each worker loads it once.
+        write: Called as write(line_number, user_id, hex_seed, error) per record, in order.
+        workers: Process count (default: CPU count).
+        chunk_size: Records per task sent to a worker.
+        in_flight: Queued chunks per worker.
+        progress: Called as progress(done, failed, elapsed) every progress_interval seconds.
+
+    Returns:
+        Tuple of (records processed, records failed).
+    """
+    workers = workers or os.cpu_count() or 1
+    done = failed = 0
+    started = last_report = time.monotonic()
+    pending = deque()
+
+    def drain_one():
+        nonlocal done, failed, last_report
+        for user_id, hex_seed, error in pending.popleft().result():
+            done += 1
+            if error is not None:
+                failed += 1
+            write(done, user_id, hex_seed, error)
+        now = time.monotonic()
+        if progress is not None and now - last_report >= progress_interval:
+            progress(done, failed, now - started)
+            last_report = now
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(key_path,)) as pool:
+        for chunk in _chunks(lines, chunk_size):
+            pending.append(pool.submit(_decrypt_chunk, chunk))
+            if len(pending) >= workers * in_flight:
+                drain_one()
+        while pending:
+            drain_one()
+
+    if progress is not None:
+        progress(done, failed, time.monotonic() - started)
+    return done, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decrypt encrypted seeds from a JSONL file in parallel.")
+    parser.add_argument("input", help="JSONL file of {user_id, encrypted_seed} records ('-' for stdin)")
+    parser.add_argument("--key", default="student_private.pem", help="Private key PEM")
+    parser.add_argument("--out", default="-", help="Write 'user_id hex_seed' lines here (default: stdout)")
+    parser.add_argument("--store", help="Write into this seed store instead of --out")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--chunk-size", type=int, default=32, help="Records per worker task")
+    args = parser.parse_args(argv)
+
+    source = sys.stdin if args.input == "-" else open(args.input, "r")
+
+    rejected = 0
+    if args.store:
+        from seed_store import SeedStore, parse_user_id
+        store = SeedStore(args.store, writable=True)
+        out = None
+
+        def write(line_no, user_id, hex_seed, error):
+            nonlocal rejected
+            if error is not None:
+                print(f"❌ Record {line_no}: {error}", file=sys.stderr)
+                return
+            try:
+                store_id = parse_user_id(user_id)
+                if store_id is None:
+                    raise ValueError("Missing user ID")
+                store.put(store_id, hex_seed)
+            except ValueError as e:
+                # A bad row is skipped; the rest of the import carries on
+                rejected += 1
+                print(f"❌ Record {line_no}: {e}", file=sys.stderr)
+    else:
+        store = None
+        out = sys.stdout if args.out == "-" else open(args.out, "w")
+
+        def write(line_no, user_id, hex_seed, error):
+            if error is not None:
+                print(f"❌ Record {line_no}: {error}", file=sys.stderr)
+            elif user_id is None:
+                out.write(hex_seed + "\n")
+            else:
+                out.write(f"{user_id} {hex_seed}\n")
+
+    def progress(done, failed, elapsed):
+        rate = done / elapsed if elapsed > 0 else 0.0
+        print(f"  {done} records ({failed} failed) in {elapsed:.1f}s - {rate:.0f} seeds/s",
+              file=sys.stderr)
+
+    try:
+        done, failed = decrypt_jsonl(source, args.key, write, workers=args.workers,
+                                     chunk_size=args.chunk_size, progress=progress)
+    finally:
+        if store is not None:
+            store.close()
+        if out is not None and out is not sys.stdout:
+            out.close()
+        if source is not sys.stdin:
+            source.close()
+
+    print(f"✅ Decrypted {done - failed}/{done} seeds", file=sys.stderr)
+    if rejected:
+        print(f"❌ Rejected {rejected} records with an invalid user_id", file=sys.stderr)
+    return 1 if failed or rejected else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
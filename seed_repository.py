@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Per-user seeds kept RSA-encrypted at rest
+
+Each user's seed is stored the way encrypted_seed.txt holds the service
+seed: a base64 RSA-OAEP ciphertext, one file per user. Seeds are decrypted
+on demand and the plaintext handles kept in a size-bounded LRU with TTL
+expiry, so steady-state lookups cost a dict hit instead of an RSA decrypt.
+
+Usage:
+    # Encrypt "user_id hex_seed" lines into a repository directory
+    python seed_repository.py /data/seeds-enc student_public.pem < seeds.txt
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Hashable, List, Optional
+
+from crypto_utils import decrypt_seed, encrypt_seed, get_private_key, load_public_key
+from metrics import CACHE_EVENTS
+from totp_utils import TotpSeed
+
+_cache_hits = CACHE_EVENTS.labels("seed_repository", "hit")
+_cache_misses = CACHE_EVENTS.labels("seed_repository", "miss")
+_cache_evictions = CACHE_EVENTS.labels("seed_repository", "eviction")
+_cache_expirations = CACHE_EVENTS.labels("seed_repository", "expired")
+_cache_coalesced = CACHE_EVENTS.labels("seed_repository", "coalesced")
+
+
+class SeedCache:
+    """
+    LRU of decrypted seed handles with a per-entry time to live.
+
+    Not thread-safe on its own; EncryptedSeedRepository calls it under its
+    lock.
+    """
+
+    def __init__(self, capacity: int = 10000, ttl: float = 300.0, clock=time.monotonic):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (expires_at, value), least recently used first
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                _cache_hits.inc()
+                return entry[1]
+            del self._entries[key]
+            self.expirations += 1
+            _cache_expirations.inc()
+        self.misses += 1
+        _cache_misses.inc()
+        return None
+
+    def put(self, key: Hashable, value):
+        self._entries[key] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+            _cache_evictions.inc()
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """Drop `key`, or every entry if None."""
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "capacity": self.capacity,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class InvalidationBus:
+    """
+    Cache invalidations broadcast between workers through a small mmap'd file.
+
+    The file holds a sequence number and a ring of the last RING invalidated
+    user IDs (-1 meaning "everyone"). `publish` appends under an flock;
+    `poll` is lock-free and returns what other workers (and this one)
+    published since the last poll. A reader that fell RING or more entries
+    behind gets a single "everyone" instead.
+    """
+
+    RING = 256
+    _SEQ = struct.Struct("<Q")
+    _SLOT = struct.Struct("<q")
+    SIZE = _SEQ.size + RING * _SLOT.size
+
+    def __init__(self, path: str):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._file = os.fdopen(fd, "r+b")
+        if os.fstat(fd).st_size < self.SIZE:
+            os.ftruncate(fd, self.SIZE)
+        self._map = mmap.mmap(fd, self.SIZE)
+        self._seen = self._sequence()
+
+    def _sequence(self) -> int:
+        return self._SEQ.unpack_from(self._map, 0)[0]
+
+    def publish(self, user_id: Optional[int] = None):
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            sequence = self._sequence()
+            offset = self._SEQ.size + (sequence % self.RING) * self._SLOT.size
+            self._SLOT.pack_into(self._map, offset, -1 if user_id is None else user_id)
+            self._SEQ.pack_into(self._map, 0, sequence + 1)
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def poll(self) -> List[Optional[int]]:
+        """User IDs invalidated since the last poll, None standing for everyone."""
+        sequence = self._sequence()
+        if sequence == self._seen:
+            return []
+        if sequence - self._seen >= self.RING:
+            self._seen = sequence
+            return [None]
+        user_ids = []
+        for n in range(self._seen, sequence):
+            user_id = self._SLOT.unpack_from(self._map, self._SEQ.size + (n % self.RING) * self._SLOT.size)[0]
+            user_ids.append(None if user_id < 0 else user_id)
+        # Too far behind, or a writer may have reused a slot while we read it
+        if self._sequence() - self._seen >= self.RING:
+            user_ids = [None]
+        self._seen = sequence
+        return user_ids
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class EncryptedSeedRepository:
+    """
+    Directory of `<user_id>.txt` files, each a base64 RSA-OAEP ciphertext.
+
+    `get_future` is single-flight: concurrent misses for the same user
+    share one decrypt. Decrypts run on `executor` when one is given (e.g.
+    the service's crypto pool), otherwise in the calling thread. With a
+    `bus`, invalidations reach the caches of every worker sharing it.
+    """
+
+    def __init__(self, directory: str, private_key_path: str, capacity: int = 10000,
+                 ttl: float = 300.0, executor=None, clock=time.monotonic, bus: Optional[InvalidationBus] = None):
+        self.directory = directory
+        self.private_key_path = private_key_path
+        self.executor = executor
+        self.bus = bus
+        self.cache = SeedCache(capacity, ttl, clock)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        # Bumped by every invalidation, so a decrypt that started before one
+        # doesn't put a stale seed back in the cache
+        self._generation = 0
+        self.decrypts = 0
+        self.coalesced = 0
+
+    def path_for(self, user_id: int) -> str:
+        if not isinstance(user_id, int) or user_id < 0:
+            raise ValueError(f"Invalid user ID: {user_id}")
+        return os.path.join(self.directory, f"{user_id}.txt")
+
+    def put_encrypted(self, user_id: int, encrypted_seed_b64: str):
+        """Store (or replace) a user's encrypted seed and drop its cached plaintext."""
+        path = self.path_for(user_id)
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(encrypted_seed_b64.strip() + "\n")
+        os.replace(tmp, path)
+        self.invalidate(user_id)
+
+    def delete(self, user_id: int):
+        try:
+            os.unlink(self.path_for(user_id))
+        except FileNotFoundError:
+            pass
+        self.invalidate(user_id)
+
+    def load(self, user_id: int) -> Optional[TotpSeed]:
+        """Read and decrypt a user's seed, bypassing the cache (None if not enrolled)."""
+        try:
+            with open(self.path_for(user_id), "r") as f:
+                encrypted_seed_b64 = f.read().strip()
+        except FileNotFoundError:
+            return None
+        self.decrypts += 1
+        hex_seed = decrypt_seed(encrypted_seed_b64, get_private_key(self.private_key_path))
+        return TotpSeed.from_hex(hex_seed)
+
+    def get_future(self, user_id: int) -> Future:
+        """
+        Future resolving to the user's seed (None if not enrolled).
+
+        Already done on a cache hit; otherwise the in-flight decrypt for this
+        user, started here if there isn't one yet.
+        """
+        with self._lock:
+            if self.bus is not None:
+                for invalidated in self.bus.poll():
+                    self._drop(invalidated)
+            seed = self.cache.get(user_id)
+            if seed is not None:
+                future = Future()
+                future.set_result(seed)
+                return future
+            future = self._inflight.get(user_id)
+            if future is not None:
+                self.coalesced += 1
+                _cache_coalesced.inc()
+                return future
+            future = self._inflight[user_id] = Future()
+            generation = self._generation
+
+        if self.executor is not None:
+            self.executor.submit(self._fill, user_id, future, generation)
+        else:
+            self._fill(user_id, future, generation)
+        return future
+
+    def get(self, user_id: int) -> Optional[TotpSeed]:
+        """Blocking lookup through the cache."""
+        return self.get_future(user_id).result()
+
+    def _fill(self, user_id, future, generation):
+        try:
+            seed = self.load(user_id)
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(user_id, None)
+            future.set_exception(e)
+            return
+        with self._lock:
+            if seed is not None and generation == self._generation:
+                self.cache.put(user_id, seed)
+            self._inflight.pop(user_id, None)
+        future.set_result(seed)
+
+    def _drop(self, user_id: Optional[int]):
+        self._generation += 1
+        self.cache.invalidate(user_id)
+
+    def invalidate(self, user_id: Optional[int] = None):
+        """Forget the cached plaintext for `user_id` (every user if None), in every worker on the bus."""
+        with self._lock:
+            self._drop(user_id)
+        if self.bus is not None:
+            self.bus.publish(user_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = self.cache.stats()
+            stats["in_flight"] = len(self._inflight)
+        stats["decrypts"] = self.decrypts
+        stats["coalesced"] = self.coalesced
+        return stats
+
+
+def import_seeds(repository: EncryptedSeedRepository, public_key, lines) -> int:
+    """
+    Encrypt "<user_id> <hex_seed>" lines into `repository`.
+
+    Returns:
+        Number of seeds written.
+    """
+    count = 0
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        user_id, hex_seed = line.split()
+        TotpSeed.from_hex(hex_seed)
+        repository.put_encrypted(int(user_id), encrypt_seed(hex_seed, public_key))
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    # Usage: python seed_repository.py DIRECTORY PUBLIC_KEY < "user_id hex_seed" lines
+    if len(sys.argv) != 3:
+        print("Usage: python seed_repository.py DIRECTORY PUBLIC_KEY < seeds.txt", file=sys.stderr)
+        sys.exit(2)
+
+    repository = EncryptedSeedRepository(sys.argv[1], private_key_path=None)
+    imported = import_seeds(repository, load_public_key(sys.argv[2]), sys.stdin)
+    print(f"✅ Encrypted {imported} seeds into {sys.argv[1]}")
@@ -0,0 +1,212 @@
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+from typing import Iterator, Optional
+
+from totp_utils import SeedLike, TotpSeed, as_seed
+
+MAGIC = b"2FASEEDS"
+VERSION = 1
+RECORD_SIZE = 32
+MAX_USER_ID = 2**32 - 1
+
+# magic, version, record size
+_HEADER = struct.Struct("<8sII")
+HEADER_SIZE = _HEADER.size
+
+# Grow the file in steps of this many records to avoid remapping per insert
+GROW_RECORDS = 32768
+
+_EMPTY = bytes(RECORD_SIZE)
+# user_ids() compares this many bytes of records at a time against zeros
+_SCAN_BYTES = 256 * RECORD_SIZE
+_EMPTY_SCAN = bytes(_SCAN_BYTES)
+
+
+def parse_user_id(value) -> Optional[int]:
+    """
+    User ID from untrusted input (JSON field, query or text value), or None if absent.
+
+    Only integers and ASCII digit strings are accepted: int() would also
+    truncate 5.7 to 5 and take True as 1.
+
+    Raises:
+        ValueError: If it is anything else, or outside 0..MAX_USER_ID.
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool) or not (isinstance(value, int)
+                                       or (isinstance(value, str) and value.isascii() and value.isdigit())):
+        raise ValueError(f"Invalid user ID: {value!r}")
+    user_id = int(value)
+    if not 0 <= user_id <= MAX_USER_ID:
+        raise ValueError(f"User ID out of range: {user_id}")
+    return user_id
+
+
+class SeedStore:
+    """
+    Fixed-width table of raw 32-byte seeds indexed by integer user ID.
+
+    Record `user_id` lives at HEADER_SIZE + user_id * 32, so a lookup is a
+    single slice of the memory map. The file is mapped shared, so every
+    worker that opens it reads the same page-cache pages. An all-zero
+    record means "not enrolled".
+
+    Only one process should open the store writable at a time; readers pick
+    up growth of the file on their next miss.
+    """
+
+    def __init__(self, path: str, writable: bool = False, capacity: int = 0):
+        self.path = path
+        self.writable = writable
+        self._lock = threading.Lock()
+
+        if writable and not os.path.exists(path):
+            self._create(path, capacity)
+
+        self._file = open(path, "r+b" if writable else "rb")
+        self._map = None
+        self._remap()
+
+        magic, version, record_size = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+            self.close()
+            raise ValueError(f"{path} is not a seed store")
+
+    @staticmethod
+    def _create(path: str, capacity: int):
+        """
+        Create an empty store with room for `capacity` records.
+
+        The file is built under a fresh temporary name (mkstemp: O_EXCL, mode
+        0600, since it holds seeds) and linked into place, so processes
+        racing to create it never see a half-written header and never
+        truncate a store another process already filled.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, RECORD_SIZE))
+            f.truncate(HEADER_SIZE + capacity * RECORD_SIZE)
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+        access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+        self._map = mmap.mmap(self._file.fileno(), 0, access=access)
+
+    @property
+    def capacity(self) -> int:
+        """Number of user IDs the file currently has room for."""
+        return (len(self._map) - HEADER_SIZE) // RECORD_SIZE
+
+    def _offset(self, user_id: int) -> int:
+        if not 0 <= user_id <= MAX_USER_ID:
+            raise ValueError(f"Invalid user ID: {user_id}")
+        return HEADER_SIZE + user_id * RECORD_SIZE
+
+    def get_key(self, user_id: int) -> Optional[bytes]:
+        """Return the raw seed for `user_id`, or None if not enrolled."""
+        offset = self._offset(user_id)
+        if offset + RECORD_SIZE > len(self._map):
+            # Another process may have grown the file since we mapped it
+            with self._lock:
+                if os.fstat(self._file.fileno()).st_size > len(self._map):
+                    self._remap()
+            if offset + RECORD_SIZE > len(self._map):
+                return None
+        key = self._map[offset:offset + RECORD_SIZE]
+        return None if key == _EMPTY else key
+
+    def get(self, user_id: int) -> Optional[TotpSeed]:
+        """Return the seed handle for `user_id`, or None if not enrolled."""
+        key = self.get_key(user_id)
+        return None if key is None else TotpSeed(key)
+
+    def user_ids(self) -> Iterator[int]:
+        """Enrolled user IDs in ascending order, skipping empty pages of the map wholesale."""
+        end = len(self._map)
+        for start in range(HEADER_SIZE, end, _SCAN_BYTES):
+            stop = min(start + _SCAN_BYTES, end)
+            if self._map[start:stop] == _EMPTY_SCAN[:stop - start]:
+                continue
+            for offset in range(start, stop - RECORD_SIZE + 1, RECORD_SIZE):
+                if self._map[offset:offset + RECORD_SIZE] != _EMPTY:
+                    yield (offset - HEADER_SIZE) // RECORD_SIZE
+
+    def put(self, user_id: int, seed: SeedLike):
+        """Store (or replace) the seed for `user_id`."""
+        self._write(user_id, as_seed(seed).key)
+
+    def delete(self, user_id: int):
+        """Remove `user_id`'s seed; a no-op if it is not enrolled."""
+        if self._offset(user_id) + RECORD_SIZE <= len(self._map):
+            self._write(user_id, _EMPTY)
+
+    def _write(self, user_id: int, key: bytes):
+        if not self.writable:
+            raise ValueError("Seed store is opened read-only")
+        offset = self._offset(user_id)
+        with self._lock:
+            if offset + RECORD_SIZE > len(self._map):
+                records = (user_id // GROW_RECORDS + 1) * GROW_RECORDS
+                self._file.truncate(HEADER_SIZE + records * RECORD_SIZE)
+                self._remap()
+            self._map[offset:offset + RECORD_SIZE] = key
+
+    def flush(self):
+        if self.writable:
+            self._map.flush()
+
+    def close(self):
+        if self._map is not None:
+            self.flush()
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def import_seeds(store: SeedStore, lines) -> int:
+    """
+    Load "<user_id> <hex_seed>" lines into `store`.
+
+    Returns:
+        Number of seeds written.
+    """
+    count = 0
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        user_id, hex_seed = line.split()
+        store.put(int(user_id), hex_seed)
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    # Usage: python seed_store.py STORE_PATH < "user_id hex_seed" lines
+    if len(sys.argv) != 2:
+        print("Usage: python seed_store.py STORE_PATH < seeds.txt", file=sys.stderr)
+        sys.exit(2)
+
+    with SeedStore(sys.argv[1], writable=True) as store:
+        imported = import_seeds(store, sys.stdin)
+    print(f"✅ Imported {imported} seeds into {sys.argv[1]}")
@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+"""
+Consistent-hash sharding of users across local 2FA service instances
+
+Each shard is an ordinary `main.py` instance with its own seed store, HOTP
+counters and in-memory state; ShardRouter is an ASGI app in front of them
+that sends every request to the shard owning its user, over pooled
+keep-alive connections. Requests without a user go to the default shard.
+
+    # three shards on 127.0.0.1:8001-8003 and the router on :8080, seeds
+    # split out of an existing store
+    python shard_router.py local 3 --source /data/seeds.bin
+
+    # adding a shard online: start it, point the router at the new set,
+    # move the seeds, then drop the old ring
+    curl -X POST localhost:8080/router/shards -d '{"shards": {"s0": "127.0.0.1:8001", ...}}'
+    python shard_router.py rebalance --old s0,s1,s2 --new s0,s1,s2,s3 --store s0=... --store s3=...
+    curl -X POST localhost:8080/router/migration/finish
+
+The /router/ admin endpoints only answer loopback clients unless the router
+has an admin token (--admin-token or ROUTER_ADMIN_TOKEN), which callers
+then send as X-Admin-Token. Shard addresses must be on loopback or on the
+--allow-host list, so the admin API can't point traffic at arbitrary hosts.
+
+While a migration is open the router tries a user's new shard first and
+falls back to the old one on "Unknown user", so seeds can be moved while
+traffic flows. Drift offsets, attempt limiters and replay records are per
+instance and start fresh for moved users.
+"""
+
+import argparse
+import asyncio
+import bisect
+import hashlib
+import hmac
+import json
+import mmap
+import os
+import signal
+import urllib.parse
+from collections import Counter
+from typing import Dict, Iterable, List, Mapping, Optional
+
+from hotp_store import CounterStore
+from http_client import ConnectionPool
+from local_instance import spawn_instance
+from seed_store import MAX_USER_ID, RECORD_SIZE, SeedStore
+
+DEFAULT_VNODES = 128
+# Users are placed on the ring in blocks of consecutive IDs, one page of
+# seed store records per block, so a shard's (sparse) store file only has
+# its own pages in memory rather than a slice of every page
+BLOCK_USERS = mmap.PAGESIZE // RECORD_SIZE
+
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "10000"))
+
+# Token the /router/ admin endpoints require in X-Admin-Token; without one
+# they only answer loopback clients
+ROUTER_ADMIN_TOKEN = os.environ.get("ROUTER_ADMIN_TOKEN", "")
+
+# Shard hosts accepted by default
+LOOPBACK_HOSTS = frozenset(("127.0.0.1", "::1", "localhost"))
+
+# End-to-end request headers passed on to the shards (X-Forwarded-For is set by the router)
+_FORWARDED_HEADERS = frozenset((b"x-admin-token",))
+
+# Response headers the router's own server sets
+_HOP_BY_HOP = frozenset((b"connection", b"keep-alive", b"transfer-encoding", b"content-length", b"date", b"server"))
+
+
+def _point(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent-hash ring mapping user IDs to node names.
+
+    Each node gets `vnodes` points on a 64-bit ring; a user's block of
+    `block` IDs belongs to the first point at or after its hash. Adding or
+    removing a node only moves the blocks between its points and their
+    neighbours, about 1/N of the users.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = DEFAULT_VNODES, block: int = BLOCK_USERS):
+        self.vnodes = vnodes
+        self.block = block
+        self._nodes = set(nodes)
+        self._points = []
+        self._owners = []
+        self._rebuild()
+
+    def _rebuild(self):
+        ring = sorted((_point(f"{node}#{i}".encode()), node) for node in self._nodes for i in range(self.vnodes))
+        self._points = [point for point, _ in ring]
+        self._owners = [node for _, node in ring]
+
+    @property
+    def nodes(self) -> List[str]:
+        return sorted(self._nodes)
+
+    def add(self, node: str):
+        if node not in self._nodes:
+            self._nodes.add(node)
+            self._rebuild()
+
+    def remove(self, node: str):
+        if node in self._nodes:
+            self._nodes.discard(node)
+            self._rebuild()
+
+    def node_for(self, user_id: int) -> str:
+        """Name of the node that owns `user_id`."""
+        if not self._points:
+            raise LookupError("Hash ring has no nodes")
+        i = bisect.bisect_left(self._points, _point(str(user_id // self.block).encode()))
+        return self._owners[i % len(self._owners)]
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+
+def split(source: SeedStore, ring: HashRing, stores: Mapping[str, SeedStore]) -> Counter:
+    """
+    Copy every seed in `source` into the store of its owning node.
+
+    Returns:
+        Seeds written per node.
+    """
+    written = Counter()
+    for user_id in source.user_ids():
+        node = ring.node_for(user_id)
+        stores[node].put(user_id, source.get(user_id))
+        written[node] += 1
+    for store in stores.values():
+        store.flush()
+    return written
+
+
+def rebalance(old: HashRing, new: HashRing, stores: Mapping[str, SeedStore],
+              counters: Optional[Mapping[str, CounterStore]] = None) -> Counter:
+    """
+    Move every seed whose owner differs between `old` and `new`.
+
+    All moved seeds are copied to their new shard and flushed before any is
+    deleted from the old one, so a user is always enrolled somewhere and a
+    router still falling back to `old` finds them either way. HOTP counters
+    in `counters` follow their user, at their value when the seed is copied.
+
+    Returns:
+        Users moved per (from, to) node pair.
+    """
+    moved = []
+    for node in old.nodes:
+        for user_id in stores[node].user_ids():
+            target = new.node_for(user_id)
+            if target == node:
+                continue
+            stores[target].put(user_id, stores[node].get(user_id))
+            if counters is not None:
+                counter = counters[node].get(user_id)
+                if counter:
+                    destination = counters[target]
+                    destination.compare_and_set(user_id, destination.get(user_id), counter)
+            moved.append((node, target, user_id))
+
+    for store in stores.values():
+        store.flush()
+    for store in (counters or {}).values():
+        store.flush()
+    for node, _, user_id in moved:
+        stores[node].delete(user_id)
+    for store in stores.values():
+        store.flush()
+    return Counter((node, target) for node, target, _ in moved)
+
+
+def _user_id(value) -> Optional[int]:
+    """User ID to route on, or None (default shard) if absent or malformed."""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        user_id = int(value)
+    except (TypeError, ValueError):
+        return None
+    return user_id if 0 <= user_id <= MAX_USER_ID else None
+
+
+def _json_response(status: int, payload) -> tuple:
+    return status, {"content-type": "application/json"}, json.dumps(payload).encode()
+
+
+class ShardRouter:
+    """
+    ASGI app forwarding requests to the shard that owns their user.
+
+    `shards` maps node names (what the ring hashes) to "host:port"
+    addresses, so a shard can move to another port without reshuffling
+    users. The user comes from ?user_id= or a JSON body's "user_id";
+    /verify-2fa/batch is split into one sub-batch per shard, sent
+    concurrently and merged back in input order.
+
+    The router adds X-Forwarded-For, which uvicorn trusts from 127.0.0.1
+    by default, so per-IP rate limits on the shards still see the client.
+    Admin endpoints live under /router/ and need `admin_token` (sent as
+    X-Admin-Token) or, without one, a loopback client. Shard addresses
+    must be on a host in `allowed_hosts`.
+    """
+
+    def __init__(self, shards: Mapping[str, str], vnodes: int = DEFAULT_VNODES, block: int = BLOCK_USERS,
+                 pool_size: int = 32, max_batch: int = BATCH_MAX_ITEMS, admin_token: str = "",
+                 allowed_hosts: Iterable[str] = LOOPBACK_HOSTS):
+        if not shards:
+            raise ValueError("At least one shard is required")
+        self.admin_token = admin_token
+        self.allowed_hosts = frozenset(allowed_hosts)
+        for address in shards.values():
+            self._check_address(address)
+        self.addresses = dict(shards)
+        self.ring = HashRing(shards, vnodes, block)
+        # Ring being migrated away from, consulted when the new owner doesn't know a user
+        self.previous = None
+        self.default = next(iter(shards))
+        self.pool_size = pool_size
+        self.max_batch = max_batch
+        self.pools = {}
+        self.forwarded = Counter()
+        self.fallbacks = 0
+
+    def _check_address(self, address: str):
+        """Raise ValueError unless `address` is host:port on an allowed host."""
+        host, _, port = address.rpartition(":")
+        if not (port.isascii() and port.isdigit() and 0 < int(port) < 65536):
+            raise ValueError(f"Invalid shard address: {address!r}")
+        if host.strip("[]") not in self.allowed_hosts:
+            raise ValueError(f"Shard host not allowed: {host!r}")
+
+    def update(self, shards: Mapping[str, str]):
+        """Route by a new shard set, keeping the current ring as fallback until finish_migration()."""
+        if not shards:
+            raise ValueError("At least one shard is required")
+        if self.previous is not None:
+            raise ValueError("A migration is already in progress")
+        for address in shards.values():
+            self._check_address(address)
+        self.previous = self.ring
+        self.ring = HashRing(shards, self.ring.vnodes, self.ring.block)
+        for node, address in shards.items():
+            if self.addresses.get(node, address) != address:
+                self._close_pool(node)
+            self.addresses[node] = address
+        if self.default not in self.ring:
+            self.default = next(iter(shards))
+
+    def finish_migration(self):
+        """Drop the fallback ring and forget shards that are no longer in the current one."""
+        self.previous = None
+        for node in list(self.addresses):
+            if node not in self.ring:
+                del self.addresses[node]
+                self._close_pool(node)
+
+    def _close_pool(self, node):
+        pool = self.pools.pop(node, None)
+        if pool is not None:
+            pool.close()
+
+    def status(self) -> dict:
+        return {
+            "shards": self.addresses,
+            "default": self.default,
+            "vnodes": self.ring.vnodes,
+            "block": self.ring.block,
+            "ring": self.ring.nodes,
+            "migrating_from": self.previous.nodes if self.previous is not None else None,
+            "forwarded": dict(self.forwarded),
+            "fallbacks": self.fallbacks,
+            "connections": {node: pool.opened for node, pool in self.pools.items()},
+        }
+
+    async def send_to(self, node, method, target, content=b"", headers=()):
+        """Forward one request to `node`; (status, headers, body), 502 if it is unreachable."""
+        pool = self.pools.get(node)
+        if pool is None:
+            host, _, port = self.addresses[node].rpartition(":")
+            pool = self.pools[node] = ConnectionPool(host.strip("[]"), int(port), self.pool_size)
+        self.forwarded[node] += 1
+        try:
+            return await pool.request(method, target, content=content, headers=headers)
+        except (OSError, asyncio.IncompleteReadError):
+            return _json_response(502, {"detail": {"error": f"Shard {node} unavailable"}})
+
+    async def _forward_user(self, user_id, method, target, content, headers):
+        node = self.default if user_id is None else self.ring.node_for(user_id)
+        response = await self.send_to(node, method, target, content, headers)
+        if (self.previous is not None and user_id is not None and response[0] == 404
+                and b"Unknown user" in response[2]):
+            old = self.previous.node_for(user_id)
+            if old != node and old in self.addresses:
+                self.fallbacks += 1
+                response = await self.send_to(old, method, target, content, headers)
+        return response
+
+    async def _scatter(self, groups, items, results, target, headers):
+        """Send each node its items as one sub-batch and fill `results`; the first failed response, if any."""
+        async def one(node, positions):
+            body = json.dumps({"items": [items[i] for i in positions]}).encode()
+            status, response_headers, content = await self.send_to(node, "POST", target, body, headers)
+            if status != 200:
+                return status, response_headers, content
+            for i, result in zip(positions, json.loads(content)["results"]):
+                results[i] = result
+
+        failures = [failure for failure in await asyncio.gather(*(one(node, positions)
+                                                                  for node, positions in groups.items()))
+                    if failure is not None]
+        return failures[0] if failures else None
+
+    async def _forward_batch(self, target, content, headers):
+        try:
+            items = json.loads(content).get("items")
+        except (ValueError, AttributeError):
+            items = None
+        if not isinstance(items, list) or len(items) > self.max_batch:
+            # Let a shard produce the usual error response
+            return await self.send_to(self.default, "POST", target, content, headers)
+
+        users = [_user_id(item.get("user_id")) if isinstance(item, dict) and item.get("seed") is None else None
+                 for item in items]
+        groups = {}
+        for i, user_id in enumerate(users):
+            node = self.default if user_id is None else self.ring.node_for(user_id)
+            groups.setdefault(node, []).append(i)
+        results = [None] * len(items)
+        failure = await self._scatter(groups, items, results, target, headers)
+
+        if failure is None and self.previous is not None:
+            retry = {}
+            for i, result in enumerate(results):
+                if users[i] is not None and result == {"error": "Unknown user"}:
+                    old = self.previous.node_for(users[i])
+                    if old != self.ring.node_for(users[i]) and old in self.addresses:
+                        retry.setdefault(old, []).append(i)
+            if retry:
+                self.fallbacks += sum(len(positions) for positions in retry.values())
+                failure = await self._scatter(retry, items, results, target, headers)
+        return failure or _json_response(200, {"results": results})
+
+    def _admin_allowed(self, scope) -> bool:
+        if self.admin_token:
+            token = next((value for name, value in scope.get("headers", ()) if name == b"x-admin-token"), b"")
+            return hmac.compare_digest(token, self.admin_token.encode())
+        client = scope.get("client")
+        return client is not None and client[0] in ("127.0.0.1", "::1")
+
+    async def _admin(self, method, path, content):
+        if method == "GET" and path == "/router/status":
+            return _json_response(200, self.status())
+        if method == "POST" and path == "/router/shards":
+            if self.previous is not None:
+                return _json_response(409, {"detail": {"error": "A migration is already in progress"}})
+            try:
+                shards = json.loads(content or b"{}").get("shards")
+                if not isinstance(shards, dict) or not all(isinstance(v, str) for v in shards.values()):
+                    raise ValueError("Missing shards")
+                self.update(shards)
+            except (ValueError, AttributeError) as e:
+                return _json_response(400, {"detail": {"error": str(e)}})
+            return _json_response(200, self.status())
+        if method == "POST" and path == "/router/migration/finish":
+            self.finish_migration()
+            return _json_response(200, self.status())
+        return _json_response(404, {"detail": "Not Found"})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    for node in list(self.pools):
+                        self._close_pool(node)
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        content = b"".join(chunks)
+
+        method, path = scope["method"], scope["path"]
+        query = scope.get("query_string", b"").decode("latin-1")
+        target = f"{path}?{query}" if query else path
+        client = scope.get("client")
+        headers = [("X-Forwarded-For", client[0])] if client else []
+        headers += [(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope.get("headers", ())
+                    if name.lower() in _FORWARDED_HEADERS]
+
+        if path.startswith("/router/"):
+            if self._admin_allowed(scope):
+                response = await self._admin(method, path, content)
+            else:
+                response = _json_response(403, {"detail": {"error": "Forbidden"}})
+        elif method == "POST" and path == "/verify-2fa/batch":
+            response = await self._forward_batch(target, content, headers)
+        else:
+            # Same source as the shard's handlers: the query string of GETs
+            # (decoded, last value wins, as FastAPI reads it), a POST's JSON body
+            user_id = None
+            if method == "GET":
+                values = urllib.parse.parse_qs(query, keep_blank_values=True).get("user_id")
+                if values:
+                    user_id = _user_id(values[-1])
+            elif content:
+                try:
+                    payload = json.loads(content)
+                except ValueError:
+                    payload = None
+                if isinstance(payload, dict):
+                    user_id = _user_id(payload.get("user_id"))
+            response = await self._forward_user(user_id, method, target, content, headers)
+
+        status, response_headers, body = response
+        raw_headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in response_headers.items()
+                       if name.encode("latin-1") not in _HOP_BY_HOP]
+        raw_headers.append((b"content-length", str(len(body)).encode()))
+        await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+        await send({"type": "http.response.body", "body": body})
+
+
+def _pairs(values, flag) -> Dict[str, str]:
+    pairs = {}
+    for value in values or ():
+        name, sep, rest = value.partition("=")
+        if not sep or not name or not rest:
+            raise SystemExit(f"{flag} expects NAME=VALUE, got {value!r}")
+        pairs[name] = rest
+    return pairs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Consistent-hash sharding of users across 2FA service instances")
+    parser.add_argument("--vnodes", type=int, default=DEFAULT_VNODES, help="Ring points per shard")
+    parser.add_argument("--block", type=int, default=BLOCK_USERS, help="Consecutive user IDs placed together")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="Run the router in front of running shards")
+    serve.add_argument("--shard", action="append", required=True, metavar="NAME=HOST:PORT")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8080)
+    serve.add_argument("--pool", type=int, default=32, help="Keep-alive connections per shard")
+
+    split_cmd = commands.add_parser("split", help="Partition a seed store into per-shard stores")
+    split_cmd.add_argument("source")
+    split_cmd.add_argument("--store", action="append", required=True, metavar="NAME=PATH")
+
+    move = commands.add_parser("rebalance", help="Move seeds after shards were added or removed")
+    move.add_argument("--old", required=True, help="Comma-separated shard names before the change")
+    move.add_argument("--new", required=True, help="Comma-separated shard names after the change")
+    move.add_argument("--store", action="append", required=True, metavar="NAME=PATH",
+                      help="Seed store of every shard in either set")
+    move.add_argument("--counters", action="append", metavar="NAME=PATH", help="HOTP counter stores to move too")
+
+    local = commands.add_parser("local", help="Spawn N shards on this machine and route to them")
+    local.add_argument("shards", type=int)
+    local.add_argument("--dir", default="/tmp/2fa-shards", help="Per-shard files go in DIR/<name>/")
+    local.add_argument("--source", help="Seed store to split across the shards first")
+    local.add_argument("--base-port", type=int, default=8001)
+    local.add_argument("--workers", type=int, default=1, help="uvicorn workers per shard")
+    local.add_argument("--host", default="127.0.0.1")
+    local.add_argument("--port", type=int, default=8080)
+    local.add_argument("--pool", type=int, default=32)
+    for command in (serve, local):
+        command.add_argument("--admin-token", default=ROUTER_ADMIN_TOKEN,
+                             help="Required as X-Admin-Token by /router/ (default: $ROUTER_ADMIN_TOKEN; "
+                                  "without one, only loopback clients may use them)")
+        command.add_argument("--allow-host", action="append", default=[], metavar="HOST",
+                             help="Shard host accepted besides loopback (repeatable)")
+    args = parser.parse_args(argv)
+
+    if args.command == "split":
+        paths = _pairs(args.store, "--store")
+        stores = {name: SeedStore(path, writable=True) for name, path in paths.items()}
+        try:
+            with SeedStore(args.source) as source:
+                written = split(source, HashRing(paths, args.vnodes, args.block), stores)
+        finally:
+            for store in stores.values():
+                store.close()
+        for name in paths:
+            print(f"{name}: {written[name]} seeds -> {paths[name]}")
+        return
+
+    if args.command == "rebalance":
+        paths = _pairs(args.store, "--store")
+        old, new = args.old.split(","), args.new.split(",")
+        missing = (set(old) | set(new)) - set(paths)
+        if missing:
+            raise SystemExit(f"No --store given for: {', '.join(sorted(missing))}")
+        stores = {name: SeedStore(path, writable=True) for name, path in paths.items()}
+        counters = {name: CounterStore(path, writable=True)
+                    for name, path in _pairs(args.counters, "--counters").items()} or None
+        try:
+            moved = rebalance(HashRing(old, args.vnodes, args.block), HashRing(new, args.vnodes, args.block),
+                              stores, counters)
+        finally:
+            for store in list(stores.values()) + list((counters or {}).values()):
+                store.close()
+        for (source, target), count in sorted(moved.items()):
+            print(f"{source} -> {target}: {count} users")
+        print(f"✅ Moved {sum(moved.values())} users")
+        return
+
+    import uvicorn
+
+    if args.command == "serve":
+        router = ShardRouter(_pairs(args.shard, "--shard"), args.vnodes, args.block, args.pool,
+                             admin_token=args.admin_token, allowed_hosts=LOOPBACK_HOSTS | set(args.allow_host))
+        uvicorn.run(router, host=args.host, port=args.port, log_level="warning")
+        return
+
+    names = [f"s{i}" for i in range(args.shards)]
+    directories = {name: os.path.join(args.dir, name) for name in names}
+    if args.source:
+        stores = {name: SeedStore(os.path.join(directory, "seeds.bin"), writable=True)
+                  for name, directory in directories.items()}
+        try:
+            with SeedStore(args.source) as source:
+                written = split(source, HashRing(names, args.vnodes, args.block), stores)
+        finally:
+            for store in stores.values():
+                store.close()
+        print("Split seeds: " + ", ".join(f"{name}={written[name]}" for name in names))
+
+    processes = []
+    try:
+        for i, name in enumerate(names):
+            processes.append(spawn_instance(directories[name], args.base_port + i, args.workers))
+            print(f"Shard {name} on 127.0.0.1:{args.base_port + i} ({directories[name]})")
+        router = ShardRouter({name: f"127.0.0.1:{args.base_port + i}" for i, name in enumerate(names)},
+                             args.vnodes, args.block, args.pool, admin_token=args.admin_token,
+                             allowed_hosts=LOOPBACK_HOSTS | set(args.allow_host))
+        print(f"Routing on {args.host}:{args.port}")
+        uvicorn.run(router, host=args.host, port=args.port, log_level="warning")
+    finally:
+        for process in processes:
+            process.send_signal(signal.SIGTERM)
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
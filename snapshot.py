@@ -0,0 +1,197 @@
+import glob
+import mmap
+import os
+import re
+import struct
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+MAGIC = b"2FASNAP\0"
+VERSION = 1
+
+# magic, version, created (unix time), section count
+_HEADER = struct.Struct("<8sIdI")
+# tag, payload length
+_SECTION = struct.Struct("<4sI")
+
+_COUNT = struct.Struct("<I")
+_KEY_LEN = struct.Struct("<H")
+_DRIFT = struct.Struct("<b")
+# tokens, seconds idle, failures, lockout seconds left
+_LIMIT = struct.Struct("<ddId")
+# step, user count
+_BUCKET = struct.Struct("<qI")
+
+SEED = b"SEED"
+DRIFT = b"DRFT"
+LIMIT_USER = b"LIMU"
+LIMIT_IP = b"LIMI"
+REPLAY = b"RPLY"
+
+
+def write_snapshot(path: str, sections: Dict[bytes, bytes], created: Optional[float] = None) -> int:
+    """
+    Atomically replace `path` with a snapshot of `sections` (tag -> payload).
+
+    The file is written under a temporary name, fsync'd and renamed over the
+    old one, so a crash mid-write leaves the previous snapshot intact. It
+    may hold the service seed, so it is created readable by the owner only.
+
+    Returns:
+        Size of the snapshot in bytes.
+    """
+    created = time.time() if created is None else created
+    parts = [_HEADER.pack(MAGIC, VERSION, created, len(sections))]
+    for tag, payload in sections.items():
+        parts.append(_SECTION.pack(tag, len(payload)))
+        parts.append(payload)
+    data = b"".join(parts)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return len(data)
+
+
+def slot_path(path: str, slot: int) -> str:
+    """File worker `slot` snapshots to: `path` itself for slot 0, `path`.<slot> for the others."""
+    return path if slot == 0 else f"{path}.{slot}"
+
+
+def slot_paths(path: str) -> List[str]:
+    """Existing snapshot files of every worker slot, slot 0 first."""
+    slots = []
+    for candidate in glob.glob(glob.escape(path) + ".*"):
+        suffix = candidate[len(path) + 1:]
+        if re.fullmatch(r"[1-9][0-9]*", suffix):
+            slots.append((int(suffix), candidate))
+    paths = [path] if os.path.exists(path) else []
+    return paths + [candidate for _, candidate in sorted(slots)]
+
+
+def load_snapshot(path: str, handlers: Dict[bytes, Callable[[memoryview, float], None]],
+                  max_age: Optional[float] = None) -> Optional[float]:
+    """
+    Map `path` and pass each section's payload to handlers[tag] along with
+    the seconds elapsed since the snapshot was taken. Unknown sections are
+    skipped, so older code can read newer snapshots. A snapshot taken more
+    than `max_age` seconds ago is ignored.
+
+    Returns:
+        The snapshot's creation time, or None if there is no usable snapshot.
+
+    Raises:
+        ValueError: If the file is not a snapshot or is truncated.
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            raise ValueError(f"{path} is not a state snapshot")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            view = memoryview(m)
+            try:
+                magic, version, created, count = _HEADER.unpack_from(view, 0)
+                if magic != MAGIC or version != VERSION:
+                    raise ValueError(f"{path} is not a state snapshot")
+                elapsed = max(0.0, time.time() - created)
+                if max_age is not None and elapsed > max_age:
+                    return None
+                offset = _HEADER.size
+                for _ in range(count):
+                    tag, length = _SECTION.unpack_from(view, offset)
+                    offset += _SECTION.size
+                    if offset + length > len(view):
+                        raise ValueError(f"{path} is truncated")
+                    handler = handlers.get(tag)
+                    if handler is not None:
+                        handler(view[offset:offset + length], elapsed)
+                    offset += length
+            except struct.error:
+                raise ValueError(f"{path} is truncated")
+            finally:
+                view.release()
+    return created
+
+
+def _pack_key(key: str) -> bytes:
+    raw = key.encode()
+    return _KEY_LEN.pack(len(raw)) + raw
+
+
+def _unpack_key(buf, offset: int) -> Tuple[str, int]:
+    (length,) = _KEY_LEN.unpack_from(buf, offset)
+    offset += _KEY_LEN.size
+    return bytes(buf[offset:offset + length]).decode(), offset + length
+
+
+def encode_drift(items: Iterable[Tuple[str, int]]) -> bytes:
+    items = [(key, offset) for key, offset in items if isinstance(key, str)]
+    return _COUNT.pack(len(items)) + b"".join(_pack_key(key) + _DRIFT.pack(offset) for key, offset in items)
+
+
+def decode_drift(buf) -> List[Tuple[str, int]]:
+    (count,) = _COUNT.unpack_from(buf, 0)
+    offset = _COUNT.size
+    items = []
+    for _ in range(count):
+        key, offset = _unpack_key(buf, offset)
+        items.append((key, _DRIFT.unpack_from(buf, offset)[0]))
+        offset += _DRIFT.size
+    return items
+
+
+def encode_limiter(entries: Iterable[tuple]) -> bytes:
+    entries = [entry for entry in entries if isinstance(entry[0], str)]
+    return _COUNT.pack(len(entries)) + b"".join(
+        _pack_key(key) + _LIMIT.pack(tokens, idle, failures, lockout)
+        for key, tokens, idle, failures, lockout in entries)
+
+
+def decode_limiter(buf) -> List[tuple]:
+    (count,) = _COUNT.unpack_from(buf, 0)
+    offset = _COUNT.size
+    entries = []
+    for _ in range(count):
+        key, offset = _unpack_key(buf, offset)
+        entries.append((key,) + _LIMIT.unpack_from(buf, offset))
+        offset += _LIMIT.size
+    return entries
+
+
+def encode_replay(buckets: Iterable[Tuple[int, Iterable[str]]]) -> bytes:
+    parts = []
+    count = 0
+    for step, users in buckets:
+        users = [user for user in users if isinstance(user, str)]
+        parts.append(_BUCKET.pack(step, len(users)))
+        parts.extend(_pack_key(user) for user in users)
+        count += 1
+    return _COUNT.pack(count) + b"".join(parts)
+
+
+def decode_replay(buf) -> List[Tuple[int, List[str]]]:
+    (count,) = _COUNT.unpack_from(buf, 0)
+    offset = _COUNT.size
+    buckets = []
+    for _ in range(count):
+        step, users = _BUCKET.unpack_from(buf, offset)
+        offset += _BUCKET.size
+        keys = []
+        for _ in range(users):
+            key, offset = _unpack_key(buf, offset)
+            keys.append(key)
+        buckets.append((step, keys))
+    return buckets
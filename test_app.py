@@ -0,0 +1,359 @@
+import asyncio
+import json
+import os
+import sys
+import time
+
+import pytest
+
+import snapshot
+from code_log import CodeLog
+from rate_limit import AttemptLimiter
+from seed_store import SeedStore
+from totp_utils import DriftTable, FileReplayBackend, ReplayGuard, TotpSeed, generate_hotp_code, generate_totp_code
+
+SEEDS = {user_id: TotpSeed(os.urandom(32)) for user_id in range(1, 65)}
+SERVICE_SEED = TotpSeed(os.urandom(32))
+
+
+@pytest.fixture(scope="module")
+def main(tmp_path_factory):
+    """main.py imported with every state path in a temp dir (no lifespan, like bench.AsgiClient)"""
+    directory = tmp_path_factory.mktemp("app")
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("SEED_STORE_PATH", str(directory / "seeds.bin"))
+        patch.setenv("HOTP_COUNTER_PATH", str(directory / "hotp-counters.bin"))
+        patch.setenv("AUDIT_LOG", "0")
+        patch.setenv("SNAPSHOT", "0")
+        patch.delenv("REPLAY_GUARD_DIR", raising=False)
+        patch.delenv("ENCRYPTED_SEED_DIR", raising=False)
+        sys.modules.pop("main", None)
+        import main as module
+    with SeedStore(module.SEED_STORE_PATH, writable=True) as store:
+        for user_id, seed in SEEDS.items():
+            store.put(user_id, seed)
+    yield module
+    sys.modules.pop("main", None)
+
+
+@pytest.fixture
+def app(main, monkeypatch):
+    """The app with fresh limiters, replay buckets and drift offsets for each test"""
+    def fresh(limiter):
+        return AttemptLimiter(rate=limiter.rate, burst=limiter.burst, max_failures=limiter.max_failures,
+                              lockout_seconds=limiter.lockout_seconds)
+
+    monkeypatch.setattr(main, "user_limiter", fresh(main.user_limiter))
+    monkeypatch.setattr(main, "ip_limiter", fresh(main.ip_limiter))
+    monkeypatch.setattr(main, "replay_guard", ReplayGuard(valid_window=main.replay_guard.valid_window))
+    monkeypatch.setattr(main, "drift_table", DriftTable(valid_window=1, max_drift=main.VERIFY_MAX_DRIFT))
+    return main
+
+
+def call(app, method, path, body=None, client="127.0.0.1", headers=()):
+    """One request through the ASGI app; (status, decoded JSON body)"""
+    path, _, query = path.partition("?")
+    payload = json.dumps(body).encode() if body is not None else b""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": query.encode(), "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode()),
+                    *headers],
+        "client": (client, 50000), "server": ("127.0.0.1", 8080),
+    }
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": payload, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app.app(scope, receive, send))
+    body = b"".join(message.get("body", b"") for message in sent[1:])
+    return sent[0]["status"], json.loads(body) if body else None
+
+
+def code_for(user_id):
+    return generate_totp_code(SEEDS[user_id])[0]
+
+
+@pytest.mark.parametrize("user_id", [5.7, True, "5.7", "-1", "", "٣", [5], {"id": 5}, 2**32])
+def test_verify_rejects_malformed_user_id(app, user_id):
+    status, body = call(app, "POST", "/verify-2fa", {"user_id": user_id, "code": "123456"})
+    assert status == 400
+    assert body == {"detail": {"error": "Invalid user_id"}}
+
+
+def test_verify_accepts_integer_and_digit_string_user_id(app):
+    assert call(app, "POST", "/verify-2fa", {"user_id": 5, "code": code_for(5)}) == (200, {"valid": True})
+    assert call(app, "POST", "/verify-2fa", {"user_id": "6", "code": code_for(6)}) == (200, {"valid": True})
+
+
+def test_batch_results_follow_input_order(app):
+    inline = TotpSeed(os.urandom(32))
+    items = [
+        {"user_id": 10, "code": code_for(10)},
+        {"user_id": 11, "code": "000000" if code_for(11) != "000000" else "111111"},
+        "not an object",
+        {"user_id": 999, "code": "123456"},
+        {"seed": inline.hex, "code": generate_totp_code(inline)[0]},
+        {"user_id": 12, "code": "12ab56"},
+        {"user_id": 12.5, "code": "123456"},
+        {"user_id": 13, "code": code_for(13)},
+    ]
+    status, body = call(app, "POST", "/verify-2fa/batch", {"items": items})
+    assert status == 200
+    results = body["results"]
+    assert len(results) == len(items)
+    assert results[0] == {"valid": True}
+    assert results[1] == {"valid": False}
+    assert "error" in results[2]
+    assert results[3] == {"error": "Unknown user"}
+    assert results[4] == {"valid": True}
+    assert "error" in results[5]
+    assert results[6] == {"error": "Invalid user_id"}
+    assert results[7] == {"valid": True}
+
+
+def test_batch_rejects_missing_and_oversized_item_lists(app, monkeypatch):
+    assert call(app, "POST", "/verify-2fa/batch", {})[0] == 400
+    monkeypatch.setattr(app, "BATCH_MAX_ITEMS", 2)
+    status, body = call(app, "POST", "/verify-2fa/batch", {"items": [{"code": "123456"}] * 3})
+    assert status == 413
+
+
+def test_codes_history_reads_the_code_log(app, monkeypatch, tmp_path):
+    log = CodeLog(str(tmp_path / "codes.log"))
+    for i in range(10):
+        log.append(1000 + 60 * i, f"{i:06d}")
+    monkeypatch.setattr(app, "code_log", log)
+
+    status, body = call(app, "GET", "/codes/history?from=1060&to=1240")
+    assert status == 200
+    assert body["entries"] == [{"timestamp": 1000 + 60 * i, "code": f"{i:06d}"} for i in range(1, 5)]
+    assert len(call(app, "GET", "/codes/history?limit=3")[1]["entries"]) == 3
+    assert call(app, "GET", "/codes/history?limit=0")[0] == 422
+    assert call(app, "GET", f"/codes/history?limit={app.CODE_HISTORY_MAX + 1}")[0] == 422
+
+
+def test_verify_rejects_a_replayed_code(app):
+    code = code_for(20)
+    assert call(app, "POST", "/verify-2fa", {"user_id": 20, "code": code}) == (200, {"valid": True})
+    assert call(app, "POST", "/verify-2fa", {"user_id": 20, "code": code}) == (200, {"valid": False})
+
+    # A code replayed inside a batch, or from a single verify into a batch, is rejected too
+    items = [{"user_id": 21, "code": code_for(21)}, {"user_id": 21, "code": code_for(21)},
+             {"user_id": 20, "code": code}]
+    status, body = call(app, "POST", "/verify-2fa/batch", {"items": items})
+    assert body["results"] == [{"valid": True}, {"valid": False}, {"valid": False}]
+
+
+def test_inline_seed_replay_keys_do_not_contain_the_seed(app, monkeypatch, tmp_path):
+    backend = FileReplayBackend(str(tmp_path / "replay"))
+    monkeypatch.setattr(app, "replay_guard", ReplayGuard(backend, valid_window=1))
+    seed = TotpSeed(os.urandom(32))
+    item = {"seed": seed.hex, "code": generate_totp_code(seed)[0]}
+
+    status, body = call(app, "POST", "/verify-2fa/batch", {"items": [item, item]})
+    assert body["results"] == [{"valid": True}, {"valid": False}]
+    names = [name for _, _, files in os.walk(backend.directory) for name in files]
+    assert len(names) == 1
+    assert seed.hex not in names[0] and seed.hex[:16] not in names[0]
+
+
+def wrong_code(user_id):
+    """A well-formed code that doesn't verify for user_id (None: the service seed)"""
+    valid = {generate_totp_code(SEEDS.get(user_id, SERVICE_SEED), for_time=time.time() + 30 * offset)[0] for offset in range(-2, 3)}
+    return next(code for code in ("000000", "111111", "222222", "333333", "444444", "555555")
+                if code not in valid)
+
+
+def test_verify_locks_out_a_user_after_repeated_failures(app):
+    for _ in range(app.user_limiter.max_failures):
+        assert call(app, "POST", "/verify-2fa", {"user_id": 30, "code": wrong_code(30)}) == (200, {"valid": False})
+    status, body = call(app, "POST", "/verify-2fa", {"user_id": 30, "code": code_for(30)})
+    assert status == 429
+    assert body == {"detail": {"error": "Too many attempts"}}
+    assert call(app, "POST", "/verify-2fa", {"user_id": 31, "code": code_for(31)}) == (200, {"valid": True})
+
+
+def test_throttled_ip_does_not_spend_the_victims_user_tokens(app, monkeypatch):
+    monkeypatch.setattr(app, "ip_limiter", AttemptLimiter(rate=0, burst=2, max_failures=100))
+    for _ in range(2):
+        call(app, "POST", "/verify-2fa", {"user_id": 32, "code": wrong_code(32)}, client="10.0.0.1")
+    for _ in range(app.user_limiter.burst * 2):
+        status, _ = call(app, "POST", "/verify-2fa", {"user_id": 33, "code": wrong_code(33)}, client="10.0.0.1")
+        assert status == 429
+
+    # The victim's bucket is untouched, so their own login still goes through
+    assert call(app, "POST", "/verify-2fa", {"user_id": 33, "code": code_for(33)},
+                client="10.0.0.2") == (200, {"valid": True})
+
+
+def test_service_seed_lockout_is_per_client_ip(app, monkeypatch):
+    monkeypatch.setattr(app, "shared_seed", None)
+    monkeypatch.setattr(app, "decrypted_seed", SERVICE_SEED)
+    for _ in range(app.user_limiter.max_failures):
+        call(app, "POST", "/verify-2fa", {"code": wrong_code(None)}, client="10.0.0.3")
+    assert call(app, "POST", "/verify-2fa", {"code": wrong_code(None)}, client="10.0.0.3")[0] == 429
+
+    code = generate_totp_code(SERVICE_SEED)[0]
+    assert call(app, "POST", "/verify-2fa", {"code": code}, client="10.0.0.4") == (200, {"valid": True})
+
+
+def test_batch_items_are_charged_to_the_client_ip(app, monkeypatch):
+    monkeypatch.setattr(app, "ip_limiter", AttemptLimiter(rate=0, burst=3, max_failures=100))
+    items = [{"user_id": user_id, "code": code_for(user_id)} for user_id in range(40, 45)]
+    status, body = call(app, "POST", "/verify-2fa/batch", {"items": items})
+    assert status == 200
+    assert body["results"] == [{"valid": True}] * 3 + [{"error": "Too many attempts"}] * 2
+    assert call(app, "POST", "/verify-2fa", {"user_id": 45, "code": code_for(45)})[0] == 429
+
+
+def test_private_runtime_dir(app, tmp_path):
+    loose = tmp_path / "loose"
+    loose.mkdir(mode=0o755)
+    assert app.ensure_private_dir(str(loose)) == str(loose)
+    assert loose.stat().st_mode & 0o777 == 0o700
+    assert (tmp_path / "fresh").exists() is False
+    app.ensure_private_dir(str(tmp_path / "fresh"))
+    assert (tmp_path / "fresh").stat().st_mode & 0o777 == 0o700
+
+    (tmp_path / "link").symlink_to(loose)
+    with pytest.raises(PermissionError):
+        app.ensure_private_dir(str(tmp_path / "link"))
+
+
+def test_warm_up_prefers_the_seed_file_over_a_stale_slot(app, monkeypatch, tmp_path):
+    slot_path = str(tmp_path / "run" / "seed.bin")
+    stale, current = TotpSeed(os.urandom(32)), TotpSeed(os.urandom(32))
+    app.ensure_private_dir(str(tmp_path / "run"))
+    with SeedStore(slot_path, writable=True, capacity=1) as slot:
+        slot.put(0, stale)
+
+    monkeypatch.setattr(app, "SHARED_SEED_PATH", slot_path)
+    monkeypatch.setattr(app, "load_seed_files", lambda: current)
+    monkeypatch.setattr(app, "decrypted_seed", None)
+    monkeypatch.setattr(app, "shared_seed", None)
+    app.warm_up()
+    try:
+        assert app.current_seed().key == current.key
+        with SeedStore(slot_path) as slot:
+            assert slot.get_key(0) == current.key
+    finally:
+        app.shared_seed.close()
+
+
+def test_seed_cache_invalidate_requires_admin(app, monkeypatch):
+    monkeypatch.setattr(app, "seed_repository", None)
+    assert call(app, "POST", "/seeds/cache/invalidate", {}, client="10.0.0.5")[0] == 403
+    assert call(app, "POST", "/seeds/cache/invalidate", {})[0] == 404
+
+    monkeypatch.setattr(app, "ADMIN_TOKEN", "s3cret")
+    assert call(app, "POST", "/seeds/cache/invalidate", {})[0] == 403
+    assert call(app, "POST", "/seeds/cache/invalidate", {}, headers=[(b"x-admin-token", b"s3cret")],
+                client="10.0.0.5")[0] == 404
+
+
+def test_hotp_resyncs_to_a_code_ahead_of_the_counter(app):
+    seed = SEEDS[50]
+    status, body = call(app, "GET", "/hotp/generate?user_id=50")
+    assert status == 200
+    counter = body["counter"]
+    assert body["code"] == generate_hotp_code(seed, counter)
+
+    # The token was pressed a few times without logging in: still accepted, and the counter catches up
+    ahead = generate_hotp_code(seed, counter + 5)
+    resyncs = app.get_hotp_verifier().resyncs
+    assert call(app, "POST", "/hotp/verify", {"user_id": 50, "code": ahead}) == (200, {"valid": True})
+    assert app.get_hotp_verifier().resyncs == resyncs + 1
+    assert call(app, "GET", "/hotp/generate?user_id=50")[1]["counter"] == counter + 6
+
+    # Codes at or behind the matched counter are spent
+    assert call(app, "POST", "/hotp/verify", {"user_id": 50, "code": ahead}) == (200, {"valid": False})
+    skipped = generate_hotp_code(seed, counter)
+    if skipped != generate_hotp_code(seed, counter + 6):
+        assert call(app, "POST", "/hotp/verify", {"user_id": 50, "code": skipped}) == (200, {"valid": False})
+
+    # Beyond the look-ahead window nothing matches
+    window = {generate_hotp_code(seed, counter + 6 + n) for n in range(app.HOTP_LOOK_AHEAD + 1)}
+    too_far = generate_hotp_code(seed, counter + 7 + app.HOTP_LOOK_AHEAD)
+    if too_far not in window:
+        assert call(app, "POST", "/hotp/verify", {"user_id": 50, "code": too_far}) == (200, {"valid": False})
+    assert call(app, "POST", "/hotp/verify", {"user_id": 50,
+                                              "code": generate_hotp_code(seed, counter + 6)}) == (200, {"valid": True})
+
+
+def test_workers_snapshot_to_their_own_files_and_restore_the_union(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "RUNTIME_DIR", str(tmp_path / "run"))
+    monkeypatch.setattr(app, "SNAPSHOT_PATH", str(tmp_path / "state.snap"))
+    monkeypatch.setattr(app, "snapshot_slot_lock", None)
+    monkeypatch.setattr(app, "snapshot_path", None)
+    step = int(time.time()) // 30
+    locks = []
+    for worker in ("1", "2"):
+        assert app.claim_snapshot_slot() == str(tmp_path / "state.snap") + ("" if worker == "1" else ".1")
+        locks.append(app.snapshot_slot_lock)
+        monkeypatch.setattr(app, "replay_guard", ReplayGuard(valid_window=1))
+        app.replay_guard.backend.add(step, worker)
+        app.replay_guard.backend.add(step, "seed-" + worker * 32)
+        app.save_state()
+
+    # A slot left behind by a worker that no longer runs ages out
+    snapshot.write_snapshot(str(tmp_path / "state.snap.5"), {
+        snapshot.REPLAY: snapshot.encode_replay([(step, ["stale"])]),
+        snapshot.DRIFT: snapshot.encode_drift([("9", 3)]),
+    }, created=time.time() - app.SNAPSHOT_MAX_AGE - 1)
+
+    monkeypatch.setattr(app, "replay_guard", ReplayGuard(valid_window=1))
+    app.restore_state()
+    assert [(s, sorted(keys)) for s, keys in app.replay_guard.backend.buckets()] == [(step, ["1", "2"])]
+    assert "9" not in dict(app.drift_table.items())
+    for lock in locks:
+        lock.close()
+
+
+def test_trusted_gateway_batches_skip_the_ip_budget_but_not_user_budgets(app, monkeypatch):
+    monkeypatch.setattr(app, "ip_limiter", AttemptLimiter(rate=0, burst=3, max_failures=100))
+    monkeypatch.setattr(app, "BATCH_TRUSTED_IPS", frozenset({"10.0.0.9"}))
+    items = [{"user_id": user_id, "code": code_for(user_id)} for user_id in range(50, 60)]
+    items += [{"user_id": 60, "code": wrong_code(60)}] * (app.user_limiter.burst + 1)
+    status, body = call(app, "POST", "/verify-2fa/batch", {"items": items}, client="10.0.0.9")
+    assert status == 200
+    assert body["results"][:10] == [{"valid": True}] * 10
+    assert body["results"][10:-1] == [{"valid": False}] * app.user_limiter.burst
+    assert body["results"][-1] == {"error": "Too many attempts"}
+    assert app.ip_limiter.stats()["allowed"] == 0
+
+
+def test_audit_records_hold_parsed_user_ids_only(app, monkeypatch):
+    records = []
+
+    class Recorder:
+        async def record(self, event, user, client_ip, result):
+            records.append((event, user, result))
+
+    monkeypatch.setattr(app, "audit_log", Recorder())
+    junk = "x" * 100000
+    call(app, "POST", "/verify-2fa", {"user_id": junk, "code": "123456"})
+    call(app, "POST", "/verify-2fa", {"user_id": "7", "code": code_for(7)})
+    call(app, "POST", "/hotp/verify", {"user_id": {"nested": [junk]}, "code": "123456"})
+    call(app, "POST", "/verify-2fa/batch", {"items": [{"user_id": [junk], "code": "123456"},
+                                                      {"user_id": 8, "code": code_for(8)}]})
+    assert records == [("verify-2fa", None, "http_400"), ("verify-2fa", 7, "valid"),
+                       ("hotp-verify", None, "http_400"),
+                       ("verify-2fa/batch", None, "http_400"), ("verify-2fa/batch", 8, "valid")]
+
+
+def test_unusable_runtime_dir_only_disables_the_scheduler(app, monkeypatch, tmp_path):
+    planted = tmp_path / "planted"
+    planted.symlink_to(tmp_path)
+    monkeypatch.setattr(app, "SCHEDULER_LOCK_PATH", str(planted / "scheduler.lock"))
+    assert app.acquire_scheduler_lock() is None
+
+    monkeypatch.setattr(app, "SCHEDULER_LOCK_PATH", str(tmp_path / "run" / "scheduler.lock"))
+    lock = app.acquire_scheduler_lock()
+    assert lock is not None and app.acquire_scheduler_lock() is None
+    lock.close()
@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+from audit_log import BLOCK, DROP, AuditLog
+
+
+def read_records(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_batches_by_size_and_time(tmp_path):
+    path = tmp_path / "audit.log"
+    log = AuditLog(str(path), max_batch=4, max_delay=0.05, fsync=False)
+
+    async def scenario():
+        writer = asyncio.create_task(log.run())
+        for i in range(10):
+            await log.record("verify-2fa", i, "127.0.0.1", "valid")
+        await asyncio.sleep(0.2)
+        batches_after_burst = log.batches
+        await log.record("verify-2fa", 99, "127.0.0.1", "invalid")
+        await asyncio.sleep(0.2)
+        writer.cancel()
+        await log.close()
+        return batches_after_burst
+
+    assert asyncio.run(scenario()) == 3
+    records = read_records(path)
+    assert [r["user"] for r in records] == list(range(10)) + [99]
+    assert records[-1]["result"] == "invalid"
+    assert log.stats()["written"] == 11 and log.batches == 4
+
+
+def test_full_queue_drops_or_blocks(tmp_path):
+    dropping = AuditLog(str(tmp_path / "drop.log"), queue_size=2, policy=DROP, fsync=False)
+    blocking = AuditLog(str(tmp_path / "block.log"), queue_size=2, max_batch=2, max_delay=0.01,
+                        policy=BLOCK, fsync=False)
+
+    async def scenario():
+        for i in range(5):
+            await dropping.record("verify-2fa", i, None, "valid")
+        writer = asyncio.create_task(blocking.run())
+        await asyncio.wait_for(asyncio.gather(*(blocking.record("verify-2fa", i, None, "valid")
+                                                for i in range(6))), 2)
+        writer.cancel()
+        await blocking.close()
+        await dropping.close()
+
+    asyncio.run(scenario())
+    assert dropping.dropped == 3 and len(read_records(tmp_path / "drop.log")) == 2
+    assert blocking.delayed > 0 and blocking.dropped == 0
+    assert sorted(r["user"] for r in read_records(tmp_path / "block.log")) == list(range(6))
+
+
+def test_rotation_keeps_retention(tmp_path):
+    path = tmp_path / "audit.log"
+    log = AuditLog(str(path), max_bytes=200, retention=2, fsync=False)
+    for i in range(10):
+        log._write([(1700000000.0 + i, "verify-2fa", i, "10.0.0.1", "valid")])
+    assert sorted(p.name for p in tmp_path.iterdir() if not p.name.endswith(".lock")) == [
+        "audit.log", "audit.log.1", "audit.log.2"]
+    assert read_records(path)[-1]["user"] == 9
@@ -0,0 +1,31 @@
+import pytest
+
+from code_log import HEADER_SIZE, RECORD_SIZE, CodeLog
+
+
+def test_range_and_at_across_rotations(tmp_path):
+    log = CodeLog(str(tmp_path / "codes.log"), max_bytes=HEADER_SIZE + 10 * RECORD_SIZE, retention=2)
+    for i in range(35):
+        log.append(1000 + 60 * i, f"{i:06d}")
+
+    # 10 records per file and 2 rotated files kept: the oldest file is gone
+    assert len(log.files()) == 3
+    entries = log.range()
+    assert [ts for ts, _ in entries] == [1000 + 60 * i for i in range(10, 35)]
+
+    assert log.range(1000 + 60 * 12, 1000 + 60 * 14) == [
+        (1000 + 60 * i, f"{i:06d}") for i in (12, 13, 14)]
+    assert log.range(1000 + 60 * 12 + 1, 1000 + 60 * 20 - 1, limit=3) == [
+        (1000 + 60 * i, f"{i:06d}") for i in (13, 14, 15)]
+    assert log.range(10**10) == []
+
+    assert log.at(1000 + 60 * 20 + 59) == (1000 + 60 * 20, "000020")
+    assert log.at(1000 + 60 * 34) == (1000 + 60 * 34, "000034")
+    assert log.at(1000 + 60 * 9) is None
+
+
+def test_rejects_foreign_file(tmp_path):
+    path = tmp_path / "codes.log"
+    path.write_bytes(b"not a log file at all, just text\n")
+    with pytest.raises(ValueError):
+        CodeLog(str(path)).range()
@@ -0,0 +1,81 @@
+import base64
+import os
+
+import pytest
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from crypto_utils import (SeedEnvelope, decrypt_seed, evict_private_key, get_private_key, preload_private_key,
+                          read_seeds, write_seed_envelope)
+
+OAEP = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+
+
+def write_key(path):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with open(path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return key
+
+
+def test_key_cache_reuses_and_reloads(tmp_path):
+    path = str(tmp_path / "key.pem")
+    write_key(path)
+
+    first = get_private_key(path)
+    assert get_private_key(path) is first
+
+    # Rotate the key the way a deploy would: new file renamed over the old one
+    write_key(str(tmp_path / "new.pem"))
+    os.replace(str(tmp_path / "new.pem"), path)
+    reloaded = get_private_key(path)
+    assert reloaded is not first
+    assert get_private_key(path) is reloaded
+
+    evict_private_key(path)
+    assert get_private_key(path) is not reloaded
+    assert preload_private_key(path) is get_private_key(path)
+    evict_private_key()
+
+
+def test_decrypt_with_cached_key(tmp_path):
+    path = str(tmp_path / "key.pem")
+    public_key = write_key(path).public_key()
+    hex_seed = os.urandom(32).hex()
+    encrypted = base64.b64encode(public_key.encrypt(hex_seed.encode(), OAEP)).decode()
+
+    assert decrypt_seed(encrypted, get_private_key(path)) == hex_seed
+    evict_private_key()
+
+
+def test_envelope_roundtrip_random_access_and_tamper(tmp_path):
+    key = write_key(str(tmp_path / "key.pem"))
+    records = [(user_id, os.urandom(32)) for user_id in range(10)]
+    path = tmp_path / "seeds.env"
+    with open(path, "wb") as f:
+        assert write_seed_envelope(f, iter(records), key.public_key(), chunk_records=4) == 10
+
+    with open(path, "rb") as f:
+        envelope = SeedEnvelope(f, key)
+        assert envelope.chunk_count == 3
+        assert envelope.read_chunk(2) == records[8:]
+        assert envelope.read_chunk(1) == records[4:8]
+        assert list(envelope) == records
+    with open(path, "rb") as f:
+        assert list(read_seeds(f, key)) == records
+
+    # Dropping the final chunk (at a chunk boundary) must not pass as a shorter archive
+    data = path.read_bytes()
+    truncated = tmp_path / "truncated.env"
+    truncated.write_bytes(data[:len(data) - (2 * 36 + 16)])
+    with open(truncated, "rb") as f:
+        with pytest.raises(ValueError):
+            list(SeedEnvelope(f, key))
+
+    # The single-seed format is still accepted
+    hex_seed = os.urandom(32).hex()
+    single = tmp_path / "encrypted_seed.txt"
+    single.write_text(base64.b64encode(key.public_key().encrypt(hex_seed.encode(), OAEP)).decode())
+    with open(single, "rb") as f:
+        assert list(read_seeds(f, key)) == [(None, bytes.fromhex(hex_seed))]
@@ -0,0 +1,60 @@
+import base64
+import os
+import random
+
+import pyotp
+import pytest
+
+from hotp_store import GROW_RECORDS, CounterStore, HotpVerifier
+from totp_utils import HotpWindow, TotpSeed, generate_hotp_code, verify_hotp_code
+
+
+def reference_hotp(seed):
+    return pyotp.HOTP(base64.b32encode(seed.key).decode())
+
+
+def test_hotp_matches_pyotp():
+    seed = TotpSeed(os.urandom(32))
+    reference = reference_hotp(seed)
+    for counter in [0, 1, 2, 1000, 2**32, 2**40] + random.Random(3).sample(range(10**6), 50):
+        code = generate_hotp_code(seed, counter)
+        assert code == reference.at(counter)
+        assert verify_hotp_code(seed, code, max(0, counter - 5), look_ahead=10) == counter
+    with pytest.raises(ValueError):
+        generate_hotp_code(seed, -1)
+
+
+def test_window_advance_matches_fresh_build():
+    key = os.urandom(32)
+    window = HotpWindow(key, 0, look_ahead=20)
+    for start in (1, 2, 7, 20, 21, 45, 46, 100):
+        window.advance(start)
+        fresh = HotpWindow(key, start, look_ahead=20)
+        assert list(window.codes) == list(fresh.codes)
+        assert window.lookup == fresh.lookup
+
+
+def test_verifier_resyncs_and_rejects_reuse(tmp_path):
+    seed = TotpSeed(os.urandom(32))
+    path = str(tmp_path / "counters.bin")
+    verifier = HotpVerifier(CounterStore(path, writable=True), look_ahead=10)
+
+    assert verifier.verify(5, seed, generate_hotp_code(seed, 0)) == 0
+    assert verifier.verify(5, seed, generate_hotp_code(seed, 0)) is None
+    # Token pressed 8 times without logging in
+    assert verifier.verify(5, seed, generate_hotp_code(seed, 9)) == 9
+    assert verifier.verify(5, seed, generate_hotp_code(seed, 21)) is None
+    assert verifier.resyncs == 1
+
+    # Another worker's store sees the counter, also past a growth
+    assert verifier.verify(GROW_RECORDS + 1, seed, generate_hotp_code(seed, 3)) == 3
+    assert verifier.counters.flush() == 3
+    with CounterStore(path) as reader:
+        assert reader.get(5) == 10
+        assert reader.get(GROW_RECORDS + 1) == 4
+        assert reader.get(6) == 0
+
+    stale = CounterStore(path, writable=True)
+    assert not stale.compare_and_set(5, 0, 1)
+    stale.close()
+    verifier.counters.close()
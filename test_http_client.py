@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from http_client import Connection
+
+OK = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+
+
+async def _serve(script):
+    """
+    Server answering the n-th request it reads per script[n]: bytes are sent
+    back on a kept-alive connection, ("idle-close", bytes) are sent before
+    the connection is dropped, None drops it without answering.
+    """
+    received = []
+
+    async def handle(reader, writer):
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                break
+            length = next(int(line.split(b":")[1]) for line in head.split(b"\r\n")
+                          if line.lower().startswith(b"content-length"))
+            await reader.readexactly(length)
+            received.append(head.split(b" ")[1].decode())
+            step = script[len(received) - 1]
+            if step is None:
+                break
+            reply = step[1] if isinstance(step, tuple) else step
+            writer.write(reply)
+            await writer.drain()
+            if isinstance(step, tuple) or not reply.endswith(b"ok"):
+                break
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1], received
+
+
+def test_idle_connection_closed_by_the_server_is_retried():
+    async def scenario():
+        server, port, received = await _serve([("idle-close", OK), OK])
+        conn = Connection("127.0.0.1", port)
+        assert (await conn.request("POST", "/first"))[0] == 200
+        await asyncio.sleep(0.05)
+        assert (await conn.request("POST", "/second"))[0] == 200
+        assert received == ["/first", "/second"]
+        server.close()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("script", [[None], [OK, b"HTTP/1.1 200 OK\r\nContent-Len"]])
+def test_requests_that_may_have_been_processed_are_not_resent(script):
+    async def scenario():
+        server, port, received = await _serve(script)
+        conn = Connection("127.0.0.1", port)
+        if len(script) > 1:
+            assert (await conn.request("POST", "/first"))[0] == 200
+        with pytest.raises((ConnectionError, asyncio.IncompleteReadError)):
+            await conn.request("POST", "/hotp/verify")
+        assert received.count("/hotp/verify") == 1
+        server.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,23 @@
+from metrics import Counter, Histogram, render
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_latency_seconds", "test", ("endpoint",), buckets=(0.1, 1.0))
+    child = histogram.labels("/x")
+    for value in (0.05, 0.1, 0.5, 5.0):
+        child.observe(value)
+
+    text = render()
+    assert 'test_latency_seconds_bucket{endpoint="/x",le="0.1"} 2' in text
+    assert 'test_latency_seconds_bucket{endpoint="/x",le="1.0"} 3' in text
+    assert 'test_latency_seconds_bucket{endpoint="/x",le="+Inf"} 4' in text
+    assert 'test_latency_seconds_count{endpoint="/x"} 4' in text
+
+
+def test_counter_children_are_reused():
+    counter = Counter("test_events_total", "test", ("result",))
+    counter.labels("hit").inc()
+    counter.labels("hit").inc(2)
+    assert counter.labels("hit").value == 3
+    assert "# TYPE test_events_total counter" in render()
+    assert 'test_events_total{result="hit"} 3' in render()
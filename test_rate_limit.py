@@ -0,0 +1,34 @@
+from rate_limit import AttemptLimiter
+
+
+def test_token_bucket_refills():
+    limiter = AttemptLimiter(rate=1.0, burst=3)
+    assert [limiter.allow("alice", now=100.0) for _ in range(4)] == [True, True, True, False]
+    assert limiter.allow("bob", now=100.0)
+    assert limiter.allow("alice", now=101.0)
+    assert not limiter.allow("alice", now=101.5)
+    assert limiter.stats()["rejected_rate"] == 2
+
+
+def test_lockout_after_consecutive_failures():
+    limiter = AttemptLimiter(rate=100.0, burst=100, max_failures=3, lockout_seconds=60)
+    for _ in range(2):
+        assert limiter.allow("alice", now=0.0)
+        limiter.record("alice", False, now=0.0)
+    limiter.record("alice", True, now=0.0)
+
+    for _ in range(3):
+        assert limiter.allow("alice", now=1.0)
+        limiter.record("alice", False, now=1.0)
+    assert not limiter.allow("alice", now=2.0)
+    assert limiter.allow("alice", now=62.0)
+
+    stats = limiter.stats()
+    assert stats["lockouts"] == 1 and stats["rejected_lockout"] == 1
+
+
+def test_idle_entries_expire_lazily():
+    limiter = AttemptLimiter(shards=1, idle_seconds=10)
+    limiter.allow("alice", now=0.0)
+    limiter.allow("bob", now=20.0)
+    assert limiter.stats()["tracked_keys"] == 1
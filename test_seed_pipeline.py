@@ -0,0 +1,64 @@
+import base64
+import json
+import os
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+
+from seed_pipeline import decrypt_jsonl
+from seed_store import SeedStore
+import seed_pipeline
+
+OAEP = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+
+
+def encrypt(hex_seed):
+    with open("student_public.pem", "rb") as f:
+        public_key = serialization.load_pem_public_key(f.read())
+    return base64.b64encode(public_key.encrypt(hex_seed.encode(), OAEP)).decode()
+
+
+def test_decrypts_in_input_order():
+    seeds = [os.urandom(32).hex() for _ in range(20)]
+    lines = [json.dumps({"user_id": i, "encrypted_seed": encrypt(seed)}) for i, seed in enumerate(seeds)]
+    lines.insert(5, json.dumps({"user_id": 99, "encrypted_seed": "bm90IHZhbGlk"}))
+
+    written = []
+    done, failed = decrypt_jsonl(lines, "student_private.pem",
+                                 lambda *record: written.append(record),
+                                 workers=2, chunk_size=3, in_flight=1)
+
+    assert (done, failed) == (21, 1)
+    assert [line_no for line_no, *_ in written] == list(range(1, 22))
+    assert written[5][1] == 99 and written[5][2] is None and written[5][3]
+    del written[5]
+    assert [(user_id, hex_seed) for _, user_id, hex_seed, _ in written] == list(enumerate(seeds))
+
+
+def test_cli_writes_seed_store(tmp_path):
+    seeds = {3: os.urandom(32).hex(), 8: os.urandom(32).hex()}
+    source = tmp_path / "encrypted.jsonl"
+    source.write_text("".join(json.dumps({"user_id": user_id, "encrypted_seed": encrypt(seed)}) + "\n"
+                              for user_id, seed in seeds.items()))
+    store_path = str(tmp_path / "seeds.bin")
+
+    assert seed_pipeline.main([str(source), "--store", store_path, "--workers", "1"]) == 0
+    with SeedStore(store_path) as store:
+        for user_id, seed in seeds.items():
+            assert store.get(user_id).hex == seed
+
+
+def test_cli_skips_and_reports_bad_user_ids(tmp_path, capsys):
+    good = os.urandom(32).hex()
+    rows = [(4, good), ("abc", os.urandom(32).hex()), (2**40, os.urandom(32).hex()),
+            (None, os.urandom(32).hex()), ("9", good)]
+    source = tmp_path / "encrypted.jsonl"
+    source.write_text("".join(json.dumps({"user_id": user_id, "encrypted_seed": encrypt(seed)}) + "\n"
+                              for user_id, seed in rows))
+    store_path = str(tmp_path / "seeds.bin")
+
+    assert seed_pipeline.main([str(source), "--store", store_path, "--workers", "1"]) == 1
+    assert "Rejected 3 records" in capsys.readouterr().err
+    with SeedStore(store_path) as store:
+        assert store.get(4).hex == good
+        assert store.get(9).hex == good
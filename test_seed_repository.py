@@ -0,0 +1,92 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from crypto_utils import encrypt_seed, load_public_key
+from seed_repository import EncryptedSeedRepository, InvalidationBus, SeedCache, import_seeds
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_evicts_least_recent_and_expires():
+    clock = FakeClock()
+    cache = SeedCache(capacity=2, ttl=10, clock=clock)
+    cache.put(1, "a")
+    cache.put(2, "b")
+    assert cache.get(1) == "a"
+    cache.put(3, "c")
+    assert cache.get(2) is None
+    assert cache.evictions == 1
+
+    clock.now = 11
+    assert cache.get(1) is None
+    assert cache.expirations == 1
+    assert cache.stats()["hit_ratio"] == 1 / 3
+
+
+def test_repository_decrypts_once_and_invalidates(tmp_path):
+    seeds = {1: os.urandom(32).hex(), 2: os.urandom(32).hex()}
+    repository = EncryptedSeedRepository(str(tmp_path), "student_private.pem")
+    public_key = load_public_key("student_public.pem")
+    assert import_seeds(repository, public_key, [f"{uid} {seed}" for uid, seed in seeds.items()]) == 2
+    stored = "".join(path.read_text() for path in tmp_path.iterdir())
+    assert not any(seed in stored for seed in seeds.values())
+
+    assert repository.get(1).hex == seeds[1]
+    assert repository.get(1).hex == seeds[1]
+    assert repository.get(7) is None
+    assert repository.decrypts == 1
+
+    replacement = os.urandom(32).hex()
+    repository.put_encrypted(1, encrypt_seed(replacement, public_key))
+    assert repository.get(1).hex == replacement
+    assert repository.decrypts == 2
+
+
+def test_concurrent_misses_share_one_decrypt(tmp_path):
+    hex_seed = os.urandom(32).hex()
+    release = threading.Event()
+
+    class SlowRepository(EncryptedSeedRepository):
+        def load(self, user_id):
+            release.wait(5)
+            return super().load(user_id)
+
+    with ThreadPoolExecutor(2) as executor:
+        repository = SlowRepository(str(tmp_path), "student_private.pem", executor=executor)
+        repository.put_encrypted(3, encrypt_seed(hex_seed, load_public_key("student_public.pem")))
+        futures = [repository.get_future(3) for _ in range(10)]
+        release.set()
+        assert {future.result().hex for future in futures} == {hex_seed}
+
+    assert repository.decrypts == 1
+    assert repository.coalesced == 9
+
+
+def test_invalidations_reach_every_worker_on_the_bus(tmp_path):
+    hex_seed = os.urandom(32).hex()
+    bus_path = str(tmp_path / "bus")
+    directory = tmp_path / "seeds"
+    workers = [EncryptedSeedRepository(str(directory), "student_private.pem", bus=InvalidationBus(bus_path))
+               for _ in range(2)]
+    workers[0].put_encrypted(1, encrypt_seed(hex_seed, load_public_key("student_public.pem")))
+    assert [worker.get(1).hex for worker in workers] == [hex_seed] * 2
+
+    replacement = os.urandom(32).hex()
+    workers[0].put_encrypted(1, encrypt_seed(replacement, load_public_key("student_public.pem")))
+    assert [worker.get(1).hex for worker in workers] == [replacement] * 2
+    assert workers[1].decrypts == 2
+
+    # A worker that missed a whole ring of messages drops everything
+    for user_id in range(InvalidationBus.RING):
+        workers[0].invalidate(user_id + 100)
+    assert workers[1].get(1).hex == replacement
+    assert workers[1].decrypts == 3
+    for worker in workers:
+        worker.bus.close()
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from seed_store import GROW_RECORDS, MAX_USER_ID, SeedStore, parse_user_id
+from totp_utils import TotpSeed
+
+
+def test_put_get_roundtrip(tmp_path):
+    path = str(tmp_path / "seeds.bin")
+    seeds = {user_id: os.urandom(32).hex() for user_id in (0, 1, 7, GROW_RECORDS + 3)}
+
+    with SeedStore(path, writable=True) as store:
+        for user_id, hex_seed in seeds.items():
+            store.put(user_id, hex_seed)
+        assert store.get(2) is None
+        assert store.get(10 * GROW_RECORDS) is None
+
+    with SeedStore(path) as store:
+        for user_id, hex_seed in seeds.items():
+            assert store.get(user_id).hex == hex_seed
+        assert list(store.user_ids()) == sorted(seeds)
+        assert os.path.getsize(path) < 40 * (GROW_RECORDS * 2)
+
+
+def test_reader_sees_growth_and_deletes(tmp_path):
+    path = str(tmp_path / "seeds.bin")
+    writer = SeedStore(path, writable=True)
+    reader = SeedStore(path)
+    seed = TotpSeed(os.urandom(32))
+
+    writer.put(5 * GROW_RECORDS, seed)
+    assert reader.get(5 * GROW_RECORDS).key == seed.key
+
+    writer.delete(5 * GROW_RECORDS)
+    assert reader.get(5 * GROW_RECORDS) is None
+
+    writer.close()
+    reader.close()
+
+
+def test_rejects_bad_input(tmp_path):
+    path = str(tmp_path / "seeds.bin")
+    with SeedStore(path, writable=True) as store:
+        with pytest.raises(ValueError):
+            store.put(-1, os.urandom(32).hex())
+        with pytest.raises(ValueError):
+            store.put(1, "nothex")
+
+    with SeedStore(path) as store:
+        with pytest.raises(ValueError):
+            store.put(1, os.urandom(32).hex())
+
+    with open(path, "r+b") as f:
+        f.write(b"NOTSEEDS")
+    with pytest.raises(ValueError):
+        SeedStore(path)
+
+
+def test_shared_slot_between_writers(tmp_path):
+    path = str(tmp_path / "shared.bin")
+    first = SeedStore(path, writable=True, capacity=1)
+    second = SeedStore(path, writable=True, capacity=1)
+    assert os.path.getsize(path) == 16 + 32
+    assert second.get_key(0) is None
+
+    seed = TotpSeed(os.urandom(32))
+    first.put(0, seed)
+    assert second.get_key(0) == seed.key
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+    first.close()
+    second.close()
+
+
+def test_new_store_is_private(tmp_path):
+    path = str(tmp_path / "seeds.bin")
+    with SeedStore(path, writable=True, capacity=4):
+        pass
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert os.listdir(tmp_path) == ["seeds.bin"]
+
+
+def test_parse_user_id_accepts_only_integers_and_digit_strings():
+    assert parse_user_id(None) is None
+    assert parse_user_id(7) == 7 and parse_user_id("0042") == 42 and parse_user_id(MAX_USER_ID) == MAX_USER_ID
+    for value in (5.7, True, "5.7", "-1", "", " 5", "٣", [5], {"id": 5}, -1, MAX_USER_ID + 1):
+        with pytest.raises(ValueError):
+            parse_user_id(value)
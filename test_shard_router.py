@@ -0,0 +1,214 @@
+import asyncio
+import json
+import os
+import socket
+from collections import Counter
+
+import pytest
+
+from hotp_store import CounterStore
+from seed_store import SeedStore
+from local_instance import spawn_instance
+from shard_router import HashRing, ShardRouter, rebalance, split
+from totp_utils import TotpSeed
+
+
+def test_ring_spreads_users_and_keeps_blocks_together():
+    ring = HashRing(["a", "b", "c"], block=1)
+    owners = Counter(ring.node_for(user_id) for user_id in range(30000))
+    assert set(owners) == {"a", "b", "c"}
+    assert min(owners.values()) > 30000 / 3 * 0.7
+
+    paged = HashRing(["a", "b", "c"], block=128)
+    assert len({paged.node_for(user_id) for user_id in range(128, 256)}) == 1
+    with pytest.raises(LookupError):
+        HashRing().node_for(1)
+
+
+def test_ring_changes_move_only_affected_users():
+    old = HashRing(["a", "b", "c"], block=1)
+    grown = HashRing(["a", "b", "c", "d"], block=1)
+    users = range(20000)
+
+    moved = [u for u in users if old.node_for(u) != grown.node_for(u)]
+    assert all(grown.node_for(u) == "d" for u in moved)
+    assert 0.15 < len(moved) / len(users) < 0.35
+
+    shrunk = HashRing(["a", "c"], block=1)
+    assert all(old.node_for(u) == "b" for u in users if old.node_for(u) != shrunk.node_for(u))
+
+
+def test_split_and_rebalance_stores(tmp_path):
+    seeds = {user_id: TotpSeed(os.urandom(32)) for user_id in range(0, 5000, 3)}
+    with SeedStore(str(tmp_path / "all.bin"), writable=True) as source:
+        for user_id, key in seeds.items():
+            source.put(user_id, key)
+
+        old = HashRing(["a", "b"], block=8)
+        stores = {name: SeedStore(str(tmp_path / f"{name}.bin"), writable=True) for name in "abc"}
+        written = split(source, old, {"a": stores["a"], "b": stores["b"]})
+    assert sum(written.values()) == len(seeds)
+
+    counters = {name: CounterStore(str(tmp_path / f"{name}.hotp"), writable=True) for name in "abc"}
+    counters[old.node_for(3)].compare_and_set(3, 0, 42)
+
+    new = HashRing(["a", "b", "c"], block=8)
+    moved = rebalance(old, new, stores, counters)
+    assert set(target for _, target in moved) == {"c"}
+    assert sum(moved.values()) == sum(1 for user_id in seeds if new.node_for(user_id) == "c")
+
+    for user_id, key in seeds.items():
+        owner = new.node_for(user_id)
+        assert stores[owner].get_key(user_id) == key.key
+        assert all(stores[name].get_key(user_id) is None for name in "abc" if name != owner)
+    assert counters[new.node_for(3)].get(3) == 42
+
+    for store in list(stores.values()) + list(counters.values()):
+        store.close()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _call(app, method, path, body=None, client="127.0.0.1", headers=()):
+    path, _, query = path.partition("?")
+    scope = {"type": "http", "method": method, "path": path, "query_string": query.encode(),
+             "headers": list(headers), "client": (client, 40000)}
+    content = json.dumps(body).encode() if body is not None else b""
+    messages = [{"type": "http.request", "body": content}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent[0]["status"], json.loads(sent[1]["body"])
+
+
+def test_router_admin_needs_loopback_or_token_and_allowed_shard_hosts():
+    router = ShardRouter({"a": "127.0.0.1:8001"})
+    new = {"shards": {"a": "127.0.0.1:8001", "b": "[::1]:8002"}}
+
+    async def scenario():
+        assert (await _call(router, "GET", "/router/status", client="10.0.0.7"))[0] == 403
+        assert (await _call(router, "POST", "/router/shards", new, client="10.0.0.7"))[0] == 403
+        for address in ("169.254.169.254:80", "10.0.0.2:8001", "127.0.0.1:0", "127.0.0.1:http", "127.0.0.1"):
+            status, body = await _call(router, "POST", "/router/shards", {"shards": {"a": address}})
+            assert status == 400, address
+        assert router.previous is None and router.addresses == {"a": "127.0.0.1:8001"}
+        assert (await _call(router, "POST", "/router/shards", new))[0] == 200
+
+        router.admin_token = "s3cret"
+        assert (await _call(router, "POST", "/router/migration/finish"))[0] == 403
+        status, body = await _call(router, "POST", "/router/migration/finish", client="10.0.0.7",
+                                   headers=[(b"x-admin-token", b"s3cret")])
+        assert status == 200 and body["migrating_from"] is None
+
+    asyncio.run(scenario())
+    with pytest.raises(ValueError):
+        ShardRouter({"a": "shard-a.internal:8001"})
+    assert ShardRouter({"a": "shard-a.internal:8001"}, allowed_hosts={"shard-a.internal"}).addresses
+
+
+def test_router_routes_like_the_shard_parses_and_forwards_admin_tokens():
+    class Recording(ShardRouter):
+        async def send_to(self, node, method, target, content=b"", headers=()):
+            sent.append((node, target, dict(headers)))
+            return 200, {"content-type": "application/json"}, b"{}"
+
+    sent = []
+    router = Recording({"a": "127.0.0.1:8001", "b": "127.0.0.1:8002"}, block=1)
+    ring = router.ring
+    first = next(u for u in range(1, 100) if ring.node_for(u) == "a")
+    last = next(u for u in range(1, 100) if ring.node_for(u) == "b")
+    encoded = next(u for u in range(10, 100) if ring.node_for(u) == "b")
+
+    async def scenario():
+        await _call(router, "GET", f"/generate-2fa?user_id={first}&user_id={last}")
+        await _call(router, "GET", "/generate-2fa?user_id=" + "".join(f"%{ord(c):02x}" for c in str(encoded)))
+        # A POST is routed by its body, as the shard reads it, not by the query string
+        await _call(router, "POST", f"/verify-2fa?user_id={first}", {"user_id": last, "code": "123456"})
+        await _call(router, "POST", "/seeds/cache/invalidate", {"user_id": last},
+                    headers=[(b"x-admin-token", b"s3cret"), (b"cookie", b"session=1")])
+
+    asyncio.run(scenario())
+    assert [node for node, _, _ in sent] == ["b", "b", "b", "b"]
+    assert sent[-1][2] == {"X-Forwarded-For": "127.0.0.1", "x-admin-token": "s3cret"}
+
+
+def test_router_forwards_to_owning_shards_and_migrates(tmp_path):
+    pytest.importorskip("uvicorn")
+    env = dict(os.environ, RATE_LIMIT="0", AUDIT_LOG="0", SNAPSHOT="0")
+    old = HashRing(["a", "b"], block=1)
+    new = HashRing(["a", "b", "c"], block=1)
+    users = list(range(1, 41))
+    moving = [u for u in users if new.node_for(u) == "c"]
+    assert moving and len({old.node_for(u) for u in users}) == 2
+
+    stores = {name: SeedStore(str(tmp_path / name / "seeds.bin"), writable=True) for name in "abc"}
+    for user_id in users:
+        stores[old.node_for(user_id)].put(user_id, TotpSeed(os.urandom(32)))
+    for store in stores.values():
+        store.flush()
+
+    ports = {name: _free_port() for name in "abc"}
+    processes = []
+    try:
+        for name in "ab":
+            processes.append(spawn_instance(str(tmp_path / name), ports[name], env=env))
+        router = ShardRouter({name: f"127.0.0.1:{ports[name]}" for name in "ab"}, block=1)
+
+        async def check_codes(targets):
+            for user_id in targets:
+                status, body = await _call(router, "GET", f"/generate-2fa?user_id={user_id}")
+                assert status == 200, body
+                status, body = await _call(router, "POST", "/verify-2fa",
+                                           {"user_id": user_id, "code": body["code"]})
+                assert status == 200 and body["valid"], body
+
+        async def scenario():
+            await check_codes(users[:10])
+            assert set(router.forwarded) == {"a", "b"}
+
+            items = []
+            for user_id in users[10:20]:
+                _, body = await _call(router, "GET", f"/generate-2fa?user_id={user_id}")
+                items.append({"user_id": user_id, "code": body["code"]})
+            items.append({"user_id": 999, "code": "000000"})
+            status, body = await _call(router, "POST", "/verify-2fa/batch", {"items": items})
+            assert status == 200
+            assert body["results"][:10] == [{"valid": True}] * 10
+            assert body["results"][10] == {"error": "Unknown user"}
+
+            # Route by the new ring before the seeds move: the old owner still answers
+            processes.append(spawn_instance(str(tmp_path / "c"), ports["c"], env=env))
+            status, _ = await _call(router, "POST", "/router/shards",
+                                    {"shards": {name: f"127.0.0.1:{port}" for name, port in ports.items()}})
+            assert status == 200
+            assert (await _call(router, "POST", "/router/shards", {"shards": {"a": "x:1"}}))[0] == 409
+            await check_codes([u for u in moving if u > 20][:3])
+            assert router.fallbacks > 0
+
+            rebalance(old, new, stores)
+            status, body = await _call(router, "POST", "/router/migration/finish")
+            assert status == 200 and body["migrating_from"] is None
+            fallbacks = router.fallbacks
+            await check_codes([u for u in moving if u > 20][3:] + [u for u in users[20:] if u not in moving][:3])
+            assert router.fallbacks == fallbacks
+            assert router.forwarded["c"] > 0
+            assert sum(pool.opened for pool in router.pools.values()) <= len(router.pools) * 2
+
+        asyncio.run(scenario())
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        for store in stores.values():
+            store.close()
@@ -0,0 +1,86 @@
+import os
+import time
+
+import pytest
+
+import snapshot
+from rate_limit import AttemptLimiter
+from totp_utils import DriftTable, MemoryReplayBackend
+
+
+def test_roundtrip_restores_state(tmp_path):
+    path = str(tmp_path / "state.snap")
+    drift = DriftTable(max_drift=4)
+    drift.restore([("7", 2), ("default", -1)])
+    limiter = AttemptLimiter(burst=5, max_failures=2, lockout_seconds=300)
+    limiter.allow("7", now=1000.0)
+    limiter.record("7", False, now=1000.0)
+    limiter.record("7", False, now=1000.0)
+    replay = MemoryReplayBackend()
+    replay.add(41152263, "7")
+    seed = os.urandom(32)
+
+    snapshot.write_snapshot(path, {
+        snapshot.SEED: seed,
+        snapshot.DRIFT: snapshot.encode_drift(drift.items()),
+        snapshot.LIMIT_USER: snapshot.encode_limiter(limiter.export(now=1010.0)),
+        snapshot.REPLAY: snapshot.encode_replay(replay.buckets()),
+        b"XTRA": b"from a newer version",
+    }, created=0.0)
+    assert oct(os.stat(path).st_mode & 0o777) == "0o600"
+
+    restored = {}
+    drift2 = DriftTable(max_drift=4)
+    limiter2 = AttemptLimiter(burst=5, max_failures=2, lockout_seconds=300)
+    replay2 = MemoryReplayBackend()
+
+    def restore_limiter(buf, elapsed):
+        # Pretend the restart took 30 seconds
+        limiter2.restore(snapshot.decode_limiter(buf), elapsed=30.0, now=5.0)
+
+    assert snapshot.load_snapshot(path, {
+        snapshot.SEED: lambda buf, elapsed: restored.setdefault("seed", bytes(buf)),
+        snapshot.DRIFT: lambda buf, elapsed: drift2.restore(snapshot.decode_drift(buf)),
+        snapshot.LIMIT_USER: restore_limiter,
+        snapshot.REPLAY: lambda buf, elapsed: replay2.restore(snapshot.decode_replay(buf)),
+    }) == 0.0
+
+    assert restored["seed"] == seed
+    assert sorted(drift2.items()) == [("7", 2), ("default", -1)]
+    # Still locked out for the remaining 300 - 10 - 30 seconds
+    assert not limiter2.allow("7", now=5.0 + 259)
+    assert limiter2.allow("7", now=5.0 + 261)
+    assert not replay2.add(41152263, "7")
+
+
+def test_missing_and_corrupt_snapshots(tmp_path):
+    path = tmp_path / "state.snap"
+    assert snapshot.load_snapshot(str(path), {}) is None
+    snapshot.write_snapshot(str(path), {snapshot.SEED: os.urandom(32)})
+    path.write_bytes(path.read_bytes()[:-5])
+    with pytest.raises(ValueError):
+        snapshot.load_snapshot(str(path), {})
+    path.write_bytes(b"not a snapshot at all, no")
+    with pytest.raises(ValueError):
+        snapshot.load_snapshot(str(path), {})
+
+
+def test_slot_paths_lists_every_worker_file(tmp_path):
+    path = str(tmp_path / "state.snap")
+    assert snapshot.slot_paths(path) == []
+    for slot in (0, 2, 10):
+        snapshot.write_snapshot(snapshot.slot_path(path, slot), {})
+    (tmp_path / "state.snap.bak").write_bytes(b"")
+    (tmp_path / "state.snap.01").write_bytes(b"")
+    assert snapshot.slot_paths(path) == [path, path + ".2", path + ".10"]
+
+
+def test_snapshot_older_than_max_age_is_ignored(tmp_path):
+    path = str(tmp_path / "state.snap")
+    snapshot.write_snapshot(path, {snapshot.SEED: b"x" * 32}, created=time.time() - 120)
+    seen = []
+    handlers = {snapshot.SEED: lambda buf, elapsed: seen.append(elapsed)}
+    assert snapshot.load_snapshot(path, handlers, max_age=60) is None
+    assert seen == []
+    assert snapshot.load_snapshot(path, handlers, max_age=600) is not None
+    assert len(seen) == 1 and seen[0] >= 120
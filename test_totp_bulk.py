@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+import pytest
+
+from totp_bulk import generate_totp_bulk, seeds_from_hex
+from totp_utils import TotpSeed, generate_totp_code
+
+
+def test_bulk_matches_single_codes():
+    hex_seeds = [os.urandom(32).hex() for _ in range(8)]
+    steps = np.array([0, 1, 41152263, 41152264, 2**33])
+    codes = generate_totp_bulk(seeds_from_hex(hex_seeds), steps)
+
+    assert codes.shape == (8, 5)
+    for n, hex_seed in enumerate(hex_seeds):
+        seed = TotpSeed.from_hex(hex_seed)
+        for m, step in enumerate(steps):
+            assert f"{codes[n, m]:06d}" == generate_totp_code(seed, for_time=int(step) * 30)[0]
+
+
+def test_bulk_pool_matches_in_process():
+    seeds = seeds_from_hex(os.urandom(32).hex() for _ in range(9))
+    steps = np.arange(100, 104)
+    assert np.array_equal(generate_totp_bulk(seeds, steps, workers=2), generate_totp_bulk(seeds, steps))
+
+
+def test_bulk_rejects_bad_input():
+    with pytest.raises(ValueError):
+        generate_totp_bulk(np.zeros((2, 16), dtype=np.uint8), [1])
+    with pytest.raises(ValueError):
+        generate_totp_bulk(np.zeros((2, 32), dtype=np.uint8), [-1])
+    with pytest.raises(ValueError):
+        seeds_from_hex(["zz" * 32])
@@ -0,0 +1,55 @@
+import io
+import os
+
+from seed_store import SeedStore
+from totp_stream import run
+from totp_utils import TotpSeed, generate_totp_code
+
+T = 1234567890
+
+
+def stream(mode, text, **kwargs):
+    out = io.BytesIO()
+    run(mode, io.BytesIO(text.encode()).readlines(), out, for_time=T, batch=2, **kwargs)
+    return out.getvalue().decode().splitlines()
+
+
+def test_generate_and_verify_inline_seeds():
+    seeds = [os.urandom(32).hex() for _ in range(5)]
+    codes = [generate_totp_code(seed, for_time=T)[0] for seed in seeds]
+    previous = generate_totp_code(seeds[0], for_time=T - 30)[0]
+
+    text = "\n".join(f"user{i} {seed}" for i, seed in enumerate(seeds)) + "\n\n# comment\nnothex\n"
+    assert stream("generate", text, resolve=TotpSeed.from_hex)[:5] == [
+        f"user{i} {code}" for i, code in enumerate(codes)]
+    assert stream("generate", text, resolve=TotpSeed.from_hex)[5].startswith("error ")
+
+    text = f"{seeds[0]} {codes[0]}\n{seeds[0]} {previous}\na {seeds[1]} {codes[0]}\n{seeds[1]} 12345\n"
+    lines = stream("verify", text, resolve=TotpSeed.from_hex)
+    assert lines[:3] == ["1", "1", "a 0"] and lines[3].startswith("error ")
+
+
+def test_verify_user_code_pairs_from_store(tmp_path):
+    path = str(tmp_path / "seeds.bin")
+    seed = TotpSeed(os.urandom(32))
+    with SeedStore(path, writable=True) as store:
+        store.put(3, seed)
+    code = generate_totp_code(seed, for_time=T)[0]
+
+    with SeedStore(path) as store:
+        def resolve(field):
+            found = store.get(int(field))
+            if found is None:
+                raise ValueError("Unknown user")
+            return found
+        assert stream("verify", f"3 {code}\n4 {code}\n", resolve=resolve) == ["1", "error Unknown user"]
+
+
+def test_invalid_utf8_line_becomes_an_error_record():
+    seed = os.urandom(32).hex()
+    code = generate_totp_code(seed, for_time=T)[0]
+    lines = [f"a {seed}\n".encode(), b"b \xff\xfe\n", b"\xff " + seed.encode() + b"\n", f"{seed}\n".encode()]
+    out = io.BytesIO()
+    assert run("generate", lines, out, resolve=TotpSeed.from_hex, for_time=T) == 4
+    assert out.getvalue().decode().splitlines() == [
+        f"a {code}", "b error Line is not valid UTF-8", f"� {code}", code]
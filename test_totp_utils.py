@@ -0,0 +1,159 @@
+import base64
+import datetime
+import os
+import random
+
+import pyotp
+import pytest
+
+from totp_utils import (DriftTable, FileReplayBackend, MemoryReplayBackend, ReplayGuard, TotpSeed,
+                        generate_totp_code, match_totp_step, verify_totp_batch, verify_totp_code)
+
+# Fixed sample of times: epoch edge, period boundaries and random points
+TIMES = [0, 29, 30, 59, 1111111109, 1234567890, 2000000000, 20000000000]
+TIMES += [random.Random(1).randrange(0, 2**34) for _ in range(200)]
+
+
+def reference_totp(hex_seed):
+    """pyotp TOTP built the way totp_utils used to build it."""
+    return pyotp.TOTP(base64.b32encode(bytes.fromhex(hex_seed)).decode("utf-8"))
+
+
+def random_seeds(count):
+    return [os.urandom(32).hex() for _ in range(count)]
+
+
+def test_generate_matches_pyotp():
+    for hex_seed in random_seeds(20):
+        seed = TotpSeed.from_hex(hex_seed)
+        reference = reference_totp(hex_seed)
+        for t in TIMES:
+            code, remaining = generate_totp_code(seed, for_time=t)
+            assert code == reference.at(t)
+            assert remaining == 30 - (t % 30)
+
+
+def test_verify_matches_pyotp():
+    for hex_seed in random_seeds(10):
+        seed = TotpSeed.from_hex(hex_seed)
+        reference = reference_totp(hex_seed)
+        for t in TIMES[4:40]:
+            when = datetime.datetime.fromtimestamp(t)
+            for offset in (-2, -1, 0, 1, 2):
+                code = reference.at(t, offset)
+                for window in (0, 1, 2):
+                    expected = reference.verify(code, for_time=when, valid_window=window)
+                    assert verify_totp_code(seed, code, window, for_time=t) == expected
+
+
+def test_hex_string_still_accepted():
+    hex_seed = random_seeds(1)[0]
+    code, _ = generate_totp_code(hex_seed, for_time=1234567890)
+    assert code == reference_totp(hex_seed).at(1234567890)
+    assert verify_totp_code(hex_seed, code, for_time=1234567890)
+
+
+def test_invalid_seeds_rejected():
+    for bad in ("ab" * 31, "zz" * 32, "0x" + "a" * 62, " " * 64):
+        with pytest.raises(ValueError):
+            TotpSeed.from_hex(bad)
+
+
+def test_invalid_code_rejected():
+    seed = TotpSeed.from_hex(random_seeds(1)[0])
+    for bad in ("12345", "abcdef", 123456, "1234567"):
+        with pytest.raises(ValueError):
+            verify_totp_code(seed, bad)
+
+
+def test_code_window_cached_per_period():
+    seed = TotpSeed.from_hex(random_seeds(1)[0])
+    t = 1234567890 - (1234567890 % 30)
+    code, _ = generate_totp_code(seed, for_time=t)
+    window = seed.window(t // 30)
+    assert window.current == code
+    assert verify_totp_code(seed, code, for_time=t + 29)
+    assert seed.window(t // 30) is window
+
+    assert verify_totp_code(seed, code, for_time=t + 30)
+    assert seed.window((t + 30) // 30) is not window
+    assert not verify_totp_code(seed, code, for_time=t + 60)
+
+
+def test_batch_matches_single_verify():
+    seeds = [TotpSeed.from_hex(hex_seed) for hex_seed in random_seeds(5)]
+    t = 1234567890
+    pairs = []
+    for seed in seeds:
+        pairs.append((seed.key, generate_totp_code(seed, for_time=t)[0]))
+        pairs.append((seed.key, generate_totp_code(seed, for_time=t - 60)[0]))
+        pairs.append((seed.key, "000000"))
+    expected = [verify_totp_code(TotpSeed(key), code, for_time=t) for key, code in pairs]
+    assert verify_totp_batch(pairs, for_time=t) == expected
+    assert expected[0] and not expected[1]
+
+
+def test_match_step_reports_matched_period():
+    seed = TotpSeed.from_hex(random_seeds(1)[0])
+    t = 1234567890
+    previous, _ = generate_totp_code(seed, for_time=t - 30)
+    assert match_totp_step(seed, previous, for_time=t) == t // 30 - 1
+    assert match_totp_step(seed, "000000" if previous != "000000" else "111111", for_time=t) is None
+
+
+def test_drift_table_follows_skewed_clock():
+    seed = TotpSeed.from_hex(random_seeds(1)[0])
+    table = DriftTable(valid_window=1, max_drift=3)
+    t = 1234567890
+    step = t // 30
+
+    # Device runs ahead by one step per login; the offset follows up to max_drift
+    for skew in (1, 2, 3):
+        code, _ = generate_totp_code(seed, for_time=t + 30 * skew)
+        assert table.match("alice", seed, code, for_time=t) == step + skew
+        assert table.offset("alice") == skew
+    code, _ = generate_totp_code(seed, for_time=t + 30 * 4)
+    assert table.match("alice", seed, code, for_time=t) is None
+
+    # The learned offset is tried first, and an on-time code still verifies
+    first_try = table.first_try
+    code, _ = generate_totp_code(seed, for_time=t + 90)
+    assert table.match("alice", TotpSeed(seed.key), code, for_time=t) == step + 3
+    assert table.first_try == first_try + 1
+    code, _ = generate_totp_code(seed, for_time=t)
+    assert table.match("alice", seed, code, for_time=t) == step
+    assert table.offset("alice") == 0
+
+    # A user that has never drifted can't jump straight to a far offset
+    code, _ = generate_totp_code(seed, for_time=t + 60)
+    assert table.match("bob", seed, code, for_time=t) is None
+    assert table.stats()["drifting_users"] == 0
+
+
+@pytest.mark.parametrize("make_backend", [lambda tmp: MemoryReplayBackend(),
+                                          lambda tmp: FileReplayBackend(str(tmp / "replay"))])
+def test_replay_guard_rejects_reuse_and_evicts(tmp_path, make_backend):
+    backend = make_backend(tmp_path)
+    guard = ReplayGuard(backend, valid_window=1)
+    t = 1234567890
+    step = t // 30
+
+    assert guard.accept("alice", step, for_time=t)
+    assert not guard.accept("alice", step, for_time=t)
+    assert guard.accept("bob", step, for_time=t)
+    assert guard.accept("alice", step + 1, for_time=t)
+
+    # Once `step` can no longer verify its bucket is dropped as a whole
+    guard.accept("carol", step + 2, for_time=t + 60)
+    if isinstance(backend, MemoryReplayBackend):
+        assert len(backend) == 2
+    else:
+        assert sorted(os.listdir(backend.directory)) == [str(step + 1), str(step + 2)]
+
+
+@pytest.mark.parametrize("user", ["..", "../escape", "a/b", ".hidden", "", "x" * 200, "seed\0"])
+def test_file_replay_backend_rejects_unsafe_keys(tmp_path, user):
+    backend = FileReplayBackend(str(tmp_path / "replay"))
+    with pytest.raises(ValueError):
+        backend.add(1, user)
+    assert os.listdir(backend.directory) == []
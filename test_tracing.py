@@ -0,0 +1,47 @@
+import asyncio
+import os
+import time
+
+from totp_utils import generate_totp_code
+from tracing import ServerTimingMiddleware
+
+
+async def totp_app(scope, receive, send):
+    generate_totp_code(os.urandom(32).hex())
+    if scope["path"] == "/slow":
+        time.sleep(0.05)
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+def call(app, path):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app({"type": "http", "path": path}, receive, send))
+    return dict(messages[0]["headers"])
+
+
+def test_server_timing_lists_stages():
+    app = ServerTimingMiddleware(totp_app, endpoints=["/generate"])
+    header = call(app, "/generate")[b"server-timing"].decode()
+    names = [part.split(";")[0] for part in header.split(", ")]
+    assert names[:2] == ["seed_parse", "hmac_window"] and names[-1] == "total"
+    assert b"server-timing" not in call(app, "/other")
+
+
+def test_profiles_every_nth_and_slow_requests(tmp_path):
+    app = ServerTimingMiddleware(totp_app, header=False, profile_every=2, profile_slow=0.01,
+                                 profile_dir=str(tmp_path))
+    for path in ("/fast", "/fast", "/slow"):
+        assert b"server-timing" not in call(app, path)
+
+    files = sorted(os.listdir(tmp_path))
+    assert [name.rsplit(".", 1)[1] for name in files] == ["prof", "folded"]
+    folded = (tmp_path / files[1]).read_text()
+    assert "test_tracing.py:totp_app" in folded
@@ -0,0 +1,137 @@
+import argparse
+import hmac
+import sys
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+
+from totp_utils import COUNTER, TOTP_PERIOD, TotpSeed
+
+
+def seeds_from_hex(hex_seeds: Iterable[str]) -> np.ndarray:
+    """
+    Build an (N, 32) uint8 seed matrix from hex seed strings.
+
+    Raises:
+        ValueError: If any seed is invalid.
+    """
+    keys = [TotpSeed.from_hex(hex_seed.strip()).key for hex_seed in hex_seeds]
+    return np.frombuffer(b"".join(keys), dtype=np.uint8).reshape(len(keys), 32)
+
+
+def _hmac_stage(seeds: np.ndarray, steps: np.ndarray) -> np.ndarray:
+    """HMAC-SHA1 of every (seed, step) pair as an (N, M, 20) uint8 array."""
+    counters = [COUNTER.pack(int(step)) for step in steps]
+    digests = b"".join(
+        hmac.digest(key, counter, "sha1")
+        for key in (row.tobytes() for row in seeds)
+        for counter in counters
+    )
+    return np.frombuffer(digests, dtype=np.uint8).reshape(len(seeds), len(counters), 20)
+
+
+def _truncate(digests: np.ndarray) -> np.ndarray:
+    """RFC 4226 dynamic truncation over a (..., 20) digest array."""
+    offsets = (digests[..., 19] & 0x0F)[..., None] + np.arange(4)
+    b = np.take_along_axis(digests, offsets, axis=-1).astype(np.uint32)
+    value = ((b[..., 0] & 0x7F) << 24) | (b[..., 1] << 16) | (b[..., 2] << 8) | b[..., 3]
+    return value % 1000000
+
+
+def _generate_rows(seeds: np.ndarray, steps: np.ndarray) -> np.ndarray:
+    return _truncate(_hmac_stage(seeds, steps))
+
+
+def generate_totp_bulk(seeds: np.ndarray, steps: np.ndarray, workers: Optional[int] = None,
+                       executor: Optional[Executor] = None) -> np.ndarray:
+    """
+    Generate TOTP codes for every seed at every time step.
+
+    Args:
+        seeds: (N, 32) uint8 seed matrix (see seeds_from_hex).
+        steps: Length-M vector of TOTP time steps (unix time // 30).
+        workers: Split the seed rows across this many processes (default: in-process).
+        executor: Pool to run the splits on; a temporary process pool is used if omitted.
+
+    Returns:
+        (N, M) uint32 array of codes; format with "%06d".
+
+    Raises:
+        ValueError: If the inputs have the wrong shape or negative steps.
+    """
+    seeds = np.ascontiguousarray(seeds, dtype=np.uint8)
+    steps = np.asarray(steps, dtype=np.int64).ravel()
+    if seeds.ndim != 2 or seeds.shape[1] != 32:
+        raise ValueError(f"Seed matrix must be (N, 32), got {seeds.shape}")
+    if steps.size and steps.min() < 0:
+        raise ValueError("Time steps must be non-negative")
+
+    if not workers or workers < 2 or len(seeds) < 2 * workers:
+        return _generate_rows(seeds, steps)
+
+    rows = -(-len(seeds) // workers)
+    slices = [seeds[start:start + rows] for start in range(0, len(seeds), rows)]
+    if executor is not None:
+        return np.concatenate(list(executor.map(_generate_rows, slices, [steps] * len(slices))))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return np.concatenate(list(pool.map(_generate_rows, slices, [steps] * len(slices))))
+
+
+def _read_seed_chunks(lines: Iterable[str], chunk_size: int) -> Iterator[np.ndarray]:
+    chunk = []
+    for line in lines:
+        if line.strip():
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                yield seeds_from_hex(chunk)
+                chunk = []
+    if chunk:
+        yield seeds_from_hex(chunk)
+
+
+def main(argv=None):
+    """python -m totp_utils bulk - codes for many seeds across many time steps"""
+    parser = argparse.ArgumentParser(
+        prog="python -m totp_utils bulk",
+        description="Generate TOTP codes for hex seeds (one per line) across consecutive time steps.")
+    parser.add_argument("--seeds", default="-", help="Seed file, one hex seed per line (default: stdin)")
+    parser.add_argument("--start", type=int, default=None,
+                        help="Unix time of the first step (default: now)")
+    parser.add_argument("--steps", type=int, default=1, help="Number of consecutive time steps")
+    parser.add_argument("--format", choices=("csv", "bin"), default="csv",
+                        help="csv: one row of codes per seed; bin: raw little-endian uint32 (N, M) rows")
+    parser.add_argument("--chunk", type=int, default=4096, help="Seeds processed per chunk")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes per chunk")
+    args = parser.parse_args(argv)
+
+    start = int(time.time()) if args.start is None else args.start
+    steps = np.arange(args.steps, dtype=np.int64) + start // TOTP_PERIOD
+
+    source = sys.stdin if args.seeds == "-" else open(args.seeds, "r")
+    out = sys.stdout.buffer
+    pool = ProcessPoolExecutor(max_workers=args.workers) if args.workers and args.workers > 1 else None
+    try:
+        if args.format == "csv":
+            out.write(("step," + ",".join(str(step) for step in steps) + "\n").encode())
+        index = 0
+        for seeds in _read_seed_chunks(source, args.chunk):
+            codes = generate_totp_bulk(seeds, steps, workers=args.workers, executor=pool)
+            if args.format == "bin":
+                out.write(codes.astype("<u4").tobytes())
+            else:
+                rows = [f"{index + i}," + ",".join(f"{code:06d}" for code in row)
+                        for i, row in enumerate(codes.tolist())]
+                out.write(("\n".join(rows) + "\n").encode())
+            index += len(seeds)
+            out.flush()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if source is not sys.stdin:
+            source.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import argparse
+import os
+import sys
+import time
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from crypto_utils import decrypt_seed, get_private_key
+from seed_store import SeedStore
+from totp_utils import TOTP_PERIOD, TotpSeed, check_code, hotp, totp_counter
+
+
+def _records(lines: Iterable[bytes], fields: int) -> Iterator[tuple]:
+    """
+    Split input lines into (tag, raw values), where tag is an optional
+    leading field echoed back on the output line (None if absent). Values
+    stay bytes: each mode decodes them with _fields inside its per-line
+    error handling, so one bad line can't end the stream.
+    """
+    for line in lines:
+        parts = line.split()
+        if not parts or parts[0].startswith(b"#"):
+            continue
+        if len(parts) == fields + 1:
+            yield parts[0].decode(errors="replace"), parts[1:]
+        else:
+            yield None, parts
+
+
+def _fields(values: List[bytes], count: int, message: str) -> List[str]:
+    """Decode one record's values, raising ValueError(message) unless there are `count` of them."""
+    if len(values) != count:
+        raise ValueError(message)
+    try:
+        return [value.decode() for value in values]
+    except UnicodeDecodeError:
+        raise ValueError("Line is not valid UTF-8") from None
+
+
+def _generate(records, resolve: Callable[[str], TotpSeed], counter_of: Callable[[], int]) -> Iterator[str]:
+    for tag, values in records:
+        try:
+            seed_field, = _fields(values, 1, "Expected one seed per line")
+            result = hotp(resolve(seed_field).key, counter_of())
+        except Exception as e:
+            result = f"error {e}"
+        yield result if tag is None else f"{tag} {result}"
+
+
+def _verify(records, resolve: Callable[[str], TotpSeed], counter_of: Callable[[], int],
+            valid_window: int) -> Iterator[str]:
+    # Nearest steps first, so an on-time code costs a single HMAC
+    offsets = sorted(range(-valid_window, valid_window + 1), key=abs)
+    for tag, values in records:
+        try:
+            seed_field, code = _fields(values, 2, "Expected a seed and a code per line")
+            check_code(code)
+            key = resolve(seed_field).key
+            counter = counter_of()
+            result = "1" if any(hotp(key, counter + offset) == code
+                                for offset in offsets if counter + offset >= 0) else "0"
+        except Exception as e:
+            result = f"error {e}"
+        yield result if tag is None else f"{tag} {result}"
+
+
+def _decrypt(records, private_key) -> Iterator[str]:
+    for tag, values in records:
+        try:
+            encrypted, = _fields(values, 1, "Expected one encrypted seed per line")
+            result = decrypt_seed(encrypted, private_key)
+        except Exception as e:
+            result = f"error {e}"
+        yield result if tag is None else f"{tag} {result}"
+
+
+def _batches(outputs: Iterator[str], size: int) -> Iterator[List[str]]:
+    while True:
+        batch = list(islice(outputs, size))
+        if not batch:
+            return
+        yield batch
+
+
+def run(mode: str, lines: Iterable[bytes], out, resolve=None, private_key=None,
+        for_time: Optional[float] = None, valid_window: int = 1, batch: int = 1024) -> int:
+    """
+    Stream `lines` through `mode` ("generate", "verify" or "decrypt") into
+    the binary file `out`, writing and flushing every `batch` lines.
+
+    Memory is bounded by one batch whatever the input size. Without
+    `for_time` the time step follows the wall clock as the stream runs.
+
+    Returns:
+        Number of output lines.
+    """
+    if for_time is not None:
+        fixed = totp_counter(for_time)
+
+        def counter_of():
+            return fixed
+    else:
+        # Re-read the clock at most once per second rather than per line
+        state = [0.0, 0]
+
+        def counter_of():
+            now = time.monotonic()
+            if now - state[0] >= 1.0:
+                state[0] = now
+                state[1] = int(time.time()) // TOTP_PERIOD
+            return state[1]
+
+    if mode == "generate":
+        outputs = _generate(_records(lines, 1), resolve, counter_of)
+    elif mode == "verify":
+        outputs = _verify(_records(lines, 2), resolve, counter_of, valid_window)
+    elif mode == "decrypt":
+        outputs = _decrypt(_records(lines, 1), private_key)
+    else:
+        raise ValueError(f"Unknown mode: {mode}")
+
+    count = 0
+    for chunk in _batches(outputs, batch):
+        out.write(("\n".join(chunk) + "\n").encode())
+        out.flush()
+        count += len(chunk)
+    return count
+
+
+def main(argv=None):
+    """python -m totp_utils stream - line-by-line codes, verification or decryption"""
+    parser = argparse.ArgumentParser(
+        prog="python -m totp_utils stream",
+        description="Read seeds (or user IDs / encrypted seeds) line by line from stdin and write "
+                    "one result line per input line to stdout. An optional leading tag field "
+                    "(e.g. a user name) is echoed back; failed lines come out as '[tag] error <reason>'.")
+    parser.add_argument("mode", choices=("generate", "verify", "decrypt"),
+                        help="generate: '[tag] SEED' -> '[tag] CODE'; verify: '[tag] SEED CODE' -> "
+                             "'[tag] 1|0'; decrypt: '[tag] BASE64' -> '[tag] HEX_SEED'")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--store", help="SEED fields are user IDs looked up in this seed store")
+    source.add_argument("--encrypted", action="store_true",
+                        help="SEED fields are base64 RSA-encrypted seeds (as in encrypted_seed.txt)")
+    parser.add_argument("--private-key", default="student_private.pem",
+                        help="Key for --encrypted and decrypt (loaded once)")
+    parser.add_argument("--time", type=float, default=None, help="Unix time to use (default: now)")
+    parser.add_argument("--window", type=int, default=1, help="Steps either side accepted by verify")
+    parser.add_argument("--batch", type=int, default=1024,
+                        help="Lines per write+flush (use 1 when driving it as an interactive co-process)")
+    args = parser.parse_args(argv)
+
+    store = None
+    private_key = None
+    if args.mode == "decrypt" or args.encrypted:
+        private_key = get_private_key(args.private_key)
+
+    if args.store:
+        store = SeedStore(args.store)
+
+        def resolve(field):
+            seed = store.get(int(field))
+            if seed is None:
+                raise ValueError("Unknown user")
+            return seed
+    elif args.encrypted:
+        def resolve(field):
+            return TotpSeed.from_hex(decrypt_seed(field, private_key))
+    else:
+        resolve = TotpSeed.from_hex
+
+    try:
+        run(args.mode, sys.stdin.buffer, sys.stdout.buffer, resolve=resolve, private_key=private_key,
+            for_time=args.time, valid_window=args.window, batch=max(1, args.batch))
+    except BrokenPipeError:
+        # Downstream (e.g. `head`) stopped reading; not an error for a filter.
+        # Point stdout at /dev/null so the interpreter's final flush doesn't fail too.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        if store is not None:
+            store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,64 +1,227 @@
+import os
+import re
+import sys
 import time
-import base64
-from typing import Tuple
-
-import pyotp
+import hmac
+import shutil
+import struct
+import threading
+from collections import deque
+from typing import Hashable, Iterable, List, Optional, Tuple, Union
 
 from crypto_utils import load_private_key, decrypt_seed
+from metrics import CACHE_EVENTS, ERRORS, STAGE_SECONDS, perf_counter
+
+TOTP_PERIOD = 30
+TOTP_DIGITS = 6
+DEFAULT_WINDOW = 1
+
+# Furthest a learned clock offset may move a user's window, in time steps
+DEFAULT_MAX_DRIFT = 4
+
+# HOTP counters past the expected one a token may have been pressed ahead
+DEFAULT_LOOK_AHEAD = 20
 
+# HOTP moving factor: the counter as an 8-byte big-endian integer (RFC 4226)
+COUNTER = struct.Struct(">Q")
 
-def generate_totp_code(hex_seed: str) -> Tuple[str, int]:
+# What FileReplayBackend accepts as a user key (it becomes a file name)
+_REPLAY_FILE_NAME = re.compile(r"[A-Za-z0-9_-]{1,128}")
+
+_seed_parse_timer = STAGE_SECONDS.labels("seed_parse")
+_hmac_timer = STAGE_SECONDS.labels("hmac_window")
+_drift_timer = STAGE_SECONDS.labels("hmac_drift")
+_window_hits = CACHE_EVENTS.labels("code_window", "hit")
+_window_misses = CACHE_EVENTS.labels("code_window", "miss")
+_generate_errors = ERRORS.labels("generate_totp")
+_verify_errors = ERRORS.labels("verify_totp")
+
+
+class CodeWindow:
     """
-    Generate current TOTP code from hex seed.
+    Codes for time steps counter-valid_window .. counter+valid_window.
 
-    Args:
-        hex_seed: 64-character hex string.
+    Built once per period; verification is then a set lookup and
+    generation a tuple read.
+    """
 
-    Returns:
-        Tuple of (6-digit code, remaining seconds valid).
+    __slots__ = ("counter", "valid_window", "codes", "accepted")
 
-    Raises:
-        ValueError: If seed is invalid or generation fails.
+    def __init__(self, key: bytes, counter: int, valid_window: int):
+        started = perf_counter()
+        self.counter = counter
+        self.valid_window = valid_window
+        self.codes = tuple(
+            hotp(key, step) if step >= 0 else None
+            for step in range(counter - valid_window, counter + valid_window + 1)
+        )
+        self.accepted = frozenset(code for code in self.codes if code is not None)
+        _hmac_timer.observe(perf_counter() - started)
+
+    @property
+    def current(self) -> str:
+        return self.codes[self.valid_window]
+
+    def step_of(self, code: str) -> Optional[int]:
+        """Time step that `code` belongs to in this window, or None."""
+        if code not in self.accepted:
+            return None
+        return self.counter - self.valid_window + self.codes.index(code)
+
+
+class TotpSeed:
     """
-    try:
-        # Step 1: Validate hex seed
+    Parsed, validated TOTP seed.
+
+    The hex seed is checked and converted to raw key bytes once, so the
+    generate/verify paths go straight to HMAC-SHA1 without any hex or
+    base32 round trips. The codes around the current period are cached
+    on the handle (see `window`).
+    """
+
+    __slots__ = ("key", "_window")
+
+    def __init__(self, key: bytes):
+        if len(key) != 32:
+            raise ValueError(f"Invalid seed length: {len(key)} bytes (expected 32)")
+        self.key = bytes(key)
+        self._window = None
+
+    @classmethod
+    def from_hex(cls, hex_seed: str) -> "TotpSeed":
+        """
+        Parse a 64-character hex seed.
+
+        Raises:
+            ValueError: If the seed has the wrong length or non-hex characters.
+        """
+        started = perf_counter()
         if len(hex_seed) != 64:
             raise ValueError(f"Invalid seed length: {len(hex_seed)} (expected 64)")
-
         try:
-            int(hex_seed, 16)
+            key = bytes.fromhex(hex_seed)
         except ValueError:
             raise ValueError("Seed contains non-hex characters")
+        if len(key) != 32:
+            raise ValueError("Seed contains non-hex characters")
+        seed = cls(key)
+        _seed_parse_timer.observe(perf_counter() - started)
+        return seed
+
+    @property
+    def hex(self) -> str:
+        return self.key.hex()
+
+    def code_at(self, step: int) -> str:
+        """Code for one time step, read from the cached window when it covers `step`."""
+        window = self._window
+        if window is not None and abs(step - window.counter) <= window.valid_window:
+            return window.codes[step - window.counter + window.valid_window]
+        return hotp(self.key, step)
+
+    def window(self, counter: int, valid_window: int = DEFAULT_WINDOW) -> CodeWindow:
+        """
+        Return the code window for `counter`, rebuilding it only when the
+        period (or window size) changed since the last call.
+        """
+        window = self._window
+        if window is None or window.counter != counter or window.valid_window != valid_window:
+            _window_misses.inc()
+            # Built fully before publishing, so concurrent readers only ever
+            # see a complete window.
+            window = CodeWindow(self.key, counter, valid_window)
+            self._window = window
+        else:
+            _window_hits.inc()
+        return window
+
+    def __repr__(self):
+        return "TotpSeed(<redacted>)"
+
+
+SeedLike = Union[TotpSeed, str]
+
+
+def as_seed(seed: SeedLike) -> TotpSeed:
+    """Return `seed` as a TotpSeed, parsing it if a hex string was given."""
+    if isinstance(seed, TotpSeed):
+        return seed
+    return TotpSeed.from_hex(seed)
+
+
+def hotp(key: bytes, counter: int) -> str:
+    """
+    RFC 4226 HOTP value for `counter` (HMAC-SHA1, dynamic truncation).
 
-        # Step 2: Convert hex seed to bytes
-        seed_bytes = bytes.fromhex(hex_seed)
+    Args:
+        key: Raw secret bytes.
+        counter: Non-negative moving factor.
+
+    Returns:
+        Zero-padded 6-digit code.
+    """
+    digest = hmac.digest(key, COUNTER.pack(counter), "sha1")
+    offset = digest[19] & 0x0F
+    value = int.from_bytes(digest[offset:offset + 4], "big") & 0x7FFFFFFF
+    return f"{value % 1000000:06d}"
+
+
+def check_code(code: str):
+    """
+    Raises:
+        ValueError: If `code` is not a 6-digit string.
+    """
+    if not isinstance(code, str) or len(code) != 6 or not code.isdigit():
+        raise ValueError("Code must be 6 digits")
 
-        # Step 3: Convert bytes to base32 encoding (PyOTP expects base32 secret)
-        base32_seed = base64.b32encode(seed_bytes).decode("utf-8")
 
-        # Step 4: Create TOTP object with base32 seed
-        totp = pyotp.TOTP(base32_seed)
+def totp_counter(for_time: Optional[float] = None) -> int:
+    """Return the TOTP time step for `for_time` (defaults to now)."""
+    if for_time is None:
+        for_time = time.time()
+    return int(for_time) // TOTP_PERIOD
+
+
+def generate_totp_code(seed: SeedLike, for_time: Optional[float] = None) -> Tuple[str, int]:
+    """
+    Generate current TOTP code from a seed.
+
+    Args:
+        seed: TotpSeed handle or 64-character hex string.
+        for_time: Unix timestamp to generate for (defaults to now).
+
+    Returns:
+        Tuple of (6-digit code, remaining seconds valid).
 
-        # Step 5: Generate current TOTP code
-        code = totp.now()
+    Raises:
+        ValueError: If seed is invalid or generation fails.
+    """
+    try:
+        seed = as_seed(seed)
+        if for_time is None:
+            for_time = time.time()
+        now = int(for_time)
 
-        # Step 6: Calculate remaining seconds in current period
-        remaining_seconds = 30 - (int(time.time()) % 30)
+        code = seed.window(now // TOTP_PERIOD).current
+        remaining_seconds = TOTP_PERIOD - (now % TOTP_PERIOD)
 
         return code, remaining_seconds
 
     except Exception as e:
+        _generate_errors.inc()
         raise ValueError(f"TOTP generation failed: {e}")
 
 
-def verify_totp_code(hex_seed: str, code: str, valid_window: int = 1) -> bool:
+def verify_totp_code(seed: SeedLike, code: str, valid_window: int = 1,
+                     for_time: Optional[float] = None) -> bool:
     """
     Verify TOTP code with time window tolerance.
 
     Args:
-        hex_seed: 64-character hex string.
+        seed: TotpSeed handle or 64-character hex string.
         code: 6-digit code to verify.
         valid_window: Number of periods before/after to accept (default 1 = ±30 seconds).
+        for_time: Unix timestamp to verify against (defaults to now).
 
     Returns:
         True if code is valid, False otherwise.
@@ -67,30 +230,388 @@ def verify_totp_code(hex_seed: str, code: str, valid_window: int = 1) -> bool:
         ValueError: If seed or code is invalid or verification fails.
     """
     try:
-        # Validate inputs
-        if len(hex_seed) != 64:
-            raise ValueError("Invalid seed length")
+        seed = as_seed(seed)
+        check_code(code)
+
+        return code in seed.window(totp_counter(for_time), valid_window).accepted
 
-        if not isinstance(code, str) or len(code) != 6 or not code.isdigit():
-            raise ValueError("Code must be 6 digits")
+    except Exception as e:
+        _verify_errors.inc()
+        raise ValueError(f"TOTP verification failed: {e}")
 
-        # Step 1: Convert hex seed to base32 (same as generation)
-        seed_bytes = bytes.fromhex(hex_seed)
-        base32_seed = base64.b32encode(seed_bytes).decode("utf-8")
 
-        # Step 2: Create TOTP object
-        totp = pyotp.TOTP(base32_seed)
+def match_totp_step(seed: SeedLike, code: str, valid_window: int = 1,
+                    for_time: Optional[float] = None) -> Optional[int]:
+    """
+    Like verify_totp_code, but return the matched time step (None if invalid).
+
+    The step is what replay protection records: a code is only usable once
+    per step.
 
-        # Step 3: Verify code with time window tolerance
-        is_valid = totp.verify(code, valid_window=valid_window)
+    Raises:
+        ValueError: If seed or code is invalid.
+    """
+    try:
+        seed = as_seed(seed)
+        check_code(code)
 
-        return is_valid
+        return seed.window(totp_counter(for_time), valid_window).step_of(code)
 
     except Exception as e:
+        _verify_errors.inc()
         raise ValueError(f"TOTP verification failed: {e}")
 
 
+def match_totp_batch(pairs: Iterable[Tuple[bytes, str]], valid_window: int = 1,
+                     for_time: Optional[float] = None) -> List[Optional[int]]:
+    """
+    Match many (key, code) pairs against one time step.
+
+    The period is computed once for the whole batch and each distinct key's
+    code window is built once, however often it repeats. Keys are raw seed
+    bytes and codes are expected to be pre-validated 6-digit strings, so the
+    arguments pickle cheaply when a batch is split across processes.
+
+    Returns:
+        Matched time step (or None) per pair, in input order.
+    """
+    counter = totp_counter(for_time)
+    windows = {}
+    results = []
+    for key, code in pairs:
+        window = windows.get(key)
+        if window is None:
+            window = windows[key] = CodeWindow(key, counter, valid_window)
+        results.append(window.step_of(code))
+    return results
+
+
+def verify_totp_batch(pairs: Iterable[Tuple[bytes, str]], valid_window: int = 1,
+                      for_time: Optional[float] = None) -> List[bool]:
+    """
+    Verify many (key, code) pairs against one time step (see match_totp_batch).
+
+    Returns:
+        One bool per pair, in input order.
+    """
+    return [step is not None for step in match_totp_batch(pairs, valid_window, for_time)]
+
+
+def generate_hotp_code(seed: SeedLike, counter: int) -> str:
+    """
+    Generate the HOTP code for `counter`.
+
+    Raises:
+        ValueError: If the seed or counter is invalid.
+    """
+    try:
+        seed = as_seed(seed)
+        if counter < 0:
+            raise ValueError(f"Invalid counter: {counter}")
+        return hotp(seed.key, counter)
+
+    except Exception as e:
+        _generate_errors.inc()
+        raise ValueError(f"HOTP generation failed: {e}")
+
+
+class HotpWindow:
+    """
+    Lookup table of HOTP codes for counters start .. start+look_ahead.
+
+    Resynchronization is then one dict lookup however far ahead the token
+    is. Advancing the window only computes the counters that came into
+    range, so a token used in order costs one HMAC per verify.
+    """
+
+    __slots__ = ("key", "start", "look_ahead", "codes", "lookup")
+
+    def __init__(self, key: bytes, start: int, look_ahead: int = DEFAULT_LOOK_AHEAD):
+        started = perf_counter()
+        self.key = key
+        self.start = start
+        self.look_ahead = look_ahead
+        self.codes = deque(hotp(key, counter) for counter in range(start, start + look_ahead + 1))
+        self.lookup = {}
+        for counter, code in enumerate(self.codes, start):
+            self.lookup.setdefault(code, counter)
+        _hmac_timer.observe(perf_counter() - started)
+
+    def match(self, code: str) -> Optional[int]:
+        """Lowest counter in the window whose code is `code`, or None."""
+        return self.lookup.get(code)
+
+    def advance(self, start: int):
+        """Slide the window forward to begin at `start`."""
+        if start <= self.start:
+            return
+        end = self.start + self.look_ahead
+        if start > end:
+            self.__init__(self.key, start, self.look_ahead)
+            return
+        rebuild = False
+        for counter in range(self.start, start):
+            code = self.codes.popleft()
+            if self.lookup.get(code) == counter:
+                del self.lookup[code]
+                # Same code again further on (a 1e-6 chance per pair)
+                rebuild = rebuild or code in self.codes
+        self.start = start
+        for counter in range(end + 1, start + self.look_ahead + 1):
+            code = hotp(self.key, counter)
+            self.codes.append(code)
+            self.lookup.setdefault(code, counter)
+        if rebuild:
+            self.lookup = {}
+            for counter, code in enumerate(self.codes, start):
+                self.lookup.setdefault(code, counter)
+
+
+def verify_hotp_code(seed: SeedLike, code: str, counter: int,
+                     look_ahead: int = DEFAULT_LOOK_AHEAD) -> Optional[int]:
+    """
+    Find `code` among counters counter .. counter+look_ahead.
+
+    Returns:
+        The matched counter (the caller stores matched + 1), or None.
+
+    Raises:
+        ValueError: If seed, code or counter is invalid.
+    """
+    try:
+        seed = as_seed(seed)
+        check_code(code)
+        if counter < 0:
+            raise ValueError(f"Invalid counter: {counter}")
+        return HotpWindow(seed.key, counter, look_ahead).match(code)
+
+    except Exception as e:
+        _verify_errors.inc()
+        raise ValueError(f"HOTP verification failed: {e}")
+
+
+class DriftTable:
+    """
+    Learned clock offset, in time steps, per user.
+
+    Each successful match records the step offset the client's code was
+    found at. The next verify for that user tries the learned offset first
+    and then walks outward, covering ±valid_window around the learned offset
+    and around the real time step, so a device that fixed its clock is never
+    rejected. An offset can move by at most valid_window per success and
+    never beyond ±max_drift.
+
+    Only users with a non-zero offset are stored, so the table stays small.
+    Once it holds `max_users` entries new offsets are not learned (counted
+    as `overflow`). Counters are plain ints, approximate under concurrency.
+    """
+
+    def __init__(self, valid_window: int = DEFAULT_WINDOW, max_drift: int = DEFAULT_MAX_DRIFT,
+                 max_users: int = 100000):
+        self.valid_window = valid_window
+        self.max_drift = max_drift
+        self.max_users = max_users
+        self._offsets = {}
+        # Candidate offsets for each learned drift, nearest first
+        self._order = {}
+        for drift in range(-max_drift, max_drift + 1):
+            near = set(range(drift - valid_window, drift + valid_window + 1))
+            near.update(range(-valid_window, valid_window + 1))
+            self._order[drift] = tuple(sorted((o for o in near if abs(o) <= max_drift),
+                                              key=lambda o: (abs(o - drift), abs(o))))
+        self.first_try = 0
+        self.searched = 0
+        self.misses = 0
+        self.candidates = 0
+        self.overflow = 0
+
+    def offset(self, user: Hashable) -> int:
+        return self._offsets.get(user, 0)
+
+    def items(self) -> List[Tuple[Hashable, int]]:
+        """(user, offset) for every drifting user, e.g. for a snapshot."""
+        return list(self._offsets.items())
+
+    def restore(self, items: Iterable[Tuple[Hashable, int]]):
+        """Load offsets saved by `items`, clamped to this table's max_drift."""
+        for user, offset in items:
+            offset = max(-self.max_drift, min(self.max_drift, offset))
+            if offset and (user in self._offsets or len(self._offsets) < self.max_users):
+                self._offsets[user] = offset
+
+    def match(self, user: Hashable, seed: SeedLike, code: str,
+              for_time: Optional[float] = None) -> Optional[int]:
+        """
+        Match `code` for `user`, starting at its learned offset.
+
+        Returns:
+            Matched time step, or None.
+
+        Raises:
+            ValueError: If seed or code is invalid.
+        """
+        try:
+            seed = as_seed(seed)
+            check_code(code)
+        except Exception as e:
+            _verify_errors.inc()
+            raise ValueError(f"TOTP verification failed: {e}")
+
+        started = perf_counter()
+        counter = totp_counter(for_time)
+        tries = 0
+        for offset in self._order[self._offsets.get(user, 0)]:
+            step = counter + offset
+            if step < 0:
+                continue
+            tries += 1
+            if seed.code_at(step) == code:
+                _drift_timer.observe(perf_counter() - started)
+                self.candidates += tries
+                self._learn(user, offset, tries)
+                return step
+        _drift_timer.observe(perf_counter() - started)
+        self.candidates += tries
+        self.misses += 1
+        return None
+
+    def _learn(self, user: Hashable, offset: int, tries: int):
+        if tries == 1:
+            self.first_try += 1
+        else:
+            self.searched += 1
+        if offset == 0:
+            self._offsets.pop(user, None)
+        elif user in self._offsets or len(self._offsets) < self.max_users:
+            self._offsets[user] = offset
+        else:
+            self.overflow += 1
+
+    def stats(self) -> dict:
+        offsets = {}
+        for offset in list(self._offsets.values()):
+            offsets[offset] = offsets.get(offset, 0) + 1
+        matched = self.first_try + self.searched
+        return {
+            "drifting_users": sum(offsets.values()),
+            "offsets": {str(offset): count for offset, count in sorted(offsets.items())},
+            "first_try": self.first_try,
+            "searched": self.searched,
+            "misses": self.misses,
+            "overflow": self.overflow,
+            # Codes compared per verify; each is an HMAC unless the seed's window was cached
+            "candidates_per_verify": self.candidates / (matched + self.misses) if matched + self.misses else 0.0,
+        }
+
+
+class MemoryReplayBackend:
+    """Per-step buckets of accepted users, local to this process."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def add(self, step: int, user: Hashable) -> bool:
+        """Record `user` at `step`; False if it was already recorded."""
+        with self._lock:
+            bucket = self._buckets.get(step)
+            if bucket is None:
+                bucket = self._buckets[step] = set()
+            if user in bucket:
+                return False
+            bucket.add(user)
+            return True
+
+    def drop_before(self, step: int):
+        """Forget every bucket older than `step`."""
+        with self._lock:
+            for old in [s for s in self._buckets if s < step]:
+                del self._buckets[old]
+
+    def buckets(self) -> List[Tuple[int, List[Hashable]]]:
+        """(step, users) per bucket, e.g. for a snapshot."""
+        with self._lock:
+            return [(step, list(bucket)) for step, bucket in self._buckets.items()]
+
+    def restore(self, buckets: Iterable[Tuple[int, Iterable[Hashable]]]):
+        with self._lock:
+            for step, users in buckets:
+                self._buckets.setdefault(step, set()).update(users)
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._buckets.values())
+
+
+class FileReplayBackend:
+    """
+    Per-step bucket directories shared by every worker on the host.
+
+    Each acceptance is an O_EXCL file create, which is atomic across
+    processes. Point it at a tmpfs such as /dev/shm to keep it in memory.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, step: int, user: Hashable) -> bool:
+        name = str(user)
+        # The key becomes a file name: no separators, dot-names or other surprises
+        if not _REPLAY_FILE_NAME.fullmatch(name):
+            raise ValueError(f"Invalid replay key: {name[:32]!r}")
+        bucket = os.path.join(self.directory, str(step))
+        os.makedirs(bucket, exist_ok=True)
+        try:
+            os.close(os.open(os.path.join(bucket, name), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        return True
+
+    def drop_before(self, step: int):
+        for name in os.listdir(self.directory):
+            if name.isdigit() and int(name) < step:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+
+class ReplayGuard:
+    """
+    Rejects a second use of the same code by the same user.
+
+    Acceptances are recorded as (user, time step) in per-step buckets. A
+    whole bucket is dropped once its step can no longer verify, so inserts
+    and checks stay O(1) and memory is bounded by active users × window.
+    """
+
+    def __init__(self, backend=None, valid_window: int = DEFAULT_WINDOW):
+        self.backend = backend if backend is not None else MemoryReplayBackend()
+        self.valid_window = valid_window
+        self._evicted_before = None
+
+    def accept(self, user: Hashable, step: int, for_time: Optional[float] = None) -> bool:
+        """
+        Record that `user` verified a code for `step`.
+
+        Returns:
+            True the first time, False if this (user, step) was already used.
+        """
+        oldest = totp_counter(for_time) - self.valid_window
+        if oldest != self._evicted_before:
+            self.backend.drop_before(oldest)
+            self._evicted_before = oldest
+        return self.backend.add(step, user)
+
+
 if __name__ == "__main__":
+    # Subcommands: python -m totp_utils bulk|stream ...
+    if len(sys.argv) > 1 and sys.argv[1] == "bulk":
+        from totp_bulk import main as bulk_main
+        bulk_main(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "stream":
+        from totp_stream import main as stream_main
+        stream_main(sys.argv[2:])
+        sys.exit(0)
+
     # Step 0: Decrypt the seed using your private key and encrypted_seed.txt
     private_key = load_private_key("student_private.pem")
 
@@ -101,18 +622,19 @@ if __name__ == "__main__":
         hex_seed = decrypt_seed(encrypted_seed_b64, private_key)
         print("Decrypted seed:", hex_seed)
         print("Seed length:", len(hex_seed))
+        seed = TotpSeed.from_hex(hex_seed)
 
         # Test code generation
-        code, remaining = generate_totp_code(hex_seed)
+        code, remaining = generate_totp_code(seed)
         print(f"✅ TOTP Code: {code}")
         print(f"   Valid for: {remaining} seconds")
 
         # Test verification with current code
-        is_valid = verify_totp_code(hex_seed, code)
+        is_valid = verify_totp_code(seed, code)
         print(f"✅ Verification (current code): {is_valid}")
 
         # Test verification with an invalid code
-        is_invalid = verify_totp_code(hex_seed, "000000")
+        is_invalid = verify_totp_code(seed, "000000")
         print(f"✅ Verification (invalid code): {is_invalid}")
 
     except Exception as e:
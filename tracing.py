@@ -0,0 +1,207 @@
+"""
+Opt-in per-request profiling for the 2FA service
+
+ServerTimingMiddleware adds a `Server-Timing` header listing the stage
+timers (metrics.STAGE_SECONDS: seed file read, seed parse, HMAC window,
+RSA decrypt, ...) that fired while the request ran, and can hand requests
+to a profiler: cProfile for every Nth request, and a stack sampler that
+records what the worker was executing while a request was over the slow
+threshold.
+
+Nothing here is imported by the hot path. Until enable_stage_tracing() runs
+the stage timers are plain histogram children, so a disabled service pays
+nothing.
+"""
+
+import contextvars
+import cProfile
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional, Sequence
+
+from metrics import STAGE_SECONDS, _HistogramChild, perf_counter
+
+# Per-request list of (histogram child, seconds), set by the middleware
+_trace = contextvars.ContextVar("twofa_trace", default=None)
+_enabled = False
+
+
+class _TracedHistogramChild(_HistogramChild):
+    """Stage timer that also reports into the current request's trace."""
+
+    __slots__ = ()
+
+    def observe(self, value):
+        _HistogramChild.observe(self, value)
+        trace = _trace.get()
+        if trace is not None:
+            trace.append((self, value))
+
+
+def enable_stage_tracing():
+    """Switch every stage timer, existing and future, to the tracing variant."""
+    global _enabled
+    if _enabled:
+        return
+    _enabled = True
+    for child in STAGE_SECONDS._children.values():
+        child.__class__ = _TracedHistogramChild
+    STAGE_SECONDS._new_child = lambda: _TracedHistogramChild(STAGE_SECONDS.buckets)
+
+
+def bind(fn):
+    """
+    Carry the current request's trace into `fn` when it runs on another
+    thread pool (run_in_executor doesn't copy context). `fn` unchanged when
+    tracing is off.
+    """
+    if not _enabled or _trace.get() is None:
+        return fn
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+def server_timing(trace, total: float) -> bytes:
+    """Header value: one entry per stage (durations summed) plus the total, in ms."""
+    names = {id(child): key[0] for key, child in list(STAGE_SECONDS._children.items())}
+    stages = {}
+    for child, seconds in trace:
+        name = names.get(id(child), "stage")
+        stages[name] = stages.get(name, 0.0) + seconds
+    parts = [f"{name};dur={seconds * 1000:.3f}" for name, seconds in stages.items()]
+    parts.append(f"total;dur={total * 1000:.3f}")
+    return ", ".join(parts).encode("latin-1")
+
+
+def _collapse(frame) -> str:
+    """Stack as "file:function;...", root first (flamegraph folded format)."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SlowRequestSampler:
+    """
+    Samples the event-loop thread's stack while any request has been
+    running longer than `threshold` seconds.
+
+    With many requests interleaved on one loop a sample shows whatever was
+    executing at the time, which is what matters when something blocks
+    the loop. The thread only exists while the sampler is enabled.
+    """
+
+    def __init__(self, threshold: float, interval: float = 0.002):
+        self.threshold = threshold
+        self.interval = interval
+        self.thread_id = None
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, key) -> None:
+        if self._thread is None:
+            self.thread_id = threading.get_ident()
+            self._thread = threading.Thread(target=self._run, name="slow-request-sampler", daemon=True)
+            self._thread.start()
+        with self._lock:
+            self._active[key] = (perf_counter(), Counter())
+
+    def finish(self, key) -> Counter:
+        with self._lock:
+            return self._active.pop(key)[1]
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self._active:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = _collapse(frame)
+            now = perf_counter()
+            with self._lock:
+                for started, samples in self._active.values():
+                    if now - started >= self.threshold:
+                        samples[stack] += 1
+
+
+class ServerTimingMiddleware:
+    """
+    ASGI middleware adding Server-Timing to responses for `endpoints`
+    (every path if None) and profiling selected requests into
+    `profile_dir`:
+
+    - profile_every=N: run every Nth request under cProfile (.prof, read
+      with pstats or snakeviz). Only one request is profiled at a time.
+    - profile_slow=seconds: write the stack samples (.folded, for
+      flamegraph.pl / speedscope) of requests that took longer.
+    """
+
+    def __init__(self, app, endpoints: Optional[Sequence[str]] = None, header: bool = True,
+                 profile_every: int = 0, profile_slow: float = 0.0, profile_dir: str = "/tmp/2fa-profiles"):
+        self.app = app
+        self.endpoints = frozenset(endpoints) if endpoints is not None else None
+        self.header = header
+        self.profile_every = profile_every
+        self.profile_dir = profile_dir
+        self.sampler = SlowRequestSampler(profile_slow) if profile_slow > 0 else None
+        self.requests = 0
+        self._profiling = False
+        enable_stage_tracing()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (self.endpoints is not None and scope["path"] not in self.endpoints):
+            return await self.app(scope, receive, send)
+
+        trace = []
+        token = _trace.set(trace)
+        started = perf_counter()
+        self.requests += 1
+
+        async def send_wrapper(message):
+            if self.header and message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(trace, perf_counter() - started)))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        profiler = None
+        if self.profile_every and self.requests % self.profile_every == 0 and not self._profiling:
+            self._profiling = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+        if self.sampler is not None:
+            self.sampler.start(id(trace))
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = perf_counter() - started
+            _trace.reset(token)
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+                self._dump(scope["path"], "prof", profiler.dump_stats)
+            if self.sampler is not None:
+                samples = self.sampler.finish(id(trace))
+                if elapsed >= self.sampler.threshold and samples:
+                    self._dump(scope["path"], "folded", functools.partial(_write_folded, samples))
+
+    def _dump(self, path, extension, write):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{self.requests}{path.replace('/', '_')}.{extension}"
+        target = os.path.join(self.profile_dir, name)
+        write(target)
+        print(f"Profile written to {target}")
+
+
+def _write_folded(samples, target):
+    with open(target, "w") as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")